@@ -0,0 +1,258 @@
+"""
+Fleet-scale benchmark: exec, status, log and clean against N simulated hosts.
+
+Each simulated host is its own directory on this machine, behind a conduit
+that adds a configurable round trip time, bandwidth limit and failure rate to
+every operation. Every subcommand runs in a fresh child process, so its peak RSS is
+its own, and each measurement is written as a JSON line:
+
+    python bench/bench_fleet.py --hosts 10 100 --rtt-ms 0 50 --output fleet.jsonl
+
+Compare the output of two commits to see whether a change made fleet
+operations faster or slower. Note that "hosts" run their runtime as local
+subprocesses, so for large N the machine's cores are shared with them;
+`cpu_s` counts the orchestrator alone and `children_cpu_s` the hosts.
+"""
+
+import argparse
+import contextlib
+import itertools
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from cattle import cattle_cli
+
+# A config with nothing to do, so we measure cattle, not the steps.
+EMPTY_CONFIG = "steps = []\n"
+
+SUBCOMMANDS = ["exec", "status", "log", "clean"]
+
+class InjectedFailure(Exception):
+    pass
+
+class ThrottledWriter:
+    "A binary stream that can't be written faster than `bandwidth` bytes/s."
+    def __init__(self, stream, bandwidth: float):
+        self.stream = stream
+        self.bandwidth = bandwidth
+
+    def write(self, data):
+        time.sleep(len(data) / self.bandwidth)
+        return self.stream.write(data)
+
+    def flush(self):
+        self.stream.flush()
+
+    def close(self):
+        self.stream.close()
+
+# The run root cattle is told the hosts have. Each simulated host's conduit
+# maps it to that host's own directory.
+SIM_RUN_ROOT = "/cattle-bench-sim"
+
+class LatencyConduit:
+    """
+    Wraps a conduit (a LocalHostConduit, here) so it behaves like a host at
+    the far end of a slow, unreliable link, with SIM_RUN_ROOT at `root`. Each
+    operation costs a round trip and each byte sent costs 1/bandwidth seconds;
+    a `failure_rate` fraction of operations fail after paying the round trip.
+    """
+    def __init__(self, inner, root: str, rtt: float, bandwidth: float, failure_rate: float, rng: random.Random):
+        self.inner = inner
+        self.root = root
+        self.rtt = rtt
+        self.bandwidth = bandwidth
+        self.failure_rate = failure_rate
+        self.rng = rng
+
+    def _round_trip(self):
+        time.sleep(self.rtt)
+        if self.rng.random() < self.failure_rate:
+            raise InjectedFailure("injected link failure")
+
+    def _on_host(self, text: str) -> str:
+        return text.replace(SIM_RUN_ROOT, self.root)
+
+    def put(self, local_path: str, remote_path: str):
+        self._round_trip()
+        time.sleep(os.path.getsize(local_path) / self.bandwidth)
+        self.inner.put(local_path, self._on_host(remote_path))
+
+    def exec_command(self, cmd: str):
+        self._round_trip()
+        return self.inner.exec_command(self._on_host(cmd))
+
+    def popen(self, cmd: str):
+        self._round_trip()
+        proc = self.inner.popen(self._on_host(cmd))
+        proc.stdin = ThrottledWriter(proc.stdin, self.bandwidth)
+        return proc
+
+    def relay_address(self, path: str) -> str:
+        return self.inner.relay_address(self._on_host(path))
+
+    def close(self):
+        self.inner.close()
+
+def simulated_conduits(spec: dict):
+    "A conduit factory (see cattle_cli.main_args_inner) for the simulated hosts."
+    def conduit(hostdesc: str) -> LatencyConduit:
+        # Seeded per host, so a scenario injects the same failures every run.
+        return LatencyConduit(
+            cattle_cli.LocalHostConduit(), os.path.join(spec["hosts_root"], hostdesc),
+            spec["rtt_ms"] / 1000, spec["bandwidth_mbps"] * 1e6 / 8, spec["failure_rate"],
+            random.Random(f"{spec['seed']}:{spec['subcommand']}:{hostdesc}"),
+        )
+    return conduit
+
+class ThreadSampler:
+    "Tracks the most threads alive at once, sampling every `interval` seconds."
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.peak = threading.active_count()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, threading.active_count())
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+def measure(spec: dict) -> dict:
+    "Run one subcommand against the simulated fleet. (In a child process.)"
+    argv = [spec["subcommand"]]
+    if spec["subcommand"] == "exec":
+        argv += [spec["config_dir"], "--transfer", spec["transfer"]]
+    else:
+        argv += [spec["execution_id"]]
+    if spec["subcommand"] == "status":
+        # (Ask the hosts, rather than the registry, which already knows they're done.)
+        argv += ["--refresh"]
+    argv += [a for i in range(spec["hosts"]) for a in ("--host", f"sim-{i}")]
+    argv += ["--run-root", SIM_RUN_ROOT, "--max-in-flight", str(spec["max_in_flight"])]
+    if spec["adaptive"]:
+        argv += ["--adaptive"]
+
+    result, error = None, None
+    before = resource.getrusage(resource.RUSAGE_SELF)
+    before_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    started = time.perf_counter()
+    with ThreadSampler() as threads, \
+            mock.patch.dict(os.environ, {"CATTLE_REGISTRY": spec["registry"]}), \
+            open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        try:
+            result = cattle_cli.main_args_inner(argv, conduit_factory=simulated_conduits(spec))
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+    wall = time.perf_counter() - started
+    after = resource.getrusage(resource.RUSAGE_SELF)
+    after_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    return {
+        "subcommand": spec["subcommand"],
+        "ok": error is None and result.exit_code == 0,
+        "error": error,
+        "execution_id": (result.result_vars or {}).get("execution_id") if result else None,
+        "wall_s": round(wall, 4),
+        "cpu_s": round((after.ru_utime - before.ru_utime) + (after.ru_stime - before.ru_stime), 4),
+        "children_cpu_s": round(
+            (after_children.ru_utime - before_children.ru_utime)
+            + (after_children.ru_stime - before_children.ru_stime), 4),
+        # (Kilobytes on Linux.)
+        "peak_rss_kb": after.ru_maxrss,
+        "peak_threads": threads.peak,
+    }
+
+def make_config(root: str, archive_kb: int) -> str:
+    "A config dir with no steps and `archive_kb` of incompressible payload."
+    cfg = os.path.join(root, "benchcfg")
+    os.makedirs(cfg)
+    with open(os.path.join(cfg, "__cattle__.py"), "w") as f:
+        f.write(EMPTY_CONFIG)
+    with open(os.path.join(cfg, "payload.bin"), "wb") as f:
+        f.write(random.Random(archive_kb).getrandbits(8 * 1024 * archive_kb).to_bytes(1024 * archive_kb, "little")
+                if archive_kb else b"")
+    return cfg
+
+def commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True,
+        ).stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+def run_child(spec: dict) -> dict:
+    proc = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--child", json.dumps(spec)],
+        stdout=subprocess.PIPE, check=True,
+    )
+    return json.loads(proc.stdout)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--hosts", type=int, nargs="+", default=[1, 10, 50], help="Fleet sizes to try.")
+    parser.add_argument("--archive-kb", type=int, nargs="+", default=[16], help="Config payload sizes to try.")
+    parser.add_argument("--rtt-ms", type=float, nargs="+", default=[0, 20], help="Round trip times to try.")
+    parser.add_argument("--bandwidth-mbps", type=float, default=100.0, help="Each host's link speed.")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="Fraction of operations that fail.")
+    parser.add_argument("--transfer", choices=["scp", "pipeline", "stream"], default="scp")
+    parser.add_argument("--max-in-flight", type=int, default=cattle_cli.DEFAULT_MAX_IN_FLIGHT)
+    parser.add_argument("--adaptive", action="store_true", help="Let cattle adapt concurrency, up to --max-in-flight.")
+    parser.add_argument("--subcommands", nargs="+", choices=SUBCOMMANDS, default=SUBCOMMANDS)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Append JSON lines here rather than printing them.")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(measure(json.loads(args.child))))
+        return 0
+
+    out = open(args.output, "a") if args.output else sys.stdout
+    meta = {"commit": commit(), "python": sys.version.split()[0], "time": time.time()}
+    try:
+        for hosts, archive_kb, rtt_ms in itertools.product(args.hosts, args.archive_kb, args.rtt_ms):
+            with tempfile.TemporaryDirectory() as tmp:
+                scenario = {
+                    "hosts": hosts, "archive_kb": archive_kb, "rtt_ms": rtt_ms,
+                    "bandwidth_mbps": args.bandwidth_mbps, "failure_rate": args.failure_rate,
+                    "transfer": args.transfer, "max_in_flight": args.max_in_flight, "adaptive": args.adaptive,
+                    "seed": args.seed,
+                }
+                spec = dict(scenario, hosts_root=os.path.join(tmp, "hosts"),
+                            registry=os.path.join(tmp, "registry.sqlite3"),
+                            config_dir=make_config(tmp, archive_kb), execution_id=None)
+                # The other subcommands need an execution to look at.
+                for subcommand in ["exec"] + [s for s in args.subcommands if s != "exec"]:
+                    row = run_child(dict(spec, subcommand=subcommand))
+                    spec["execution_id"] = spec["execution_id"] or row.pop("execution_id")
+                    row.pop("execution_id", None)
+                    if subcommand in args.subcommands:
+                        out.write(json.dumps(dict(meta, scenario=scenario, **row)) + "\n")
+                        out.flush()
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,76 @@
+"""
+Cold-start benchmark for the remote runtime.
+
+Times `python3 cattle_runtime.pyz <subcommand>` the way a host runs it, for a
+runtime built with and without precompiled bytecode. Every run is a fresh
+interpreter, so this is start-up plus imports plus (not much) work:
+
+    python bench/bench_startup.py [--runs N] [--python python3]
+"""
+
+import argparse
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from cattle import cattle_cli
+
+# A config with nothing to do, so `exec` measures the runner, not the steps.
+EMPTY_CONFIG = "steps = []\n"
+
+def subcommands(exec_dir: str, archive: cattle_cli.Artifact):
+    "(label, argv) for each subcommand worth timing, run from exec_dir."
+    return [
+        ("help", ["--help"]),
+        ("poll", ["poll", exec_dir, "--timeout", "0"]),
+        ("init", ["init", archive.name, "--sha256", archive.digest]),
+        ("exec", ["exec", os.path.join(exec_dir, "config")]),
+    ]
+
+def time_runs(python: str, runtime: str, argv, cwd: str, runs: int):
+    times = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        subprocess.run([python, runtime] + argv, cwd=cwd, check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        times.append(time.perf_counter() - started)
+    return times
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=20, help="Invocations per subcommand.")
+    parser.add_argument("--python", default=sys.executable, help="Interpreter to run the runtime with.")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        cfg_dir = os.path.join(tmp, "config-src")
+        os.mkdir(cfg_dir)
+        with open(os.path.join(cfg_dir, "__cattle__.py"), "w") as f:
+            f.write(EMPTY_CONFIG)
+        archive = cattle_cli.make_archive(cfg_dir)
+
+        print(f"{'subcommand':<12}{'build':<12}{'median ms':>10}{'p90 ms':>10}")
+        for precompile in (False, True):
+            executable = cattle_cli.make_executable(precompile=precompile)
+            exec_dir = os.path.join(tmp, f"exec-{int(precompile)}")
+            os.mkdir(exec_dir)
+            shutil.copyfile(archive.path, os.path.join(exec_dir, archive.name))
+            runtime = os.path.join(exec_dir, cattle_cli.RUNTIME_NAME)
+            shutil.copyfile(executable.path, runtime)
+            # (Unpack once up front, so `exec` has a config on the first go.)
+            time_runs(args.python, runtime, ["init", archive.name], exec_dir, 1)
+
+            for label, argv in subcommands(exec_dir, archive):
+                times = sorted(time_runs(args.python, runtime, argv, exec_dir, args.runs))
+                p90 = times[min(len(times) - 1, int(len(times) * 0.9))]
+                build = "bytecode" if precompile else "source"
+                print(f"{label:<12}{build:<12}{statistics.median(times) * 1000:>10.1f}{p90 * 1000:>10.1f}")
+
+if __name__ == "__main__":
+    main()
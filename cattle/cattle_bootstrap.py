@@ -0,0 +1,89 @@
+"""
+Single round trip remote bootstrap.
+
+The orchestrator runs this file's source with `python3 -c` on the remote host,
+so it has to stand alone: stdlib only, and nothing from the cattle runtime
+(which may be one of the artifacts still in flight). Everything happens over
+the one exec channel:
+
+    argv:  store_dir exec_dir archive_name:digest runtime_name:digest [exec args...]
+    ->     "NEED <digest> ...\\n"      artifacts missing from the host's store
+    <-     "<size>\\n" <bytes>         once per needed digest, in order
+    ->     "STATUS <status>\\n"        after init and exec have run
+"""
+
+import hashlib
+import os
+import shutil
+import subprocess
+import sys
+
+def receive(inp, store, digest):
+    size = int(inp.readline())
+    partial = os.path.join(store, digest + ".partial")
+    h = hashlib.sha256()
+    with open(partial, "wb") as f:
+        while size > 0:
+            chunk = inp.read(min(size, 1 << 20))
+            if not chunk:
+                raise Exception("stream ended early receiving " + digest)
+            h.update(chunk)
+            f.write(chunk)
+            size -= len(chunk)
+    if h.hexdigest() != digest:
+        os.unlink(partial)
+        raise Exception("digest mismatch receiving " + digest)
+    os.replace(partial, os.path.join(store, digest))
+
+def link(store, digest, dest):
+    try:
+        os.link(os.path.join(store, digest), dest)
+    except FileExistsError:
+        pass
+    except OSError:
+        shutil.copyfile(os.path.join(store, digest), dest)
+
+def main():
+    store, exec_dir = sys.argv[1:3]
+    archive_name, archive_digest = sys.argv[3].split(":")
+    runtime_name, runtime_digest = sys.argv[4].split(":")
+    exec_args = sys.argv[5:]
+
+    os.makedirs(store, exist_ok=True)
+    os.makedirs(exec_dir, exist_ok=True)
+
+    need = [
+        d for d in (archive_digest, runtime_digest)
+        if not os.path.exists(os.path.join(store, d))
+    ]
+    out = sys.stdout
+    out.write("NEED " + " ".join(need) + "\n")
+    out.flush()
+
+    inp = sys.stdin.buffer
+    for d in need:
+        receive(inp, store, d)
+    link(store, archive_digest, os.path.join(exec_dir, archive_name))
+    link(store, runtime_digest, os.path.join(exec_dir, runtime_name))
+
+    # Keep the runtime's own output off our stdout; it's the protocol channel.
+    stderr = sys.stderr.fileno()
+    subprocess.run(
+        [sys.executable, runtime_name, "init", archive_name, "--sha256", archive_digest],
+        cwd=exec_dir, check=True, stdout=stderr,
+    )
+    subprocess.run(
+        [sys.executable, runtime_name, "exec", os.path.join(exec_dir, "config")] + exec_args,
+        cwd=exec_dir, check=True, stdout=stderr,
+    )
+
+    try:
+        with open(os.path.join(exec_dir, "STATUS")) as f:
+            status = f.read().strip()
+    except FileNotFoundError:
+        status = "UNKNOWN"
+    out.write("STATUS " + status + "\n")
+    out.flush()
+
+if __name__ == "__main__":
+    main()
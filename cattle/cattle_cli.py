@@ -1,92 +1,859 @@
 import argparse
+import atexit
+import collections
 import concurrent.futures
 import getpass
+import hashlib
 import importlib
+import importlib.util
+import io
+import itertools
+import json
+import lzma
+import marshal
+import math
 import os
 import pathlib
+import shlex
 import shutil
+import sqlite3
+import stat
 import subprocess
 import sys
 import tarfile
 import tempfile
 import threading
 import time
-from typing import Dict, NamedTuple, Union
-import zipapp
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple, Union
+import zipfile
+import zlib
 
 import paramiko
 import scp
 
+from cattle import cattle_remote
+from cattle.facility.file import MANIFEST_NAME
+
 EXCLUDE_FRAGMENTS = ["__pycache__", ".pytest_cache"]
 
-def make_archive(cfg_dir):
-    def add_filter(item: tarfile.TarInfo):
-        for f in EXCLUDE_FRAGMENTS:
-            if f in item.name:
-                return None
-        return item
+# Names the artifacts get inside a remote execution directory.
+ARCHIVE_NAME = "config.tar"
+DELTA_NAME = "config.delta.tar"
+RUNTIME_NAME = "cattle_runtime.pyz"
+
+# Directory (under the run root) holding each host's content-addressed artifact
+# store.
+STORE_DIRNAME = "artifacts"
+
+DEFAULT_RUN_ROOT = "/var/run/cattle"
+DEFAULT_PORT = 22
+
+# Pooled SSH connections send a keepalive this often (in seconds), and are
+# closed once nothing has used them for SSH_IDLE_TIMEOUT.
+SSH_KEEPALIVE_INTERVAL = 15
+SSH_IDLE_TIMEOUT = 60
+
+# Source of the single round trip bootstrap, which runs under `python3 -c`.
+BOOTSTRAP_SCRIPT = (pathlib.Path(__file__).parent / "cattle_bootstrap.py").read_text()
+
+# The scp transfer path spends separate exec channels on the store probe, each
+# upload, the admit/link step, the execute and the status read. The pipelined
+# bootstrap does all of it in one channel with one extra exchange inside it.
+SCP_PATH_ROUND_TRIPS = 4
+PIPELINE_ROUND_TRIPS = 2
 
-    with tempfile.NamedTemporaryFile(prefix="cattle_cfg_", delete=False) as t:
-        with tarfile.open(mode="w:gz", fileobj=t) as tar:
-            tar.add(cfg_dir, arcname="config", recursive=True, filter=add_filter)
-            return t.name
+class Artifact(NamedTuple):
+    """A local file destined for each host, identified by its content digest."""
+    path: str
+    name: str
+    digest: str
+
+def file_digest(path) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def make_artifact(path, name) -> Artifact:
+    return Artifact(path, name, file_digest(path))
+
+def cache_dir() -> str:
+    """
+    Where built artifacts are kept between invocations. Override with
+    $CATTLE_CACHE_DIR.
+    """
+    root = os.getenv("CATTLE_CACHE_DIR") or os.path.join(
+        os.getenv("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "cattle"
+    )
+    os.makedirs(root, exist_ok=True)
+    return root
+
+# Bump this whenever the layout of built artifacts changes, so stale cache
+# entries stop matching.
+BUILD_FORMAT = 4
+
+# How many recently used builds of each kind to keep in the cache. Builds used
+# within CACHE_GRACE seconds are kept regardless, as another cattle may still
+# be uploading them.
+CACHE_KEEP = 8
+CACHE_GRACE = 24 * 60 * 60
+
+def _excluded(relpath: str) -> bool:
+    return any(f in relpath for f in EXCLUDE_FRAGMENTS)
+
+def _walk_inputs(root: str, exclude_names=()):
+    """
+    Yield (relpath, stat) for every file and directory under root, in a stable
+    order, skipping excluded paths.
+    """
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        reldir = os.path.relpath(dirpath, root)
+        for name in dirnames + sorted(filenames):
+            relpath = os.path.normpath(os.path.join(reldir, name))
+            if _excluded(relpath) or name in exclude_names:
+                continue
+            yield relpath, os.lstat(os.path.join(dirpath, name))
+
+def _fingerprint(kind: str, entries) -> str:
+    "A digest of the build inputs' metadata. Costs a stat walk, not a read."
+    h = hashlib.sha256(f"{kind}:{BUILD_FORMAT}".encode())
+    for relpath, st in entries:
+        h.update(f"\0{relpath}:{st.st_mode}:{st.st_size}:{st.st_mtime_ns}".encode())
+    return h.hexdigest()
+
+def _prune_cache(root: str, kind: str):
+    builds = sorted(
+        (e for e in os.scandir(root) if e.name.startswith(f"{kind}-") and not e.name.endswith(".sha256")),
+        key=lambda e: e.stat().st_mtime,
+        reverse=True,
+    )
+    now = time.time()
+    for e in builds[CACHE_KEEP:]:
+        if now - e.stat().st_mtime < CACHE_GRACE:
+            continue
+        for path in (e.path, e.path + ".sha256"):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
 
-def _make_zipapp_archive(**kwargs):
+def _cached_build(kind: str, fingerprint: str, name: str, build) -> Artifact:
     """
-    zipapp.create_archive's `filter` param was added in Py3.7. Work around that.
+    Return the cached artifact for this fingerprint, calling `build(fileobj)`
+    to produce it on a miss.
     """
-    if sys.version_info < (3, 7):
+    root = cache_dir()
+    path = os.path.join(root, f"{kind}-{fingerprint}")
+    try:
+        with open(path + ".sha256") as f:
+            digest = f.read().strip()
+        os.utime(path)
+        return Artifact(path, name, digest)
+    except FileNotFoundError:
+        pass
+
+    with tempfile.NamedTemporaryFile(dir=root, prefix=f".{kind}-", delete=False) as t:
         try:
-            del kwargs["filter"]
-        except KeyError:
-            pass
-    zipapp.create_archive(**kwargs)
+            build(t)
+        except BaseException:
+            os.unlink(t.name)
+            raise
+    digest = file_digest(t.name)
+    # The digest lands first, whole: a reader that finds it before the
+    # artifact just misses (os.utime fails) and builds it too.
+    with tempfile.NamedTemporaryFile("w", dir=root, prefix=f".{kind}-", suffix=".sha256", delete=False) as d:
+        d.write(digest)
+    os.replace(d.name, path + ".sha256")
+    os.replace(t.name, path)
+    _prune_cache(root, kind)
+    return Artifact(path, name, digest)
 
-def make_executable():
-    this_file = pathlib.Path(__file__)
-    exclude = {this_file.name, "test_cattle.py"}
-    def should_include(p: pathlib.Path) -> bool:
-        return (
-            all(f not in str(p.resolve()) for f in EXCLUDE_FRAGMENTS)
-            and str(p.name) not in exclude
-        )
+def _normalize(info: tarfile.TarInfo) -> tarfile.TarInfo:
+    "Strip the bits of a tar header that would make builds irreproducible."
+    info.mtime = 0
+    info.uid = info.gid = 0
+    info.uname = info.gname = ""
+    return info
+
+def config_entries(cfg_dir: str):
+    return list(_walk_inputs(cfg_dir, exclude_names={MANIFEST_NAME}))
+
+def build_manifest(cfg_dir: str, entries) -> bytes:
+    """
+    The size and digest of every regular file in the config, so facilities on
+    the host can compare against sources without reading them.
+    """
+    files = {
+        pathlib.PurePath(relpath).as_posix(): {
+            "size": st.st_size,
+            "sha256": file_digest(os.path.join(cfg_dir, relpath)),
+        }
+        for relpath, st in entries
+        if stat.S_ISREG(st.st_mode)
+    }
+    return json.dumps({"files": files}, sort_keys=True).encode()
+
+# Archive codecs, and the suffix each gives an archive's name. The remote side
+# goes by the name (or, streaming, by `init --codec`) to decode.
+CODEC_SUFFIXES = {"none": "", "gz": ".gz", "xz": ".xz"}
+
+# Rough single core throughput, in bytes/s, of each codec at the level we use.
+# For choosing a codec, and deliberately not measured, so the same content
+# gets the same codec (and so the same cached archive) every time.
+CODEC_SPEEDS = {"none": float("inf"), "gz": 40e6, "xz": 3e6}
+
+# The tar stream is cut into chunks of this size, each compressed on its own
+# (as a separate gzip member or xz stream) so the chunks can be compressed in
+# parallel. Readers see the concatenation as one stream.
+CODEC_CHUNK_SIZES = {"gz": 1 << 20, "xz": 4 << 20}
 
-    with tempfile.NamedTemporaryFile(prefix="cattle_runtime_", delete=False) as t:
-        _make_zipapp_archive(
-            source=this_file.absolute().parent,
-            target=t,
-            main="cattle_remote:main",
-            filter=should_include,
+def _compress_chunk(codec: str, data: bytes) -> bytes:
+    if codec == "gz":
+        # (wbits 31: a gzip wrapper, with a zero mtime.)
+        c = zlib.compressobj(6, zlib.DEFLATED, 31)
+        return c.compress(data) + c.flush()
+    return lzma.compress(data, preset=6)
+
+class ChunkCompressor:
+    """
+    A writable stream that compresses what's written to it onto fileobj, a
+    chunk at a time, on a pool of threads: zlib and lzma let go of the GIL
+    while they work. Chunks are cut at fixed offsets, so the output doesn't
+    depend on the thread count.
+    """
+    def __init__(self, fileobj, codec: str, workers: Optional[int] = None):
+        self.fileobj = fileobj
+        self.codec = codec
+        self.workers = workers or os.cpu_count() or 1
+        self.written = 0
+        self.buffer = bytearray()
+        self.pending = collections.deque()
+        self.executor = (
+            concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) if codec != "none" else None
         )
-        return t.name
+
+    def write(self, data):
+        self.written += len(data)
+        if self.executor is None:
+            self.fileobj.write(data)
+            return len(data)
+        self.buffer += data
+        size = CODEC_CHUNK_SIZES[self.codec]
+        while len(self.buffer) >= size:
+            self._submit(bytes(self.buffer[:size]))
+            del self.buffer[:size]
+        return len(data)
+
+    def _submit(self, chunk: bytes):
+        self.pending.append(self.executor.submit(_compress_chunk, self.codec, chunk))
+        # Write out what's done, and hold no more than a couple of chunks per
+        # worker in memory.
+        while self.pending and (self.pending[0].done() or len(self.pending) > 2 * self.workers):
+            self.fileobj.write(self.pending.popleft().result())
+
+    def tell(self) -> int:
+        return self.written
+
+    def flush(self):
+        # (Flushing a partial chunk would make the output depend on when we
+        # were asked to.)
+        pass
+
+    def close(self):
+        if self.executor is None:
+            return
+        try:
+            if self.buffer or not self.written:
+                self._submit(bytes(self.buffer))
+                self.buffer = bytearray()
+            while self.pending:
+                self.fileobj.write(self.pending.popleft().result())
+        finally:
+            self._shutdown()
+
+    def _shutdown(self):
+        for future in self.pending:
+            future.cancel()
+        self.pending.clear()
+        self.executor.shutdown()
+        self.executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        elif self.executor is not None:
+            # (The output's being thrown away: don't finish it.)
+            self._shutdown()
+
+def _sample(cfg_dir: str, relpaths, budget: int, data: bytes = b"") -> bytes:
+    "Up to `budget` bytes, spread across `data` and the files at relpaths."
+    parts = len(relpaths) + bool(data)
+    if not parts:
+        return b""
+    share = max(4096, budget // parts)
+    sample = bytearray(data[:share])
+    for relpath in relpaths:
+        if len(sample) >= budget:
+            break
+        with open(os.path.join(cfg_dir, relpath), "rb") as f:
+            sample += f.read(share)
+    return bytes(sample)
+
+def _ratios(sample: bytes, budget: int) -> Dict[str, float]:
+    if not sample:
+        return {codec: 1.0 for codec in CODEC_SUFFIXES}
+    xz_sample = sample[:budget // 4]
+    return {
+        "none": 1.0,
+        "gz": len(_compress_chunk("gz", sample)) / len(sample),
+        "xz": len(_compress_chunk("xz", xz_sample)) / len(xz_sample),
+    }
+
+def sample_ratios(cfg_dir: str, entries, budget: int = 1 << 20) -> Dict[str, float]:
+    """
+    Each codec's compression ratio on a sample of the config: up to `budget`
+    bytes, spread across its files. (xz, being slow, gets a quarter of that.)
+    """
+    files = [relpath for relpath, st in entries if stat.S_ISREG(st.st_mode) and st.st_size]
+    return _ratios(_sample(cfg_dir, files, budget), budget)
+
+def _fastest_codec(size: int, ratios: Dict[str, float], link_bps: float, workers: int) -> str:
+    return min(
+        CODEC_SUFFIXES,
+        key=lambda codec: size / (CODEC_SPEEDS[codec] * workers) + size * ratios[codec] / link_bps,
+    )
+
+def _cached_choice(fingerprint: str, choose) -> str:
+    """
+    The codec chosen before for this fingerprint, or else `choose()`'s,
+    remembered: sampling costs a read and a compression of up to a MiB, on
+    every exec, for an answer that only changes with the inputs.
+    """
+    root = cache_dir()
+    path = os.path.join(root, f"codec-{fingerprint}")
+    try:
+        with open(path) as f:
+            codec = f.read().strip()
+        if codec in CODEC_SUFFIXES:
+            os.utime(path)
+            return codec
+    except FileNotFoundError:
+        pass
+    codec = choose()
+    with tempfile.NamedTemporaryFile("w", dir=root, prefix=".codec-", delete=False) as t:
+        t.write(codec)
+    os.replace(t.name, path)
+    _prune_cache(root, "codec")
+    return codec
+
+def choose_codec(cfg_dir: str, entries, link_bps: float, workers: Optional[int] = None) -> str:
+    """
+    The codec that should get the config to a host soonest: the time to
+    compress it here, on every core, plus the time to send the result over a
+    link_bps link, going by the ratios on a sample of the content. Big,
+    incompressible configs go uncompressed; small, compressible ones on slow
+    links get xz. The choice is cached under the config's build fingerprint.
+    """
+    workers = workers or os.cpu_count() or 1
+
+    def choose():
+        size = sum(st.st_size for _, st in entries if stat.S_ISREG(st.st_mode))
+        return _fastest_codec(size, sample_ratios(cfg_dir, entries), link_bps, workers)
+
+    return _cached_choice(_fingerprint(f"codec-config-{link_bps}-{workers}", entries), choose)
+
+def write_archive(cfg_dir: str, fileobj, entries=None, manifest: Optional[bytes] = None, codec: str = "gz"):
+    """
+    Write a reproducible compressed tar of cfg_dir, plus its manifest, to
+    fileobj: entries are sorted and timestamps and ownership are fixed, so
+    identical inputs give identical bytes.
+    """
+    if entries is None:
+        entries = config_entries(cfg_dir)
+    if manifest is None:
+        manifest = build_manifest(cfg_dir, entries)
+    with ChunkCompressor(fileobj, codec) as compressed:
+        with tarfile.open(mode="w", fileobj=compressed, format=tarfile.GNU_FORMAT) as tar:
+            tar.addfile(_normalize(tar.gettarinfo(cfg_dir, arcname="config")))
+            info = _normalize(tarfile.TarInfo(os.path.join("config", MANIFEST_NAME)))
+            info.size = len(manifest)
+            info.mode = 0o644
+            tar.addfile(info, io.BytesIO(manifest))
+            for relpath, _ in entries:
+                full = os.path.join(cfg_dir, relpath)
+                info = _normalize(tar.gettarinfo(full, arcname=os.path.join("config", relpath)))
+                if info.isreg():
+                    with open(full, "rb") as f:
+                        tar.addfile(info, f)
+                else:
+                    tar.addfile(info)
+
+class HashingWriter:
+    "Writes through to a binary stream, hashing whatever passes by."
+    def __init__(self, stream):
+        self.stream = stream
+        self.hash = hashlib.sha256()
+        self.written = 0
+
+    def write(self, data):
+        self.hash.update(data)
+        self.written += len(data)
+        return self.stream.write(data)
+
+    def flush(self):
+        self.stream.flush()
+
+class ChunkedWriter:
+    """
+    Frames writes for a streaming init (see cattle_remote.ChunkedReader), so
+    the far end can tell where the archive stops and the digest trailer
+    starts, and hold off unpacking into place until it's checked.
+    """
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, data):
+        if data:
+            self.stream.write(b"%x\n" % len(data))
+            self.stream.write(data)
+        return len(data)
+
+    def flush(self):
+        self.stream.flush()
+
+    def finish(self, digest: str):
+        self.stream.write(f"0\n{digest}\n".encode())
+
+def make_archive(cfg_dir, codec: str = "gz") -> Artifact:
+    entries = config_entries(cfg_dir)
+    return _cached_build(
+        "config", _fingerprint(f"config-{codec}", entries), ARCHIVE_NAME + CODEC_SUFFIXES[codec],
+        lambda f: write_archive(cfg_dir, f, entries, codec=codec),
+    )
+
+# Changed files bigger than this are sent whole rather than diffed. Diffing
+# reads them into memory and rolls a checksum over them in Python, at roughly
+# half a second a MiB, so past a few MiB sending the file beats diffing it on
+# all but the slowest links.
+DELTA_MAX_DIFF_SIZE = 4 << 20
+
+def delta_ops(data: bytes, block_size: int, blocks) -> Tuple[list, bytes]:
+    """
+    The rsync algorithm: express `data` as runs of blocks from an old file
+    (given its blocks' weak and strong checksums) and literal bytes. Returns
+    ops, each ["copy", first block, block count] or ["data", offset, length]
+    into the returned literal bytes.
+    """
+    index = {}
+    for i, (weak, strong) in enumerate(blocks):
+        index.setdefault(weak, []).append((strong, i))
+
+    ops, literal = [], bytearray()
+
+    def emit_data(start, end):
+        if start < end:
+            ops.append(["data", len(literal), end - start])
+            literal.extend(data[start:end])
+
+    n, L = len(data), block_size
+    i = unmatched = 0
+    if n >= L:
+        weak = cattle_remote.weak_checksum(data[:L])
+        a, b = weak & 0xffff, weak >> 16
+    while i + L <= n:
+        match = None
+        for strong, j in index.get((b << 16) | a, ()):
+            if strong == cattle_remote.strong_checksum(data[i:i + L]):
+                match = j
+                break
+        if match is not None:
+            emit_data(unmatched, i)
+            if ops and ops[-1][0] == "copy" and ops[-1][1] + ops[-1][2] == match:
+                ops[-1][2] += 1
+            else:
+                ops.append(["copy", match, 1])
+            i = unmatched = i + L
+            if i + L <= n:
+                weak = cattle_remote.weak_checksum(data[i:i + L])
+                a, b = weak & 0xffff, weak >> 16
+        else:
+            # Roll the window on a byte.
+            if i + L < n:
+                a = (a - data[i] + data[i + L]) & 0xffff
+                b = (b - L * data[i] + a) & 0xffff
+            i += 1
+    emit_data(unmatched, n)
+    return ops, bytes(literal)
+
+def _plan_delta(cfg_dir: str, entries, files: dict, base: dict) -> Tuple[dict, bytes, set]:
+    """
+    Work out what a delta against `base` carries: its spec, the literal bytes
+    its patches draw on, and the relpaths of the files it sends whole.
+    """
+    base_files = base.get("manifest") or {}
+    by_digest = {entry["sha256"]: p for p, entry in base_files.items()}
+    sigs = base.get("files") or {}
+    spec = {"base": base["base"], "files": {}}
+    data = io.BytesIO()
+    whole = set()
+    for relpath, st in entries:
+        posix = pathlib.PurePath(relpath).as_posix()
+        if not stat.S_ISREG(st.st_mode):
+            continue
+        entry = {"sha256": files[posix]["sha256"], "size": st.st_size, "mode": stat.S_IMODE(st.st_mode)}
+        if entry["sha256"] in by_digest:
+            spec["files"][posix] = dict(entry, op="same", **{"from": by_digest[entry["sha256"]]})
+            continue
+        if posix in sigs:
+            with open(os.path.join(cfg_dir, relpath), "rb") as f:
+                ops, literal = delta_ops(f.read(), sigs[posix]["block_size"], sigs[posix]["blocks"])
+            if len(literal) < st.st_size:
+                for op in ops:
+                    if op[0] == "data":
+                        op[1] += data.tell()
+                data.write(literal)
+                spec["files"][posix] = dict(entry, op="patch", block_size=sigs[posix]["block_size"], ops=ops)
+                continue
+        whole.add(relpath)
+    return spec, data.getvalue(), whole
+
+def make_delta(cfg_dir: str, entries, manifest: bytes, base: dict, codec: str = "gz",
+               link_bps: Optional[float] = None, workers: Optional[int] = None) -> Artifact:
+    """
+    Build an archive that recreates the config on a host from `base`, the
+    host's latest config (as described by `cattle_remote signatures`): files
+    the base already has are reused, changed files it has an old version of
+    are sent as rsync-style deltas, and the rest are sent whole. With no base,
+    that's everything. Cached, since every host with the same base gets the
+    same delta. Codec "auto" chooses as choose_codec does, but by what the
+    delta carries rather than the whole config.
+    """
+    files = json.loads(manifest)["files"]
+    base_digest = hashlib.sha256(json.dumps(base, sort_keys=True).encode()).hexdigest()
+    planned = []
+
+    def plan():
+        if not planned:
+            planned.append(_plan_delta(cfg_dir, entries, files, base))
+        return planned[0]
+
+    if codec == "auto":
+        workers = workers or os.cpu_count() or 1
+
+        def choose():
+            _, data, whole = plan()
+            sizes = dict(entries)
+            size = len(data) + sum(sizes[relpath].st_size for relpath in whole)
+            sample = _sample(cfg_dir, sorted(r for r in whole if sizes[r].st_size), 1 << 20, data)
+            return _fastest_codec(size, _ratios(sample, 1 << 20), link_bps, workers)
+
+        codec = _cached_choice(_fingerprint(f"codec-delta-{base_digest}-{link_bps}-{workers}", entries), choose)
+
+    def build(fileobj):
+        spec, data, whole = plan()
+        with ChunkCompressor(fileobj, codec) as compressed:
+            with tarfile.open(mode="w", fileobj=compressed, format=tarfile.GNU_FORMAT) as tar:
+                tar.addfile(_normalize(tar.gettarinfo(cfg_dir, arcname="config")))
+                for name, content in (
+                    (os.path.join("config", MANIFEST_NAME), manifest),
+                    (cattle_remote.DELTA_SPEC_NAME, json.dumps(spec, sort_keys=True).encode()),
+                    (cattle_remote.DELTA_DATA_NAME, data),
+                ):
+                    info = _normalize(tarfile.TarInfo(name))
+                    info.size = len(content)
+                    info.mode = 0o644
+                    tar.addfile(info, io.BytesIO(content))
+                for relpath, st in entries:
+                    if stat.S_ISREG(st.st_mode) and relpath not in whole:
+                        continue
+                    full = os.path.join(cfg_dir, relpath)
+                    info = _normalize(tar.gettarinfo(full, arcname=os.path.join("config", relpath)))
+                    if info.isreg():
+                        with open(full, "rb") as f:
+                            tar.addfile(info, f)
+                    else:
+                        tar.addfile(info)
+
+    return _cached_build(
+        "delta", _fingerprint(f"delta-{codec}-{base_digest}", entries), DELTA_NAME + CODEC_SUFFIXES[codec], build,
+    )
+
+# zipapp's entry point, except that it passes main()'s return code on as the
+# exit status.
+ZIPAPP_MAIN = "import sys\nimport cattle_remote\nsys.exit(cattle_remote.main())\n"
+
+def _zip_entry(name: str) -> zipfile.ZipInfo:
+    info = zipfile.ZipInfo(name, date_time=(1980, 1, 1, 0, 0, 0))
+    info.external_attr = 0o644 << 16
+    return info
+
+def _compile_pyc(source: bytes, filename: str) -> bytes:
+    """
+    Compile module source to an unchecked hash-based pyc (PEP 552) for this
+    interpreter. Unchecked, because zipimport can't check a zip entry's
+    timestamp the way the regular importer checks a file's.
+    """
+    code = compile(source, filename, "exec", dont_inherit=True)
+    return (
+        importlib.util.MAGIC_NUMBER
+        + (0b01).to_bytes(4, "little")
+        + importlib.util.source_hash(source)
+        + marshal.dumps(code)
+    )
+
+def make_executable(precompile: bool = True) -> Artifact:
+    """
+    Build the zipapp runtime that runs configs on the remote host. Like
+    zipapp.create_archive, but reproducible.
+
+    With `precompile`, each module also ships as bytecode for the interpreter
+    we're running under, sparing the host a compile on every invocation. A
+    host running some other Python version finds the bytecode's magic number
+    wrong, and zipimport falls back to the source.
+    """
+    this_file = pathlib.Path(__file__)
+    source = str(this_file.absolute().parent)
+    entries = [
+        (relpath, st)
+        for relpath, st in _walk_inputs(source, exclude_names={this_file.name, "test_cattle.py", "cattle_bootstrap.py"})
+        if not stat.S_ISDIR(st.st_mode)
+    ]
+    # (Hash-based pycs arrived in Python 3.7.)
+    precompile = precompile and hasattr(importlib.util, "source_hash")
+
+    def build(fileobj):
+        with zipfile.ZipFile(fileobj, "w") as z:
+            for relpath, _ in entries:
+                with open(os.path.join(source, relpath), "rb") as f:
+                    data = f.read()
+                z.writestr(_zip_entry(relpath), data)
+                if precompile and relpath.endswith(".py"):
+                    # Named for where it'll be on the host, so tracebacks read
+                    # sensibly; zipimport looks for "<module>.pyc" beside the source.
+                    pyc = _compile_pyc(data, os.path.join(RUNTIME_NAME, relpath))
+                    z.writestr(_zip_entry(relpath + "c"), pyc)
+            z.writestr(_zip_entry("__main__.py"), ZIPAPP_MAIN)
+
+    kind = f"runtime-{importlib.util.MAGIC_NUMBER.hex()}" if precompile else "runtime"
+    return _cached_build("runtime", _fingerprint(kind, entries), RUNTIME_NAME, build)
+
+class KnownHosts:
+    """
+    The user's known_hosts, parsed once and indexed by host name. Loading it
+    into each paramiko client instead costs a parse of the whole file per
+    host, and paramiko looks names up by scanning every entry.
+    """
+    def __init__(self, path: Optional[str] = None):
+        self.lock = threading.Lock()
+        # name -> {key type: key}
+        self.by_name: Dict[str, Dict[str, paramiko.PKey]] = {}
+        # ("|1|salt|hash", {key type: key}) for hashed names, which can only
+        # be matched by hashing the name we're after with each one's salt.
+        self.hashed: List[Tuple[str, Dict[str, paramiko.PKey]]] = []
+        path = path or os.path.expanduser("~/.ssh/known_hosts")
+        try:
+            f = open(path)
+        except OSError:
+            return
+        with f:
+            for lineno, line in enumerate(f, 1):
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+                try:
+                    entry = paramiko.hostkeys.HostKeyEntry.from_line(line, lineno)
+                except paramiko.SSHException:
+                    continue
+                if entry is None:
+                    continue
+                for name in entry.hostnames:
+                    if name.startswith("|1|"):
+                        self.hashed.append((name, {entry.key.get_name(): entry.key}))
+                    else:
+                        self.by_name.setdefault(name, {})[entry.key.get_name()] = entry.key
+
+    def lookup(self, name: str) -> Dict[str, paramiko.PKey]:
+        "The keys known for `name` (a host, or \"[host]:port\" off port 22), by type."
+        with self.lock:
+            keys = self.by_name.get(name)
+            if keys is None:
+                keys = {}
+                for hashed, hashed_keys in self.hashed:
+                    if paramiko.HostKeys.hash_host(name, hashed) == hashed:
+                        keys.update(hashed_keys)
+                # (Remembered, so each name is hashed against the file once.)
+                self.by_name[name] = keys
+            return dict(keys)
+
+    def add(self, name: str, key: paramiko.PKey):
+        with self.lock:
+            self.by_name.setdefault(name, {})[key.get_name()] = key
+
+class ConnectionPool:
+    """
+    SSH connections shared by every conduit to the same host, port and user,
+    in this process: subcommands run one after another through
+    main_args_inner reuse the connections of the ones before. Each conduit
+    opens its own channels on the shared transport. Connections get
+    keepalives while pooled and are closed after `idle_timeout` seconds with
+    no conduit holding them. Agents started on a connection are kept with it,
+    for later conduits to reuse, and go when it does.
+    """
+    def __init__(self, idle_timeout: float = SSH_IDLE_TIMEOUT, keepalive: int = SSH_KEEPALIVE_INTERVAL,
+                 known_hosts_path: Optional[str] = None):
+        self.idle_timeout = idle_timeout
+        self.keepalive = keepalive
+        self.known_hosts_path = known_hosts_path
+        self._known_hosts = None
+        self.lock = threading.Lock()
+        # (host, port, username) -> client, and how many conduits hold it,
+        # and (once none do) since when it's been idle.
+        self.clients: Dict[tuple, paramiko.SSHClient] = {}
+        self.holders: Dict[tuple, int] = {}
+        self.idle_since: Dict[tuple, float] = {}
+        # One lock per key, so two conduits to a host don't both connect.
+        self.connecting: Dict[tuple, threading.Lock] = {}
+        # key -> the agents running on that connection, by name (see agent()),
+        # and one lock per agent, so two conduits don't both start it.
+        self.agents: Dict[tuple, Dict[tuple, "AgentClient"]] = {}
+        self.starting: Dict[tuple, threading.Lock] = {}
+        self.reaper = None
+
+    def known_hosts(self) -> KnownHosts:
+        with self.lock:
+            if self._known_hosts is None:
+                self._known_hosts = KnownHosts(self.known_hosts_path)
+            return self._known_hosts
+
+    def acquire(self, host: str, port: int, username: str, password: str) -> paramiko.SSHClient:
+        "A connected client for the host, new or pooled. Give it back with release()."
+        key = (host, port, username)
+        with self.lock:
+            connecting = self.connecting.setdefault(key, threading.Lock())
+        with connecting:
+            with self.lock:
+                client = self.clients.get(key)
+                if client is not None and client.get_transport() and client.get_transport().is_active():
+                    self.holders[key] += 1
+                    self.idle_since.pop(key, None)
+                    return client
+            # (Not pooled, or it died: anyone holding a dead one will find out
+            # when they use it.)
+            fresh = self._connect(host, port, username, password)
+            with self.lock:
+                self.clients[key] = fresh
+                self.holders[key] = self.holders.get(key, 0) + 1
+                self.idle_since.pop(key, None)
+                # (Any agents went with the old connection.)
+                self.agents.pop(key, None)
+            if client is not None:
+                client.close()
+            return fresh
+
+    def _connect(self, host: str, port: int, username: str, password: str) -> paramiko.SSHClient:
+        known_hosts = self.known_hosts()
+        name = host if port == DEFAULT_PORT else f"[{host}]:{port}"
+        c = paramiko.SSHClient()
+        # Only this host's keys, so paramiko still does the checking (and
+        # negotiates for a key type we know).
+        for key in known_hosts.lookup(name).values():
+            c.get_host_keys().add(name, key.get_name(), key)
+        c.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        c.connect(host, port, username, password)
+        transport = c.get_transport()
+        transport.set_keepalive(self.keepalive)
+        known_hosts.add(name, transport.get_remote_server_key())
+        return c
+
+    def agent(self, host: str, port: int, username: str, name: tuple,
+              start: Callable[[], "AgentClient"]) -> "AgentClient":
+        """
+        The agent `name` running on the host's connection or, if there isn't
+        one (or it has exited), the one start() starts on it.
+        """
+        key = (host, port, username)
+        with self.lock:
+            starting = self.starting.setdefault(key + name, threading.Lock())
+        with starting:
+            with self.lock:
+                agent = self.agents.get(key, {}).get(name)
+            if agent is None or agent.closed:
+                agent = start()
+                with self.lock:
+                    self.agents.setdefault(key, {})[name] = agent
+            return agent
+
+    def release(self, host: str, port: int, username: str):
+        key = (host, port, username)
+        with self.lock:
+            self.holders[key] -= 1
+            if self.holders[key] > 0:
+                return
+            self.idle_since[key] = time.monotonic()
+            if self.reaper is None:
+                self.reaper = threading.Thread(target=self._reap, daemon=True)
+                self.reaper.start()
+
+    def _reap(self):
+        while True:
+            time.sleep(self.idle_timeout / 4)
+            with self.lock:
+                self.close_idle()
+                if not self.idle_since:
+                    self.reaper = None
+                    return
+
+    def close_idle(self, now: Optional[float] = None):
+        "Close connections idle for longer than the idle timeout. (Call holding self.lock.)"
+        now = time.monotonic() if now is None else now
+        for key, since in list(self.idle_since.items()):
+            if now - since >= self.idle_timeout:
+                self._drop(key)
+
+    def _drop(self, key):
+        # Closing the connection closes the agents' channels, and they exit.
+        self.agents.pop(key, None)
+        self.clients.pop(key).close()
+        self.holders.pop(key, None)
+        self.idle_since.pop(key, None)
+
+    def close(self):
+        "Close every connection, held or not."
+        with self.lock:
+            for key in list(self.clients):
+                self._drop(key)
+
+SSH_POOL = ConnectionPool()
+atexit.register(SSH_POOL.close)
 
 class RemoteHostConduit:
     """
-    Implements file transfers and command execution for a remote host.
+    Implements file transfers and command execution for a remote host, over a
+    connection from the pool.
     """
-    def __init__(self, host, port, username, password):
+    def __init__(self, host, port, username, password, pool: Optional[ConnectionPool] = None):
         self.host = host
         self.port = port
         self.username = username
         self.password = password
+        self.pool = pool or SSH_POOL
         self.ssh_client = None
 
     def _connect(self):
-        """Establish a connected SSH client, if one isn't already connected."""
+        """Take a connected SSH client from the pool, if we don't have one."""
         if self.ssh_client is not None:
             return
-        c = paramiko.SSHClient()
-        c.load_system_host_keys()
-        c.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        c.connect(self.host, self.port, self.username, self.password)
-        self.ssh_client = c
+        self.ssh_client = self.pool.acquire(self.host, self.port, self.username, self.password)
 
-    def transfer(self, archive, executable, exec_dir):
+    def put(self, local_path: str, remote_path: str):
         self._connect()
-        self.exec_command(f"mkdir -p {exec_dir}")
         with scp.SCPClient(self.ssh_client.get_transport()) as scp_client:
-            scp_client.put(archive, exec_dir)
-            scp_client.put(executable, exec_dir)
+            scp_client.put(local_path, remote_path)
 
     def exec_command(self, cmd: str):
         """Execute command, make sure it's a success, and return stdout as a string."""
@@ -100,65 +867,737 @@ class RemoteHostConduit:
             )
         return cmd_out.read().decode().strip()
 
+    def relay_address(self, path: str) -> str:
+        "How a relaying peer reaches `path` on this host."
+        return f"ssh://{self.username}@{self.host}:{self.port}{path}"
+
+    def close(self):
+        "Give the connection back to the pool."
+        if self.ssh_client is not None:
+            self.ssh_client = None
+            self.pool.release(self.host, self.port, self.username)
+
+    def popen(self, cmd: str) -> "ChannelProcess":
+        """Start a command, leaving its stdin and stdout open for a conversation."""
+        self._connect()
+        channel = self.ssh_client.get_transport().open_session()
+        channel.exec_command(cmd)
+        return ChannelProcess(channel)
+
+    def agent(self, name: tuple, start: Callable[[], "AgentClient"]) -> "AgentClient":
+        """The agent `name` on our pooled connection, started by start() if need be."""
+        self._connect()
+        return self.pool.agent(self.host, self.port, self.username, name, start)
+
+class Drain:
+    """
+    Reads a stream to its end on a thread, so whatever's writing it never
+    blocks on a full pipe (or SSH channel window) while we're busy with
+    another stream. Keeps the last `keep` bytes.
+    """
+    def __init__(self, stream, keep: int = 1 << 16):
+        self.keep = keep
+        self.data = bytearray()
+        self.thread = threading.Thread(target=self._read, args=(stream,), daemon=True)
+        self.thread.start()
+
+    def _read(self, stream):
+        for chunk in iter(lambda: stream.read(1 << 16), b""):
+            self.data += chunk
+            del self.data[:-self.keep]
+
+    def text(self) -> str:
+        "Everything (kept) once the stream has ended."
+        self.thread.join()
+        return self.data.decode(errors="replace").strip()
+
+class ChannelProcess:
+    """
+    The bits of subprocess.Popen's interface we need, for a paramiko exec
+    channel. Like Popen's, the streams are binary.
+    """
+    def __init__(self, channel: paramiko.Channel):
+        self.channel = channel
+        self.stdin = channel.makefile_stdin("wb")
+        self.stdout = channel.makefile("rb")
+        self.stderr = channel.makefile_stderr("rb")
+
+    def wait(self) -> int:
+        return self.channel.recv_exit_status()
+
 class LocalHostConduit:
     """
     A conduit for localhost. Rather than transferring and executing via SSH/SCP,
     we do the local analogs.
     """
-    def transfer(self, archive: str, executable: str, exec_dir: str):
-        self.exec_command(f"mkdir -p {exec_dir}")
-        shutil.copy(archive, exec_dir)
-        shutil.copy(executable, exec_dir)
+    # The agents we've started, by name. With no connection to go with, they
+    # last until we exit and their stdin closes.
+    agents: Dict[tuple, "AgentClient"] = {}
+    agents_lock = threading.Lock()
+
+    def put(self, local_path: str, remote_path: str):
+        shutil.copyfile(local_path, remote_path)
 
     def exec_command(self, cmd: str):
         proc = subprocess.run(cmd, check=True, shell=True,
                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
         return proc.stdout.decode().strip()
 
+    def relay_address(self, path: str) -> str:
+        return path
+
+    def close(self):
+        pass
+
+    def popen(self, cmd: str) -> subprocess.Popen:
+        return subprocess.Popen(cmd, shell=True, stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    def agent(self, name: tuple, start: Callable[[], "AgentClient"]) -> "AgentClient":
+        with self.agents_lock:
+            agent = self.agents.get(name)
+            if agent is None or agent.closed:
+                agent = self.agents[name] = start()
+            return agent
+
+class BootstrapResult(NamedTuple):
+    status: str
+    uploaded: List[Artifact]
+    first_response: float
+
+def log_query_options(query: dict) -> List[str]:
+    "The `cattle_remote log` options for a query given as cattle_remote.query_log's keyword arguments."
+    options = []
+    for flag, span in (("--bytes", query.get("byte_range")), ("--lines", query.get("line_range"))):
+        if span is not None:
+            start, end = span
+            options += [flag, f"{start}:{'' if end is None else end}"]
+    for flag, value in (("--level", query.get("level")), ("--tail", query.get("tail"))):
+        if value is not None:
+            options += [flag, str(value)]
+    options += [a for step in query.get("steps", ()) for a in ("--step", str(step))]
+    options += [a for pattern in query.get("patterns", ()) for a in ("--grep", pattern)]
+    if query.get("ignore_case"):
+        options.append("--ignore-case")
+    return options
+
 class HostRunner:
     """
     HostRunner handles all remote host communication: transferring files, running
     the remote cattle module, peeking at statuses, etc.
     """
-    def __init__(self, execution_id: str, exec_dir: str, hostdesc: str, conduit: Union[RemoteHostConduit, LocalHostConduit]):
+    def __init__(self, execution_id: str, run_root: str, hostdesc: str, conduit: Union[RemoteHostConduit, LocalHostConduit],
+                 agent_runtime: Optional[Artifact] = None):
+        """
+        Given an `agent_runtime`, status, log queries, trace, clean, watch
+        and execute go through a `cattle_remote agent` run from it. The agent
+        belongs to the conduit's connection rather than to us, so the
+        runners of later commands reuse it.
+        """
         self.execution_id = execution_id
-        self.exec_dir = exec_dir
+        self.run_root = run_root
+        self.exec_dir = os.path.join(run_root, execution_id)
+        self.store_dir = os.path.join(run_root, STORE_DIRNAME)
         self.hostdesc = hostdesc
         self.conduit = conduit
+        self.agent_runtime = agent_runtime
+        self.agent = None
+        # What map_runners' adaptive concurrency goes by: the first round
+        # trip's latency, how many bytes we've sent in how long, and whether
+        # the operation failed on this host (for operations that carry on
+        # past a failing host rather than raise).
+        self.first_response: Optional[float] = None
+        self.bytes_sent = 0
+        self.send_s = 0.0
+        self.failed = False
+
+    def _sent(self, size: int, started: float):
+        self.bytes_sent += size
+        self.send_s += time.monotonic() - started
+
+    def _responded(self, started: float):
+        if self.first_response is None:
+            self.first_response = time.monotonic() - started
 
-    def transfer(self, archive, executable):
-        self.conduit.transfer(archive, executable, self.exec_dir)
+    def _round_trip(self, cmd: str) -> str:
+        "Run a quick command on the host, timing it if it's our first."
+        started = time.monotonic()
+        out = self.conduit.exec_command(cmd)
+        self._responded(started)
+        return out
 
-    def execute(self, archive, executable):
-        archive_filename = os.path.basename(archive)
-        executable_filename = os.path.basename(executable)
+    def transfer(self, artifacts: List[Artifact], link=True) -> List[Artifact]:
+        """
+        Make the artifacts available in the execution dir (or, without `link`,
+        just in the store), uploading only the ones missing from the host's
+        artifact store. Returns the uploaded ones.
+        """
+        store = shlex.quote(self.store_dir)
+        probes = " ".join(
+            f"test -f {store}/{a.digest} || echo {a.digest};" for a in artifacts
+        )
+        dirs = f"{shlex.quote(self.exec_dir)} {store}" if link else store
+        started = time.monotonic()
+        missing = self.conduit.exec_command(f"mkdir -p {dirs} && {probes}").split()
+        self._responded(started)
+
+        uploaded = [a for a in artifacts if a.digest in missing]
+        for a in uploaded:
+            started = time.monotonic()
+            self.conduit.put(a.path, os.path.join(self.store_dir, f"{a.digest}.partial"))
+            self._sent(os.path.getsize(a.path), started)
+
+        if uploaded or link:
+            specs = " ".join(
+                f"{a.digest}:{a.name}:{int(a in uploaded)}" for a in artifacts
+            )
+            self.conduit.exec_command(
+                f"python3 -c {shlex.quote(cattle_remote.ADMIT_SCRIPT)} "
+                f"{store} {shlex.quote(self.exec_dir) if link else '-'} {specs}"
+            )
+        return uploaded
+
+    def _agent(self) -> "AgentClient":
+        "This host's agent for our run root, started (from the store) if it isn't running yet."
+        if self.agent is None or self.agent.closed:
+            self.agent = self.conduit.agent((self.run_root, self.agent_runtime.digest), self._start_agent)
+        return self.agent
+
+    def _start_agent(self) -> "AgentClient":
+        self.transfer([self.agent_runtime], link=False)
+        runtime = os.path.join(self.store_dir, self.agent_runtime.digest)
+        return AgentClient(self.conduit.popen(
+            f"nohup python3 {shlex.quote(runtime)} agent --run-root {shlex.quote(self.run_root)}"
+        ))
+
+    def execute(self, archive: Optional[Artifact], executable: Artifact, detach=False) -> str:
+        """
+        Unpack the archive and run the config. With no archive, the config
+        must already be unpacked in the execution dir. A detached run returns
+        as soon as the remote runner has daemonized, with its pid.
+        """
+        if self.agent_runtime is not None:
+            return self._agent().call(
+                "exec", exec_dir=self.exec_dir, runtime=executable.name,
+                archive=archive and archive.name, sha256=archive and archive.digest, detach=detach,
+            )
+        init = (
+            f"python3 '{executable.name}' init '{archive.name}' --sha256 {archive.digest} && "
+            if archive is not None else ""
+        )
+        return self._run_config(init, detach=detach)
+
+    def init(self, archive: Artifact, executable: Artifact):
+        "Unpack the config archive in the execution dir, without running it."
+        self.conduit.exec_command(
+            f"cd {shlex.quote(self.exec_dir)} && "
+            f"python3 {executable.name} init {archive.name} --sha256 {archive.digest}"
+        )
+
+    def base_config(self, executable: Artifact, config_files: Dict[str, dict]) -> dict:
+        """
+        Describe the host's latest unpacked config, as a base for a delta of
+        the config with the given manifest files: its manifest, and block
+        signatures of the files the config changes.
+        """
+        signatures = f"cd {shlex.quote(self.exec_dir)} && python3 {executable.name} signatures {shlex.quote(self.run_root)}"
+        base = json.loads(self.conduit.exec_command(signatures))
+        if base["base"] is None:
+            return base
+        have = {entry["sha256"] for entry in base["manifest"].values()}
+        changed = [
+            p for p, entry in config_files.items()
+            if entry["sha256"] not in have and p in base["manifest"] and entry["size"] <= DELTA_MAX_DIFF_SIZE
+        ]
+        if changed:
+            paths = " ".join(f"--path {shlex.quote(p)}" for p in changed)
+            base["files"] = json.loads(self.conduit.exec_command(
+                f"{signatures} --base {shlex.quote(base['base'])} {paths}"
+            ))["files"]
+        return base
+
+    def patch(self, delta: Artifact, executable: Artifact):
+        "Unpack a delta archive (already in the execution dir) against its base."
+        self.conduit.exec_command(
+            f"cd {shlex.quote(self.exec_dir)} && "
+            f"python3 {executable.name} patch {delta.name} --sha256 {delta.digest}"
+        )
+
+    def check(self, executable: Artifact, mark_done=False) -> str:
+        """
+        The unpacked config's check vector: which steps would run here. See
+        cattle_remote.check_config.
+        """
+        if self.agent_runtime is not None:
+            return self._agent().call("check", exec_dir=self.exec_dir, runtime=executable.name, mark_done=mark_done)
+        return self.conduit.exec_command(
+            f"cd {shlex.quote(self.exec_dir)} && "
+            f"python3 {executable.name} check {shlex.quote(os.path.join(self.exec_dir, 'config'))}"
+            f"{' --mark-done' if mark_done else ''}"
+        )
+
+    def resume(self, detach=False) -> str:
+        """
+        Rerun a stopped execution, skipping the steps its journal shows
+        already completed.
+        """
+        if self.agent_runtime is not None:
+            return self._agent().call(
+                "exec", exec_dir=self.exec_dir, runtime=RUNTIME_NAME, detach=detach, resume=True,
+            )
+        return self._run_config("", detach=detach, resume=True)
+
+    def _run_config(self, init: str, detach=False, resume=False) -> str:
         config_filename = os.path.join(self.exec_dir, "config")
         script = (
             "set -euxo pipefail && "
             f"cd '{self.exec_dir}' && "
-            f"python3 '{executable_filename}' init '{archive_filename}' && "
-            f"python3 '{executable_filename}' exec '{config_filename}'"
+            f"{init}"
+            f"python3 '{RUNTIME_NAME}' exec '{config_filename}'"
+            f"{' --detach' if detach else ''}"
+            f"{' --resume' if resume else ''}"
         )
-        self.conduit.exec_command(f"nohup bash -c \"{script}\"")
+        return self.conduit.exec_command(f"nohup bash -c \"{script}\"")
+
+    def stream_config(self, cfg_dir: str, entries, manifest: bytes, executable: Artifact, codec: str = "gz") -> str:
+        """
+        Build the config archive straight into a remote streaming init, with no
+        file on either end. The runtime must already be in the execution dir.
+        The archive's digest follows it, and the host only moves the unpacked
+        config into place if that matches what arrived. Returns the digest.
+        """
+        proc = self.conduit.popen(
+            f"cd {shlex.quote(self.exec_dir)} && python3 {executable.name} init - --codec {codec}"
+        )
+        stderr = Drain(proc.stderr)
+        framed = ChunkedWriter(proc.stdin)
+        writer = HashingWriter(framed)
+        started = time.monotonic()
+        try:
+            write_archive(cfg_dir, writer, entries, manifest, codec)
+            framed.finish(writer.hash.hexdigest())
+            proc.stdin.close()
+            self._sent(writer.written, started)
+            received = proc.stdout.read().decode().strip()
+        finally:
+            # (Make sure the far end isn't left waiting on us.)
+            proc.stdin.close()
+            exit_code = proc.wait()
+        sent = writer.hash.hexdigest()
+        if exit_code != 0 or received != sent:
+            raise Exception(
+                f"Streaming init failed with code {exit_code}: sent {sent}, host received {received}: "
+                f"stderr={stderr.text()}"
+            )
+        return sent
+
+    def bootstrap(self, archive: Artifact, executable: Artifact, detach=False) -> BootstrapResult:
+        """
+        Transfer, init, exec and read the status over a single channel. See
+        cattle_bootstrap for the protocol.
+        """
+        started = time.monotonic()
+        proc = self.conduit.popen(
+            f"nohup python3 -c {shlex.quote(BOOTSTRAP_SCRIPT)} "
+            f"{shlex.quote(self.store_dir)} {shlex.quote(self.exec_dir)} "
+            f"{archive.name}:{archive.digest} {executable.name}:{executable.digest}"
+            f"{' --detach' if detach else ''}"
+        )
+        # (The runtime's output goes to stderr, and can be plenty.)
+        stderr = Drain(proc.stderr)
+        try:
+            need = proc.stdout.readline().decode().split()
+            first_response = time.monotonic() - started
+            if self.first_response is None:
+                self.first_response = first_response
+            if not need or need[0] != "NEED":
+                raise Exception(f"unexpected bootstrap response: {need}")
+            uploaded = [a for a in (archive, executable) if a.digest in need[1:]]
+            for a in uploaded:
+                started = time.monotonic()
+                proc.stdin.write(f"{os.path.getsize(a.path)}\n".encode())
+                with open(a.path, "rb") as f:
+                    shutil.copyfileobj(f, proc.stdin, 1 << 20)
+                self._sent(os.path.getsize(a.path), started)
+            proc.stdin.close()
+            reply = proc.stdout.read().decode().split()
+        finally:
+            proc.stdin.close()
+            exit_code = proc.wait()
+        if exit_code != 0 or len(reply) < 2 or reply[0] != "STATUS":
+            raise Exception(f"Bootstrap failed with code {exit_code}: reply={reply} stderr={stderr.text()}")
+        return BootstrapResult(reply[1], uploaded, first_response)
+
+    def relay(self, executable: Artifact, artifacts: List[Artifact], peers: List["HostRunner"], fanout: int):
+        """
+        Have this host forward the artifacts (already in its store) on to the
+        peers' stores.
+        """
+        argv = [
+            "python3", os.path.join(self.store_dir, executable.digest), "relay",
+            "--store", self.store_dir, "--runtime", executable.digest, "--fanout", str(fanout),
+        ]
+        argv += [a for art in artifacts for a in ("--digest", art.digest)]
+        argv += [a for p in peers for a in ("--peer", p.conduit.relay_address(p.store_dir))]
+        self.conduit.exec_command(" ".join(shlex.quote(a) for a in argv))
+
+    def close(self):
+        # (The agent stays with the connection, for the next command.)
+        self.agent = None
+        self.conduit.close()
+
+    def watch(self, on_change, deadline: Optional[float] = None) -> str:
+        """
+        Follow the execution's "<status> <step>" state with the remote
+        long-poll, calling on_change(state) as it moves, until it's terminal or
+        the (monotonic) deadline passes. Returns the last state seen.
+        """
+        runtime = os.path.join(self.exec_dir, RUNTIME_NAME)
+        state = ""
+        while True:
+            timeout = LONG_POLL_TIMEOUT
+            if deadline is not None:
+                timeout = max(0, min(timeout, deadline - time.monotonic()))
+            if self.agent_runtime is not None:
+                polled = self._agent().call("poll", exec_dir=self.exec_dir, since=state, timeout=timeout)
+                if polled != state:
+                    state = polled
+                    on_change(state)
+                if state.split(" ", 1)[0] in cattle_remote.TERMINAL_STATUSES:
+                    return state
+                if deadline is not None and time.monotonic() >= deadline:
+                    return state
+                continue
+            proc = self.conduit.popen(
+                f"python3 {shlex.quote(runtime)} poll {shlex.quote(self.exec_dir)} "
+                f"--since {shlex.quote(state)} --timeout {timeout}"
+            )
+            proc.stdin.close()
+            for line in proc.stdout:
+                state = line.decode().strip()
+                on_change(state)
+            exit_code = proc.wait()
+            if exit_code != 0:
+                raise Exception(
+                    f"poll failed with code {exit_code}: stderr={proc.stderr.read().decode()}"
+                )
+            if state.split(" ", 1)[0] in cattle_remote.TERMINAL_STATUSES:
+                return state
+            if deadline is not None and time.monotonic() >= deadline:
+                return state
 
     def status(self):
+        if self.agent_runtime is not None:
+            return self._agent().call("status", exec_dir=self.exec_dir)["status"]
         exec_status = os.path.join(self.exec_dir, "STATUS")
-        return self.conduit.exec_command(f"cat {exec_status} || echo 'UNKNOWN'")
+        pid_file = os.path.join(self.exec_dir, cattle_remote.PID_FILE)
+        # A run that's PROGRESS without a live pid has died. (As in
+        # read_state, a pid we may not signal is still alive: kill -0 fails
+        # then too, so check /proc or ps for it.)
+        return self._round_trip(
+            f"s=$(cat {exec_status} || echo 'UNKNOWN'); "
+            f"if [ \"$s\" = {cattle_remote.STATUS_PROGRESS} ]; then "
+            f"p=$(cat {pid_file} 2>/dev/null); "
+            f"if [ -z \"$p\" ] || {{ ! kill -0 $p 2>/dev/null && [ ! -d /proc/$p ] && ! ps -p $p >/dev/null 2>&1; }}; "
+            f"then s={cattle_remote.STATUS_DIED}; fi; fi; "
+            f"echo $s"
+        )
 
     def clean(self):
         assert self.exec_dir is not None and self.exec_dir != "/", "exec_dir should not be empty or dangerous-looking"
-        self.conduit.exec_command(f"rm -rf {self.exec_dir}")
+        if self.agent_runtime is not None:
+            self._agent().call("clean", exec_dir=self.exec_dir)
+            return
+        self._round_trip(f"rm -rf {self.exec_dir}")
+
+    def trace(self) -> List[dict]:
+        "The execution's per-step trace records."
+        if self.agent_runtime is not None:
+            return self._agent().call("trace", exec_dir=self.exec_dir)
+        exec_trace = os.path.join(self.exec_dir, cattle_remote.TRACE_FILE)
+        out = self._round_trip(f"cat {exec_trace} 2>/dev/null || true")
+        return cattle_remote.parse_trace(out.splitlines())
+
+    def query_log(self, query: dict, write: Callable[[bytes], None]) -> int:
+        """
+        Run a log query (cattle_remote.query_log's keyword arguments) on the
+        host, calling write() with each line it selects as it arrives. The
+        lines travel gzipped, or from an agent a chunk at a time. Returns how
+        many there were.
+        """
+        if self.agent_runtime is not None:
+            return self._agent_query_log(query, write)
+        argv = [
+            "python3", os.path.join(self.exec_dir, RUNTIME_NAME), "log", self.exec_dir, "--codec", "gz",
+        ] + log_query_options(query)
+        started = time.monotonic()
+        proc = self.conduit.popen(" ".join(shlex.quote(a) for a in argv))
+        proc.stdin.close()
+        stderr = Drain(proc.stderr)
+        n = 0
+        for line in cattle_remote.decompressing(proc.stdout, "gz"):
+            self._responded(started)
+            write(line)
+            n += 1
+        self._responded(started)
+        err = stderr.text()
+        exit_code = proc.wait()
+        if exit_code != 0:
+            raise Exception(f"log query failed with code {exit_code}: {err}")
+        return n
+
+    def _agent_query_log(self, query: dict, write: Callable[[bytes], None]) -> int:
+        n = 0
+        started = time.monotonic()
+        while True:
+            reply = self._agent().call("log", exec_dir=self.exec_dir, query=query, skip=n)
+            self._responded(started)
+            for line in reply["lines"]:
+                write(line.encode("latin-1"))
+            n += len(reply["lines"])
+            if not reply["more"]:
+                return n
+
+class AgentClient:
+    """
+    The orchestrator's end of a `cattle_remote agent` channel. Calls are
+    tagged with ids and a reader thread matches up the replies, so any
+    number of threads can have calls outstanding on the one channel.
+    """
+    def __init__(self, proc):
+        self.proc = proc
+        self.lock = threading.Lock()
+        self.pending: Dict[int, concurrent.futures.Future] = {}
+        self.ids = itertools.count(1)
+        self.closed = False
+        self.reader = threading.Thread(target=self._read_replies, daemon=True)
+        self.reader.start()
+
+    def _read_replies(self):
+        try:
+            while True:
+                reply = cattle_remote.read_frame(self.proc.stdout)
+                if reply is None:
+                    break
+                with self.lock:
+                    future = self.pending.pop(reply["id"])
+                if reply["ok"]:
+                    future.set_result(reply["result"])
+                else:
+                    future.set_exception(Exception(f"agent: {reply['error']}"))
+        except Exception as e:
+            error = e
+        else:
+            error = Exception("agent exited")
+        with self.lock:
+            self.closed = True
+            pending, self.pending = self.pending, {}
+        for future in pending.values():
+            future.set_exception(error)
+
+    def call(self, op: str, **params):
+        "Send a request and wait for its result, raising the agent's error if it failed."
+        future = concurrent.futures.Future()
+        with self.lock:
+            if self.closed:
+                raise Exception("agent connection is closed")
+            i = next(self.ids)
+            self.pending[i] = future
+            cattle_remote.write_frame(self.proc.stdin, dict(params, id=i, op=op))
+        return future.result()
+
+    def close(self):
+        self.proc.stdin.close()
+        self.proc.wait()
+        self.reader.join()
+
+# Longest a single remote long-poll runs before it's reissued.
+LONG_POLL_TIMEOUT = 60
+
+# Default cap on how many hosts a fleet operation works on at once. Each
+# host in flight has a thread of its own, since our conduits block.
+DEFAULT_MAX_IN_FLIGHT = 64
+
+# ...and on how many a wait watches at once. A long poll mostly sits idle on
+# the host, so this is more about threads and open channels than load.
+DEFAULT_MAX_WATCHING = 1024
+
+class AdaptiveConcurrency:
+    """
+    How many hosts to have in flight, adjusted AIMD-style as hosts finish.
+    The limit creeps up by one per limit's worth of healthy hosts, and is
+    cut by `decrease` when a host fails, when its first round trip takes
+    more than `tolerance` times the quickest seen (the far ends, or our
+    link, are queueing), or when its send throughput falls below 1/tolerance
+    of the best seen (our uplink is shared too thinly). It's cut at most
+    once per limit's worth of finished hosts, so one bad patch costs one cut.
+
+    Round trips within `slack` seconds of the quickest are never slow, and
+    only hosts sent at least `min_sample` bytes say anything about
+    throughput: short timings are mostly noise.
+    """
+    def __init__(self, ceiling: int, initial: int = 4, tolerance: float = 2.0, decrease: float = 0.5,
+                 slack: float = 0.05, min_sample: int = 1 << 20, verbose=False):
+        self.ceiling = ceiling
+        self.limit = float(min(initial, ceiling))
+        self.tolerance = tolerance
+        self.decrease = decrease
+        self.slack = slack
+        self.min_sample = min_sample
+        self.verbose = verbose
+        self.lock = threading.Lock()
+        self.best_latency: Optional[float] = None
+        self.best_throughput: Optional[float] = None
+        # Hosts finished since the last cut. (As if long ago, at first.)
+        self.since_cut = ceiling
+        # (limit, reason) each time the whole number of hosts allowed changed.
+        self.decisions: List[Tuple[int, str]] = []
 
-    def log(self):
-        exec_log = os.path.join(self.exec_dir, "exec.log")
-        return self.conduit.exec_command(f"cat {exec_log} || echo '<not found>'")
+    def allowed(self) -> int:
+        with self.lock:
+            return int(self.limit)
 
-def map_runners(fn, runners):
-    """Call `fn` with each of the given runners in a thread pool."""
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        future_map = {executor.submit(fn, r): r for r in runners}
-        for future in concurrent.futures.as_completed(future_map):
-            future.result()
+    def record(self, ok: bool, latency: Optional[float] = None, bytes_sent: int = 0, send_s: float = 0):
+        "Account for a finished host: whether it succeeded, and what we saw of its link."
+        throughput = bytes_sent / send_s if bytes_sent >= self.min_sample and send_s > 0 else None
+        with self.lock:
+            reason = None
+            if not ok:
+                reason = "host failed"
+            elif latency is not None and self.best_latency is not None \
+                    and latency > max(self.tolerance * self.best_latency, self.best_latency + self.slack):
+                reason = f"round trip {latency * 1000:.0f}ms vs best {self.best_latency * 1000:.0f}ms"
+            elif throughput is not None and self.best_throughput is not None \
+                    and throughput * self.tolerance < self.best_throughput:
+                reason = f"throughput {throughput / 1e6:.2f}MB/s vs best {self.best_throughput / 1e6:.2f}MB/s"
+            if latency is not None:
+                self.best_latency = latency if self.best_latency is None else min(self.best_latency, latency)
+            if throughput is not None:
+                self.best_throughput = throughput if self.best_throughput is None else max(self.best_throughput, throughput)
+
+            before = int(self.limit)
+            self.since_cut += 1
+            if reason is None:
+                self.limit = min(self.ceiling, self.limit + 1 / self.limit)
+                reason = "healthy"
+            elif self.since_cut >= self.limit:
+                self.limit = max(1.0, self.limit * self.decrease)
+                self.since_cut = 0
+            if int(self.limit) != before:
+                self.decisions.append((int(self.limit), reason))
+                if self.verbose:
+                    print(f"concurrency: {before} -> {int(self.limit)} hosts in flight ({reason})")
+
+def map_runners(fn, runners, max_in_flight=DEFAULT_MAX_IN_FLIGHT, adaptive: Optional[AdaptiveConcurrency] = None):
+    """
+    Call `fn` with each of the given runners on a pool of worker threads (our
+    conduits block), with at most `max_in_flight` hosts in flight at once
+    or, given an AdaptiveConcurrency, as many as it allows (up to
+    max_in_flight). Hosts finish in completion order and each runner's
+    connection is released as soon as it's done. The first error is
+    re-raised once every host has been attempted.
+    """
+    runners = iter(runners)
+    first_error = None
+    in_flight = set()
+
+    def run_and_close(runner):
+        ok = False
+        try:
+            result = fn(runner)
+            ok = True
+            return result
+        finally:
+            _record_host(adaptive, runner, ok)
+            runner.close()
+
+    def launch():
+        limit = max_in_flight if adaptive is None else min(max_in_flight, adaptive.allowed())
+        for runner in itertools.islice(runners, max(0, limit - len(in_flight))):
+            in_flight.add(executor.submit(run_and_close, runner))
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        launch()
+        while in_flight:
+            done, in_flight = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is not None and first_error is None:
+                    first_error = future.exception()
+            launch()
+
+    if first_error is not None:
+        raise first_error
+
+def _record_host(adaptive: Optional[AdaptiveConcurrency], runner, ok: bool):
+    if adaptive is None:
+        return
+    adaptive.record(
+        ok and not getattr(runner, "failed", False), getattr(runner, "first_response", None),
+        getattr(runner, "bytes_sent", 0), getattr(runner, "send_s", 0),
+    )
+
+def fan_out_artifacts(runners, executable: Artifact, artifacts: List[Artifact], fanout: int,
+                      max_in_flight=DEFAULT_MAX_IN_FLIGHT, verbose=False):
+    """
+    Seed the first `fanout` hosts' stores from here and have them relay the
+    artifacts through a tree to everyone else, so our uplink carries the
+    artifacts `fanout` times rather than once per host. Relayed copies are
+    digest-checked on arrival like ours. If a relay fails, its subtree is
+    left to the per-host transfer that follows, which uploads whatever's
+    missing directly.
+    """
+    runners = list(runners)
+    seeds, peers = runners[:fanout], runners[fanout:]
+    assignments = {seed: peers[i::len(seeds)] for i, seed in enumerate(seeds)}
+
+    def seed_and_relay(seed):
+        seed.transfer(artifacts)
+        if assignments[seed]:
+            try:
+                seed.relay(executable, artifacts, assignments[seed], fanout)
+            except Exception as e:
+                print(f"Host {seed.hostdesc}: relay failed, so its {len(assignments[seed])} hosts will be sent "
+                      f"to directly: {e}", file=sys.stderr)
+                return
+        if verbose:
+            print(f"Host {seed.hostdesc}: relayed artifacts to {len(assignments[seed])} hosts.")
+
+    map_runners(seed_and_relay, seeds, max_in_flight)
+
+class FleetProgress:
+    """Each host's last known execution state, with optional live rendering."""
+    def __init__(self, runners, live: bool):
+        self.states = {r.hostdesc: "UNKNOWN -" for r in runners}
+        self.live = live
+        self.lock = threading.Lock()
+
+    def update(self, hostdesc: str, state: str):
+        with self.lock:
+            self.states[hostdesc] = state
+            if self.live:
+                status, step = state.split(" ", 1)
+                print(f"Host {hostdesc}: {status} (step {step})  [{self.summary()}]")
+
+    def statuses(self) -> Dict[str, str]:
+        return {h: state.split(" ", 1)[0] for h, state in self.states.items()}
+
+    def summary(self) -> str:
+        counts = {}
+        for status in self.statuses().values():
+            counts[status] = counts.get(status, 0) + 1
+        return ", ".join(f"{n} {status}" for status, n in sorted(counts.items()))
+
+def percentile(values: List[float], p: float) -> float:
+    "Nearest-rank percentile of a non-empty list."
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(len(ordered) * p / 100) - 1)]
+
+def positive_int(spec: str) -> int:
+    "An argparse type: a whole number, at least 1."
+    n = int(spec)
+    if n < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, not {n}")
+    return n
 
 class ExecResult(NamedTuple):
     exit_code: int
@@ -171,15 +1610,40 @@ def main_args(argv) -> int:
     "Executes the given args list and returns the exit code."
     return main_args_inner(argv).exit_code
 
-def main_args_inner(argv) -> ExecResult:
-    "Like main_args but returns a slightly richer result."
+def main_args_inner(argv, conduit_factory: Optional[Callable[[str], Union[RemoteHostConduit, LocalHostConduit]]] = None
+                    ) -> ExecResult:
+    """
+    Like main_args but returns a slightly richer result. Given a
+    `conduit_factory`, remote hosts are reached through the conduit it returns
+    for each host name, rather than over SSH. (The benchmarks simulate a
+    fleet this way.)
+    """
     common_parser = argparse.ArgumentParser(add_help=False)
     common_parser.add_argument("-l", "--local", action="store_true")
     common_parser.add_argument("-ho", "--host", dest="hosts", action="append")
-    common_parser.add_argument("-p", "--port", type=int, default=22)
+    common_parser.add_argument("-p", "--port", type=int,
+                               help=f"ssh port. (default: the execution's, from the registry, or {DEFAULT_PORT})")
     common_parser.add_argument("-u", "--username", action="store")
-    common_parser.add_argument("-rr", "--run-root", action="store", type=str, default="/var/run/cattle",
-                               help="allows overriding where the Cattle run dir will be rooted on the target filesystem. (default /var/run/cattle)")
+    common_parser.add_argument("-rr", "--run-root", action="store", type=str,
+                               help="allows overriding where the Cattle run dir will be rooted on the target filesystem. "
+                                    f"(default: the execution's, from the registry, or {DEFAULT_RUN_ROOT})")
+    common_parser.add_argument("-v", "--verbose", action="store_true")
+
+    # How the subcommands that work through the fleet pace it. (wait and
+    # watch instead long-poll every host at once: see --max-watching.)
+    pacing_parser = argparse.ArgumentParser(add_help=False)
+    pacing_parser.add_argument("--max-in-flight", type=positive_int, default=DEFAULT_MAX_IN_FLIGHT,
+                               help=f"most hosts to work on at once. (default {DEFAULT_MAX_IN_FLIGHT})")
+    pacing_parser.add_argument("--adaptive", action="store_true",
+                               help="adjust how many hosts are in flight as they finish, up to --max-in-flight, "
+                                    "backing off on failures, slow round trips and falling throughput")
+
+    # For the subcommands that query executions. (An agent lasts as long as
+    # the connection it's on, so later queries in the process reuse it.)
+    agent_parser = argparse.ArgumentParser(add_help=False)
+    agent_parser.add_argument("--agent", action="store_true",
+                              help="talk to each host through one long-lived cattle agent rather than a shell "
+                                   "per operation")
 
     parser = argparse.ArgumentParser(
         prog="cattle",
@@ -189,72 +1653,299 @@ def main_args_inner(argv) -> ExecResult:
     parser_exec = subparsers.add_parser(
         "exec",
         help="Execute a Cattle config.",
-        parents=[common_parser],
+        parents=[common_parser, pacing_parser],
     )
     parser_exec.set_defaults(func=run_exec_config)
     parser_exec.add_argument("config_dir")
     parser_exec.add_argument("-m", "--config-module", default="__cattle__",
                             help="name of the config module. defaults to __cattle__.")
-    parser_exec.add_argument("-v", "--verbose", action="store_true")
+    parser_exec.add_argument("-t", "--transfer", choices=["scp", "pipeline", "stream", "delta"], default="scp",
+                            help="how artifacts get to the hosts. 'pipeline' transfers, runs and "
+                                 "reports status over a single SSH channel. 'stream' compresses the "
+                                 "config straight into the remote unpacker without temp files, once "
+                                 "per host. 'delta' sends only what changed since the host's latest "
+                                 "execution. (default scp)")
+    parser_exec.add_argument("-c", "--codec", choices=["auto"] + list(CODEC_SUFFIXES), default="auto",
+                            help="how to compress the config. 'auto' weighs compression time here against "
+                                 "transfer time at --link-mbps, by trying the codecs on a sample (of the delta, "
+                                 "with --transfer delta). (default auto)")
+    parser_exec.add_argument("--link-mbps", type=float, default=100,
+                            help="the hosts' estimated link speed, for choosing a codec. (default 100)")
+    parser_exec.add_argument("-f", "--fanout", type=int, default=0,
+                            help="distribute artifacts through a tree of hosts, each sending to this many "
+                                 "others, instead of uploading to every host from here. hosts need "
+                                 "key-based ssh access to each other. (default 0: off)")
     parser_exec.add_argument("-d", "--dry-run",
                             help="if set, prints the hypothetical rather than running anything",
                             action="store_true")
+    parser_exec.add_argument("-D", "--detach", action="store_true",
+                            help="return as soon as each host's run has started rather than waiting "
+                                 "for it to finish. check on it later with `cattle status`.")
+    parser_exec.add_argument("--if-drifted", action="store_true",
+                            help="only run on hosts where some step's should_run says it has work to do. "
+                                 "(not with --transfer pipeline)")
+
+    parser_check = subparsers.add_parser(
+        "check",
+        help="Find which steps of a config would run on each host, without running any, "
+             "and group the hosts by the answer.",
+        parents=[common_parser, pacing_parser],
+    )
+    parser_check.set_defaults(func=run_check)
+    parser_check.add_argument("config_dir")
+    parser_check.add_argument("-m", "--config-module", default="__cattle__",
+                              help="name of the config module. defaults to __cattle__.")
 
     parser_status = subparsers.add_parser(
         "status",
         help="Enquire about the remote status of an execution.",
-        parents=[common_parser],
+        parents=[common_parser, pacing_parser, agent_parser],
     )
     parser_status.set_defaults(func=run_status)
     parser_status.add_argument("execution_id")
+    parser_status.add_argument("--refresh", action="store_true",
+                               help="ask every host, even those the registry already knows have finished")
+
+    parser_list = subparsers.add_parser(
+        "list",
+        help="List recent executions from the local registry.",
+    )
+    parser_list.set_defaults(func=run_list)
+    parser_list.add_argument("-n", "--limit", type=int, default=20,
+                             help="how many executions to list, newest first. (default 20)")
 
     parser_clean = subparsers.add_parser(
         "clean",
         help="Clean remote resources associated with an execution.",
-        parents=[common_parser],
+        parents=[common_parser, pacing_parser, agent_parser],
     )
     parser_clean.set_defaults(func=run_clean)
-    parser_clean.add_argument("execution_id")
+    parser_clean.add_argument("execution_id", nargs="?")
+    parser_clean.add_argument("--finished", action="store_true",
+                              help="instead of one execution, clean every registered execution that has "
+                                   "finished successfully (DONE) on all its hosts. failed ones are left to "
+                                   "look into, and clean by ID.")
 
     parser_log = subparsers.add_parser(
         "log",
         help="View remote logs for an execution.",
-        parents=[common_parser],
+        parents=[common_parser, pacing_parser, agent_parser],
     )
     parser_log.set_defaults(func=run_log)
     parser_log.add_argument("execution_id")
+    parser_log.add_argument("--bytes", type=cattle_remote.parse_range, help="only look at this START:END byte range of each log (from 0, END excluded)")
+    parser_log.add_argument("--lines", type=cattle_remote.parse_range, help="only look at this START:END range of lines (from 0, END excluded), counted from the start of --bytes if given")
+    parser_log.add_argument("--tail", type=int, help="only the last TAIL lines selected, per host")
+    parser_log.add_argument("--level", choices=list(cattle_remote.LOG_LEVELS),
+                            help="only lines of records at this level or above")
+    parser_log.add_argument("--step", dest="steps", type=int, action="append", default=[],
+                            help="only lines logged by this step. may be repeated.")
+    parser_log.add_argument("-e", "--grep", dest="patterns", action="append", default=[],
+                            help="only lines matching this regular expression. may be repeated (any may match).")
+    parser_log.add_argument("-i", "--ignore-case", action="store_true")
+    parser_log.add_argument("-o", "--output-dir",
+                            help="write each host's lines to <host>.log here, rather than to stdout")
+
+    for name, live, help_text in (
+        ("wait", False, "Wait for an execution to finish on every host."),
+        ("watch", True, "Follow an execution's progress on every host until it finishes."),
+    ):
+        parser_wait = subparsers.add_parser(name, help=help_text, parents=[common_parser, agent_parser])
+        parser_wait.set_defaults(func=run_wait, live=live)
+        parser_wait.add_argument("execution_id")
+        parser_wait.add_argument("-t", "--timeout", type=float,
+                                 help="give up after this many seconds. (default: wait indefinitely)")
+        parser_wait.add_argument("--max-watching", type=positive_int, default=DEFAULT_MAX_WATCHING,
+                                 help=f"most hosts to watch at once. (default {DEFAULT_MAX_WATCHING})")
+
+    parser_resume = subparsers.add_parser(
+        "resume",
+        help="Rerun a failed execution from the step where it stopped.",
+        parents=[common_parser, pacing_parser],
+    )
+    parser_resume.set_defaults(func=run_resume)
+    parser_resume.add_argument("execution_id")
+    parser_resume.add_argument("-D", "--detach", action="store_true",
+                               help="return as soon as each host's run has restarted.")
+
+    parser_profile = subparsers.add_parser(
+        "profile",
+        help="Summarize per-step timings for an execution across hosts.",
+        parents=[common_parser, pacing_parser, agent_parser],
+    )
+    parser_profile.set_defaults(func=run_profile)
+    parser_profile.add_argument("execution_id")
+    parser_profile.add_argument("--top", type=int, default=5,
+                                help="how many of the slowest hosts to list. (default 5)")
 
     args = parser.parse_args(argv)
-    res: ExecResult = args.func(args)
+    args.conduit_factory = conduit_factory
+    registry = Registry()
+    try:
+        res: ExecResult = args.func(args, registry)
+    finally:
+        registry.close()
     return res
 
-def runners_from_args(args, execution_id):
-    exec_dir = os.path.join(args.run_root, execution_id)
+REGISTRY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS executions (
+    id TEXT PRIMARY KEY,
+    created REAL NOT NULL,
+    config TEXT,
+    run_root TEXT NOT NULL,
+    local INTEGER NOT NULL,
+    port INTEGER,
+    username TEXT
+);
+CREATE TABLE IF NOT EXISTS hosts (
+    execution_id TEXT NOT NULL REFERENCES executions(id) ON DELETE CASCADE,
+    host TEXT NOT NULL,
+    status TEXT NOT NULL,
+    updated REAL NOT NULL,
+    PRIMARY KEY (execution_id, host)
+);
+"""
+
+def registry_path() -> str:
+    """
+    Where the registry of executions lives. Override with $CATTLE_REGISTRY.
+    """
+    path = os.getenv("CATTLE_REGISTRY") or os.path.join(
+        os.getenv("XDG_STATE_HOME") or os.path.expanduser("~/.local/state"), "cattle", "registry.sqlite3"
+    )
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return path
 
-    if args.local:
-        return [HostRunner(execution_id, exec_dir=exec_dir, hostdesc="[local]", conduit=LocalHostConduit())]
+class Registry:
+    """
+    The orchestrator's memory of its executions: where each ran, how to reach
+    its hosts, and each host's last known status. Commands about an execution
+    default to its registered hosts, and needn't ask again about hosts already
+    known to be finished. Safe to share between map_runners' threads.
+    """
+    def __init__(self, path: Optional[str] = None):
+        self.db = sqlite3.connect(path or registry_path(), timeout=30, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.lock = threading.Lock()
+        with self.lock, self.db:
+            self.db.execute("PRAGMA foreign_keys = ON")
+            self.db.executescript(REGISTRY_SCHEMA)
 
-    if not args.hosts:
+    def close(self):
+        self.db.close()
+
+    def add_execution(self, execution_id: str, config: Optional[str], runners: List["HostRunner"],
+                      local: bool, port: Optional[int], username: Optional[str]):
+        now = time.time()
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT INTO executions (id, created, config, run_root, local, port, username) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (execution_id, now, config, runners[0].run_root, int(local), port, username),
+            )
+            self.db.executemany(
+                "INSERT INTO hosts (execution_id, host, status, updated) VALUES (?, ?, 'UNKNOWN', ?)",
+                [(execution_id, r.hostdesc, now) for r in runners],
+            )
+
+    def execution(self, execution_id: str) -> Optional[sqlite3.Row]:
+        with self.lock:
+            return self.db.execute("SELECT * FROM executions WHERE id = ?", (execution_id,)).fetchone()
+
+    def statuses(self, execution_id: str) -> Dict[str, str]:
+        "Each registered host's last known status."
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT host, status FROM hosts WHERE execution_id = ? ORDER BY rowid", (execution_id,)
+            ).fetchall()
+        return {row["host"]: row["status"] for row in rows}
+
+    def set_status(self, execution_id: str, host: str, status: str):
+        with self.lock, self.db:
+            self.db.execute(
+                "UPDATE hosts SET status = ?, updated = ? WHERE execution_id = ? AND host = ?",
+                (status, time.time(), execution_id, host),
+            )
+
+    def recent(self, limit: int) -> List[sqlite3.Row]:
+        with self.lock:
+            return self.db.execute(
+                "SELECT * FROM executions ORDER BY created DESC LIMIT ?", (limit,)
+            ).fetchall()
+
+    def finished(self, statuses=(cattle_remote.STATUS_DONE,)) -> List[str]:
+        """
+        Executions whose every host is known to have finished with one of
+        `statuses`: by default, successfully.
+        """
+        statuses = sorted(statuses)
+        with self.lock:
+            rows = self.db.execute(
+                f"SELECT id FROM executions e WHERE NOT EXISTS ("
+                f"SELECT 1 FROM hosts h WHERE h.execution_id = e.id "
+                f"AND h.status NOT IN ({', '.join('?' * len(statuses))})) ORDER BY created",
+                statuses,
+            ).fetchall()
+        return [row["id"] for row in rows]
+
+    def forget(self, execution_id: str):
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM executions WHERE id = ?", (execution_id,))
+
+def runners_from_args(args, execution_id, registry: Optional[Registry] = None):
+    """
+    The runners for the hosts named in args or, with none named, for the
+    hosts the registry has for the execution. Their conduits come from
+    args.conduit_factory, given one (see main_args_inner), or are SSH.
+    """
+    agent_runtime = make_executable() if getattr(args, "agent", False) else None
+    local, hosts, port, username, run_root = args.local, args.hosts, args.port, args.username, args.run_root
+    known = registry.execution(execution_id) if registry is not None and not (local or hosts) else None
+    if known is not None:
+        local = bool(known["local"])
+        hosts = list(registry.statuses(execution_id))
+        port = port or known["port"]
+        username = username or known["username"]
+        run_root = run_root or known["run_root"]
+    run_root = run_root or DEFAULT_RUN_ROOT
+
+    if local:
+        return [HostRunner(execution_id, run_root=run_root, hostdesc="[local]", conduit=LocalHostConduit(),
+                           agent_runtime=agent_runtime)]
+
+    if not hosts:
         raise Exception("require at least one host when run in remote mode.")
-    if not args.username:
-        raise Exception("username required in remote mode.")
-    password = (
-        os.getenv("SSH_SPECIAL_PASS")
-        or getpass.getpass("Please enter the password for these hosts: ")
-    )
+    conduit_factory = getattr(args, "conduit_factory", None)
+    if conduit_factory is None:
+        if not username:
+            raise Exception("username required in remote mode.")
+        # (Asked for at most once per command, however many executions it
+        # works through.)
+        password = (
+            getattr(args, "password", None)
+            or os.getenv("SSH_SPECIAL_PASS")
+            or getpass.getpass("Please enter the password for these hosts: ")
+        )
+        args.password = password
+        conduit_factory = lambda h: RemoteHostConduit(h, port or DEFAULT_PORT, username, password)
 
     return [
         HostRunner(
             execution_id=execution_id,
-            exec_dir=exec_dir,
+            run_root=run_root,
             hostdesc=h,
-            conduit=RemoteHostConduit(h, args.port, args.username, password),
+            conduit=conduit_factory(h),
+            agent_runtime=agent_runtime,
         )
-        for h in args.hosts
+        for h in hosts
     ]
 
-def run_exec_config(args):
-    config_abs = os.path.abspath(args.config_dir.rstrip("/"))
+def adaptive_from_args(args) -> Optional[AdaptiveConcurrency]:
+    "With --adaptive, a controller for one fleet operation's concurrency."
+    return AdaptiveConcurrency(args.max_in_flight, verbose=args.verbose) if args.adaptive else None
+
+def import_config(config_abs: str, config_module: str):
+    "Import the config here, to catch a broken one before any host sees it."
     config_package = os.path.basename(config_abs)
 
     sys.path.append(os.path.dirname(__file__))
@@ -263,15 +1954,23 @@ def run_exec_config(args):
     config_dir_parent = os.path.dirname(config_abs)
     sys.path.append(config_dir_parent)
 
-    importable_module = f"{config_package}.{args.config_module}"
+    importable_module = f"{config_package}.{config_module}"
     if importable_module.endswith(".py"):
         importable_module = importable_module[:-3]
 
+    return importlib.import_module(importable_module)
+
+def run_exec_config(args, registry: Registry):
+    config_abs = os.path.abspath(args.config_dir.rstrip("/"))
+
     try:
-        importlib.import_module(importable_module)
+        import_config(config_abs, args.config_module)
     except ModuleNotFoundError as e:
         print(f"couldn't load config: {e}", file=sys.stderr)
         return ExecResult(1)
+    if args.if_drifted and args.transfer == "pipeline":
+        print("--if-drifted needs to look before it runs, which the pipeline transfer doesn't.", file=sys.stderr)
+        return ExecResult(1)
 
     # Package up the customer configs and a zipapp package and transfer these to
     # the remote hosts.
@@ -282,67 +1981,364 @@ def run_exec_config(args):
     try:
         runners = runners_from_args(args, execution_id)
     except Exception as e:
-        print(e.msg, file=sys.stderr)
+        print(e, file=sys.stderr)
         return ExecResult(1)
 
-    archive = make_archive(config_abs)
+    registry.add_execution(execution_id, config_abs, runners, args.local, args.port, args.username)
+
     executable = make_executable()
+    entries = config_entries(config_abs)
+    link_bps = args.link_mbps * 1e6 / 8
+    codec = args.codec
+    if codec == "auto" and args.transfer != "delta":
+        # (A delta's codec goes by what it carries, so is chosen per base.)
+        codec = choose_codec(config_abs, entries, link_bps)
+    if args.verbose:
+        print("codec:", codec)
+    if args.transfer in ("stream", "delta"):
+        # Nothing to stage: the archive is built as it's sent, or per base.
+        archive = None
+        manifest = build_manifest(config_abs, entries)
+        artifacts = [executable]
+    else:
+        archive = make_archive(config_abs, codec)
+        artifacts = [archive, executable]
+        if args.verbose:
+            print("archive:", archive.path, archive.digest)
     if args.verbose:
-        print("archive:", archive)
-        print("executable:", executable)
+        print("executable:", executable.path, executable.digest)
+
+    if args.fanout > 0:
+        fan_out_artifacts(runners, executable, artifacts, args.fanout,
+                          args.max_in_flight, args.verbose)
+
+    def drifted(runner, executable) -> bool:
+        vector = runner.check(executable, mark_done=True)
+        if set(vector) <= {cattle_remote.CHECK_CLEAN}:
+            registry.set_status(execution_id, runner.hostdesc, cattle_remote.STATUS_DONE)
+            print(f"Host {runner.hostdesc} is already up to date; not running.")
+            return False
+        return True
 
     def transfer_and_exec(runner):
-        runner.transfer(archive, executable)
-        runner.execute(archive, executable)
-        print(f"Host {runner.hostdesc} finished with status '{runner.status()}'.")
+        status = None
+        if args.transfer == "pipeline":
+            res = runner.bootstrap(archive, executable, args.detach)
+            uploaded, status = res.uploaded, res.status
+            if args.verbose:
+                saved = SCP_PATH_ROUND_TRIPS + len(uploaded) - PIPELINE_ROUND_TRIPS
+                rtt_ms = res.first_response * 1000
+                print(f"Host {runner.hostdesc}: pipelined bootstrap saved {saved} round trips "
+                      f"(~{saved * rtt_ms:.0f}ms at {rtt_ms:.0f}ms to first response).")
+        elif args.transfer == "stream":
+            uploaded = runner.transfer(artifacts)
+            digest = runner.stream_config(config_abs, entries, manifest, executable, codec)
+            if args.verbose:
+                print(f"Host {runner.hostdesc}: streamed config archive {digest}.")
+            if args.if_drifted and not drifted(runner, executable):
+                return
+            runner.execute(None, executable, args.detach)
+        elif args.transfer == "delta":
+            uploaded = runner.transfer(artifacts)
+            base = runner.base_config(executable, json.loads(manifest)["files"])
+            delta = make_delta(config_abs, entries, manifest, base, codec, link_bps)
+            runner.transfer([delta])
+            try:
+                runner.patch(delta, executable)
+            except Exception as e:
+                print(f"Host {runner.hostdesc}: delta didn't apply, sending the whole config: {e}", file=sys.stderr)
+                full = make_archive(config_abs, choose_codec(config_abs, entries, link_bps) if codec == "auto" else codec)
+                runner.transfer([full])
+                runner.init(full, executable)
+            if args.verbose:
+                print(f"Host {runner.hostdesc}: sent a {os.path.getsize(delta.path)} byte delta "
+                      f"({delta.name}) against {base['base'] or 'nothing'}.")
+            if args.if_drifted and not drifted(runner, executable):
+                return
+            runner.execute(None, executable, args.detach)
+        elif args.if_drifted:
+            uploaded = runner.transfer(artifacts)
+            runner.init(archive, executable)
+            if not drifted(runner, executable):
+                return
+            runner.execute(None, executable, args.detach)
+        else:
+            uploaded = runner.transfer(artifacts)
+            runner.execute(archive, executable, args.detach)
+        if args.verbose:
+            print(f"Host {runner.hostdesc}: uploaded {len(uploaded)} of {len(artifacts)} artifacts; the rest were cached.")
+        if args.detach:
+            registry.set_status(execution_id, runner.hostdesc, cattle_remote.STATUS_PROGRESS)
+            print(f"Host {runner.hostdesc} started.")
+        else:
+            status = status or runner.status()
+            registry.set_status(execution_id, runner.hostdesc, status)
+            print(f"Host {runner.hostdesc} finished with status '{status}'.")
 
-    map_runners(transfer_and_exec, runners)
-    print("Completed execution ID", execution_id)
+    map_runners(transfer_and_exec, runners, args.max_in_flight, adaptive_from_args(args))
+    if args.detach:
+        print("Started execution ID", execution_id)
+    else:
+        print("Completed execution ID", execution_id)
     return ExecResult(0, {"execution_id": execution_id})
 
-def run_status(args):
+# The drift class of hosts that couldn't be checked.
+UNREACHABLE = "unreachable"
+
+def run_check(args, registry: Registry):
+    """
+    Unpack the config on every host, evaluate each step's should_run there,
+    and print the hosts grouped into drift classes: hosts with the same steps
+    pending. Nothing is registered, and the hosts' execution dirs are removed
+    afterwards (the artifacts stay in their stores for the real run).
+    """
+    config_abs = os.path.abspath(args.config_dir.rstrip("/"))
     try:
-        runners = runners_from_args(args, args.execution_id)
+        config = import_config(config_abs, args.config_module)
+    except ModuleNotFoundError as e:
+        print(f"couldn't load config: {e}", file=sys.stderr)
+        return ExecResult(1)
+
+    check_id = f"cattle-check.{time.monotonic()}"
+    try:
+        runners = runners_from_args(args, check_id)
     except Exception as e:
-        print(e.msg, file=sys.stderr)
+        print(e, file=sys.stderr)
         return ExecResult(1)
 
+    archive = make_archive(config_abs)
+    executable = make_executable()
+    lock = threading.Lock()
+    classes: Dict[str, List[str]] = {}
+
+    def check(runner):
+        try:
+            try:
+                runner.transfer([archive, executable])
+                runner.init(archive, executable)
+                vector = runner.check(executable)
+            finally:
+                runner.clean()
+        except Exception as e:
+            print(f"Host {runner.hostdesc}: {e}", file=sys.stderr)
+            runner.failed = True
+            vector = UNREACHABLE
+        with lock:
+            classes.setdefault(vector, []).append(runner.hostdesc)
+
+    map_runners(check, runners, args.max_in_flight, adaptive_from_args(args))
+
+    steps = list(config.steps)
+    print(f"{len(classes)} drift classes across {len(runners)} hosts:")
+    for vector, hosts in sorted(classes.items(), key=lambda kv: len(kv[1]), reverse=True):
+        shown = ", ".join(sorted(hosts)[:5]) + (", ..." if len(hosts) > 5 else "")
+        print(f"  {vector}  {len(hosts)} hosts: {shown}")
+        for i, c in enumerate(vector if vector != UNREACHABLE else "", 1):
+            if c != cattle_remote.CHECK_CLEAN:
+                what = "would run" if c == cattle_remote.CHECK_PENDING else "should_run failed"
+                print(f"      step {i} {what}: {steps[i - 1].__class__.__name__} ({steps[i - 1].desc()})")
+    return ExecResult(0, classes)
+
+def run_status(args, registry: Registry):
+    try:
+        runners = runners_from_args(args, args.execution_id, registry)
+    except Exception as e:
+        print(e, file=sys.stderr)
+        return ExecResult(1)
+
+    # (Only for the hosts asked about.)
+    hostdescs = {r.hostdesc for r in runners}
+    statuses = {} if args.refresh else {
+        h: s for h, s in registry.statuses(args.execution_id).items()
+        if h in hostdescs and s in cattle_remote.TERMINAL_STATUSES
+    }
+    for hostdesc, status in statuses.items():
+        print(f"Host {hostdesc} status = {status} (finished; from the registry)")
+
     def status(runner):
-        print(f"Host {runner.hostdesc} status = {runner.status()}")
+        s = runner.status()
+        registry.set_status(args.execution_id, runner.hostdesc, s)
+        statuses[runner.hostdesc] = s
+        print(f"Host {runner.hostdesc} status = {s}")
 
-    map_runners(status, runners)
-    return ExecResult(0)
+    map_runners(status, [r for r in runners if r.hostdesc not in statuses], args.max_in_flight,
+                adaptive_from_args(args))
+    return ExecResult(0, statuses)
 
-def run_clean(args):
+def run_wait(args, registry: Registry):
     try:
-        runners = runners_from_args(args, args.execution_id)
+        runners = runners_from_args(args, args.execution_id, registry)
     except Exception as e:
-        print(e.msg, file=sys.stderr)
+        print(e, file=sys.stderr)
         return ExecResult(1)
 
-    def clean(runner):
-        runner.clean()
-        print(f"Host {runner.hostdesc} cleaned.")
+    progress = FleetProgress(runners, args.live)
+    # No need to wait on hosts we already know are finished.
+    hostdescs = {r.hostdesc for r in runners}
+    finished = {
+        h: s for h, s in registry.statuses(args.execution_id).items()
+        if h in hostdescs and s in cattle_remote.TERMINAL_STATUSES
+    }
+    for hostdesc, status in finished.items():
+        progress.update(hostdesc, f"{status} -")
+    deadline = None if args.timeout is None else time.monotonic() + args.timeout
+
+    def wait(runner):
+        try:
+            runner.watch(lambda state: progress.update(runner.hostdesc, state), deadline)
+        except Exception as e:
+            progress.update(runner.hostdesc, "UNREACHABLE -")
+            print(f"Host {runner.hostdesc}: {e}", file=sys.stderr)
+            return
+        registry.set_status(args.execution_id, runner.hostdesc, progress.statuses()[runner.hostdesc])
+
+    # Every host is watched at once (up to --max-watching) rather than paced
+    # like the other operations: a host left queued behind the cap wouldn't
+    # be heard from until others finished, however long that takes.
+    map_runners(wait, [r for r in runners if r.hostdesc not in finished], args.max_watching)
+    statuses = progress.statuses()
+    if not args.live:
+        for hostdesc, status in statuses.items():
+            print(f"Host {hostdesc} status = {status}")
+    print(f"Execution {args.execution_id}: {progress.summary()}")
+    all_done = all(s == cattle_remote.STATUS_DONE for s in statuses.values())
+    return ExecResult(0 if all_done else 1, statuses)
+
+def run_resume(args, registry: Registry):
+    try:
+        runners = runners_from_args(args, args.execution_id, registry)
+    except Exception as e:
+        print(e, file=sys.stderr)
+        return ExecResult(1)
+
+    def resume(runner):
+        status = runner.status()
+        if status == cattle_remote.STATUS_DONE:
+            print(f"Host {runner.hostdesc} already finished; nothing to resume.")
+            return
+        # (A PROGRESS run whose pid is gone comes back DIED, and resumes.)
+        if status == cattle_remote.STATUS_PROGRESS:
+            print(f"Host {runner.hostdesc} is still running; not resuming.")
+            return
+        runner.resume(args.detach)
+        if args.detach:
+            registry.set_status(args.execution_id, runner.hostdesc, cattle_remote.STATUS_PROGRESS)
+            print(f"Host {runner.hostdesc} resumed.")
+        else:
+            status = runner.status()
+            registry.set_status(args.execution_id, runner.hostdesc, status)
+            print(f"Host {runner.hostdesc} resumed and finished with status '{status}'.")
 
-    map_runners(clean, runners)
-    print(f"Cleaned execution from {len(runners)} hosts.")
+    map_runners(resume, runners, args.max_in_flight, adaptive_from_args(args))
     return ExecResult(0)
 
-def run_log(args):
+def run_profile(args, registry: Registry):
     try:
-        runners = runners_from_args(args, args.execution_id)
+        runners = runners_from_args(args, args.execution_id, registry)
     except Exception as e:
-        print(e.msg, file=sys.stderr)
+        print(e, file=sys.stderr)
         return ExecResult(1)
 
     lock = threading.Lock()
+    # (step index, class, desc) -> that step's duration on each host.
+    step_times: Dict[tuple, List[float]] = {}
+    host_times: Dict[str, float] = {}
 
-    def clean(runner):
-        log = runner.log()
-        # (Don't interleave the logs from different hosts.)
+    def fetch(runner):
+        total = 0.0
+        records = runner.trace()
         with lock:
-            print(f"Host {runner.hostdesc} log:")
-            print(log)
+            for rec in records:
+                duration = (rec["should_run_s"] or 0.0) + sum(rec["attempts"])
+                step_times.setdefault((rec["step"], rec["cls"], rec["desc"]), []).append(duration)
+                total += duration
+            host_times[runner.hostdesc] = total
 
-    map_runners(clean, runners)
-    return ExecResult(0)
+    map_runners(fetch, runners, args.max_in_flight, adaptive_from_args(args))
+
+    print(f"{'step':>5}  {'hosts':>5}  {'p50':>8}  {'p95':>8}  {'max':>8}  description")
+    for (i, cls, desc), times in sorted(step_times.items()):
+        print(f"{i:>5}  {len(times):>5}  {percentile(times, 50):>8.3f}  {percentile(times, 95):>8.3f}  "
+              f"{max(times):>8.3f}  {cls} ({desc})")
+
+    print("Slowest hosts:")
+    for hostdesc, total in sorted(host_times.items(), key=lambda kv: kv[1], reverse=True)[:args.top]:
+        print(f"  {hostdesc}: {total:.3f}s")
+    return ExecResult(0, {"steps": step_times, "hosts": host_times})
+
+def run_clean(args, registry: Registry):
+    if args.finished == (args.execution_id is not None):
+        print("give either an execution ID or --finished.", file=sys.stderr)
+        return ExecResult(1)
+
+    cleaned = []
+    for execution_id in registry.finished() if args.finished else [args.execution_id]:
+        try:
+            runners = runners_from_args(args, execution_id, registry)
+        except Exception as e:
+            print(e, file=sys.stderr)
+            return ExecResult(1)
+
+        def clean(runner):
+            runner.clean()
+            print(f"Host {runner.hostdesc} cleaned.")
+
+        map_runners(clean, runners, args.max_in_flight, adaptive_from_args(args))
+        registry.forget(execution_id)
+        cleaned.append(execution_id)
+        print(f"Cleaned execution {execution_id} from {len(runners)} hosts.")
+    return ExecResult(0, {"cleaned": cleaned})
+
+def run_list(args, registry: Registry):
+    executions = registry.recent(args.limit)
+    for e in executions:
+        counts = {}
+        for status in registry.statuses(e["id"]).values():
+            counts[status] = counts.get(status, 0) + 1
+        created = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(e["created"]))
+        summary = ", ".join(f"{n} {status}" for status, n in sorted(counts.items()))
+        print(f"{e['id']}  {created}  {summary}  {e['config'] or ''}")
+    return ExecResult(0, {"executions": [e["id"] for e in executions]})
+
+def run_log(args, registry: Registry):
+    try:
+        runners = runners_from_args(args, args.execution_id, registry)
+    except Exception as e:
+        print(e, file=sys.stderr)
+        return ExecResult(1)
+
+    query = {
+        "byte_range": args.bytes, "line_range": args.lines, "level": args.level, "steps": args.steps,
+        "patterns": args.patterns, "ignore_case": args.ignore_case, "tail": args.tail,
+    }
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok=True)
+
+    lock = threading.Lock()
+    counts = {}
+    failed = False
+
+    def log(runner):
+        nonlocal failed
+        try:
+            if args.output_dir:
+                # (Host names can't have slashes, but "[local]" shouldn't
+                # trip anyone up either.)
+                name = runner.hostdesc.replace("/", "_")
+                with open(os.path.join(args.output_dir, f"{name}.log"), "wb") as f:
+                    counts[runner.hostdesc] = runner.query_log(query, f.write)
+            else:
+                # Lines go out as they arrive, each whole and tagged with its
+                # host, so no host waits on another's log.
+                def write(line: bytes):
+                    with lock:
+                        print(f"{runner.hostdesc}: {line.decode(errors='replace').rstrip()}")
+                counts[runner.hostdesc] = runner.query_log(query, write)
+        except Exception as e:
+            runner.failed = True
+            with lock:
+                failed = True
+                print(f"Host {runner.hostdesc} log: {e}", file=sys.stderr)
+
+    map_runners(log, runners, args.max_in_flight, adaptive_from_args(args))
+    return ExecResult(1 if failed else 0, counts)
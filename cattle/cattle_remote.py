@@ -2,30 +2,118 @@
 Command line and tools for running Cattle configs.
 """
 
+# Every runtime invocation pays for these imports, so the heavier ones that
+# only some subcommands need (concurrent.futures, tarfile, subprocess, pathlib
+# and friends) are imported where they're used instead.
 import argparse
+import hashlib
 import importlib
+import itertools
+import json
 import logging
 import os
-import pathlib
+import shlex
+import struct
 import sys
-import tarfile
-from typing import Callable, NoReturn
+import threading
+import time
+from typing import Callable, Dict, List, NoReturn, Optional, Set
 
 RETRIES = 3
 
 STATUS_PROGRESS = "PROGRESS"
 STATUS_ERROR = "ERROR"
 STATUS_DONE = "DONE"
+# Reported (never written) when STATUS says PROGRESS but the pid in PID_FILE is
+# gone, or there's no PID_FILE at all (every run records its pid).
+STATUS_DIED = "DIED"
 
-def call_with_retry(c: Callable[[], NoReturn]):
+TERMINAL_STATUSES = {STATUS_DONE, STATUS_ERROR, STATUS_DIED}
+
+STATUS_FILE = "STATUS"
+# The step a run is currently on, as "<index>/<count> <class>".
+STEP_FILE = "STEP"
+# Per-step timings, one JSON object per line.
+TRACE_FILE = "trace.jsonl"
+# Append-only record of completed steps, for resuming.
+JOURNAL_FILE = "journal"
+PID_FILE = "PID"
+LOG_FILE = "exec.log"
+
+# exec.log records are "<date> <time> <LEVEL> [<step>] <message>", the step
+# (or "<first>-<last>", for coalesced steps) only when logged from within
+# one; lines that don't start like that (say, a traceback's) continue the
+# record before them.
+LOG_FORMAT = "%(asctime)s %(levelname)s %(step_tag)s%(message)s"
+LOG_RECORD = r"\d{4}-\d\d-\d\d \d\d:\d\d:\d\d,\d+ ([A-Z]+) (?:\[(\d+)(?:-(\d+))?\] )?"
+LOG_LEVELS = {"DEBUG": 10, "INFO": 20, "WARNING": 30, "ERROR": 40, "CRITICAL": 50}
+
+# The step the current thread is running, for tagging its log records.
+_current_step = threading.local()
+
+def tag_step(record: logging.LogRecord) -> bool:
+    "A logging filter giving records the step_tag LOG_FORMAT wants."
+    step = getattr(_current_step, "value", None)
+    record.step_tag = f"[{step}] " if step is not None else ""
+    return True
+
+def _step_module():
+    try:
+        from facility import step # Inside the runtime zipapp.
+    except ImportError:
+        from cattle.facility import step
+    return step
+
+def default_retry_policy():
+    "The policy for steps that neither they nor their config set one for."
+    return _step_module().RetryPolicy(attempts=RETRIES)
+
+def call_with_timeout(c: Callable[[], NoReturn], timeout: Optional[float]):
+    """
+    Call c as an attempt limited to `timeout` seconds. Python can't kill a
+    thread, so c is told its deadline (facility.step.attempt_timeout) and
+    enforces it, the facilities by passing it to subprocess as `timeout=`.
+    Either way the call finishes before this returns, so a retry never
+    overlaps an attempt that's still running, and one that overran fails.
+    """
+    if timeout is None:
+        return c()
+    started = time.monotonic()
+    with _step_module().attempt_deadline(timeout):
+        result = c()
+    elapsed = time.monotonic() - started
+    if elapsed > timeout:
+        raise TimeoutError(f"attempt took {elapsed:.2f}s, over its {timeout}s timeout")
+    return result
+
+def call_with_retry(c: Callable[[], NoReturn], attempts: Optional[List[float]] = None,
+                    policy=None, label: str = "call"):
+    """
+    Call c until it succeeds, as often and as patiently as the retry policy
+    (by default, default_retry_policy()) says. Each attempt is logged, and its
+    duration appended to `attempts`, if given.
+    """
+    if policy is None:
+        policy = default_retry_policy()
     e = None
-    for _ in range(RETRIES):
+    for n in range(1, policy.attempts + 1):
+        started = time.monotonic()
         try:
-            return c()
+            return call_with_timeout(c, policy.timeout)
         except Exception as err:
             e = err
-    else:
-        raise Exception(f"unable to execute after {RETRIES} attempts. last err: {e}")
+        finally:
+            elapsed = time.monotonic() - started
+            if attempts is not None:
+                attempts.append(elapsed)
+        if n < policy.attempts:
+            delay = policy.delay(n)
+            logging.warning(f"{label} attempt {n}/{policy.attempts} failed after {elapsed:.2f}s: {e}; "
+                            f"retrying in {delay:.2f}s")
+            time.sleep(delay)
+        else:
+            logging.warning(f"{label} attempt {n}/{policy.attempts} failed after {elapsed:.2f}s: {e}")
+    raise Exception(f"unable to execute after {policy.attempts} attempts. last err: {e}")
 
 def dry_run_config(cfg):
     logging.info("running in dry run mode")
@@ -40,7 +128,203 @@ def dry_run_config(cfg):
         logging.info(f"> {step.__class__.__name__}:")
         logging.info(f"   > {step.desc()}")
 
-def run_config(cfg):
+class Trace:
+    """Writes a JSON line of timings per step to the trace file."""
+    def __init__(self, path: str):
+        self.f = open(path, "a")
+
+    def record(self, **fields):
+        self.f.write(json.dumps(fields) + "\n")
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+def parse_trace(lines) -> list:
+    """
+    The records in a trace file's lines, skipping any that don't parse (a
+    torn final write, say, if the run was killed). A resumed run appends to
+    the trace, so each step's latest record stands for it.
+    """
+    records = {}
+    for n, line in enumerate(lines):
+        try:
+            rec = json.loads(line)
+        except ValueError:
+            continue
+        if isinstance(rec, dict):
+            records[rec.get("step", ("line", n))] = rec
+    return list(records.values())
+
+# Step attributes that steer scheduling rather than say what the step does.
+SCHEDULING_ATTRS = {"resources", "depends_on"}
+# All the attributes that are about how the runner treats a step, which aren't
+# part of its identity.
+RUNNER_ATTRS = SCHEDULING_ATTRS | {"retry_policy"}
+
+# Worker threads for configs whose steps form a graph. A config can set its own
+# with a `max_workers` attribute.
+DEFAULT_STEP_WORKERS = 4
+
+def step_fingerprint(step) -> str:
+    """
+    Identifies a step by its class and parameters, so a resumed run can tell
+    whether a journaled step is still the same step. A step can say what its
+    parameters are with a `fingerprint()` method; otherwise they're its
+    JSON-able attributes. (Anything else, an object whose repr carries its
+    address say, would differ from run to run.)
+    """
+    cls = step.__class__
+    if hasattr(step, "fingerprint"):
+        params = str(step.fingerprint())
+    else:
+        kept = {}
+        for k, v in getattr(step, "__dict__", {}).items():
+            if k in RUNNER_ATTRS:
+                continue
+            try:
+                json.dumps(v)
+            except (TypeError, ValueError):
+                continue
+            kept[k] = v
+        params = json.dumps(kept, sort_keys=True)
+    return hashlib.sha256(f"{cls.__module__}.{cls.__qualname__}:{params}".encode()).hexdigest()
+
+def coalesce_steps(steps) -> List[tuple]:
+    """
+    Merge runs of consecutive same-type steps whose facility offers a
+    `merge(next_step)` method (package installs, say) into single steps.
+    Steps carrying scheduling annotations are left alone, as are steps that
+    another's `depends_on` names (the merged step would be a new object) and
+    pairs that merge() returns None for. Returns (first, last, step) for each
+    resulting step, first and last being the (1-based) indices of the
+    config's steps it stands for, so they keep their numbering.
+    """
+    depended_on = {id(other) for s in steps for other in getattr(s, "depends_on", None) or ()}
+    merged = []
+    for i, step in enumerate(steps, start=1):
+        if merged:
+            first, last, prev = merged[-1]
+            if (
+                type(prev) is type(step)
+                and hasattr(prev, "merge")
+                and not any(hasattr(s, a) for s in (prev, step) for a in SCHEDULING_ATTRS)
+                and not {id(prev), id(step)} & depended_on
+            ):
+                combined = prev.merge(step)
+                if combined is not None:
+                    merged[-1] = (first, i, combined)
+                    logging.info(f"coalesced steps {first}-{i} into one {step.__class__.__name__} step")
+                    continue
+        merged.append((i, i, step))
+    return merged
+
+def step_label(first: int, last: int) -> str:
+    "How a (possibly coalesced) step is numbered in logs and status."
+    return str(first) if first == last else f"{first}-{last}"
+
+def plan_steps(steps) -> Dict[int, Set[int]]:
+    """
+    Work out which steps each (1-based) step must wait for. Configs that
+    declare nothing run in order. Otherwise a step waits for its `depends_on`
+    steps and for the last earlier step sharing any of its `resources`, and
+    steps that declare neither are barriers between everything before and
+    after them. See facility.step.
+    """
+    if not any(hasattr(s, "resources") or hasattr(s, "depends_on") for s in steps):
+        return {i: {i - 1} if i > 1 else set() for i in range(1, len(steps) + 1)}
+
+    index = {id(s): i for i, s in enumerate(steps, start=1)}
+    deps = {}
+    last_barrier = None
+    last_user = {}
+    for i, step in enumerate(steps, start=1):
+        resources = getattr(step, "resources", None)
+        depends_on = getattr(step, "depends_on", None)
+        if resources is None and depends_on is None:
+            deps[i] = set(range(1, i))
+            last_barrier = i
+            last_user = {}
+            continue
+        d = {last_barrier} if last_barrier is not None else set()
+        for r in resources or ():
+            if r in last_user:
+                d.add(last_user[r])
+            last_user[r] = i
+        for other in depends_on or ():
+            j = index.get(id(other))
+            if j is None or j >= i:
+                raise ValueError(f"step {i} depends on a step that isn't earlier in the config")
+            d.add(j)
+        deps[i] = d
+    return deps
+
+def run_graph(deps: Dict[int, Set[int]], done: Set[int], run_step: Callable[[int], None], workers: int):
+    """
+    Run every step not already done, each once the steps it depends on are
+    done, on up to `workers` threads. After a failure nothing new starts; the
+    error is raised once the steps in flight finish.
+    """
+    import concurrent.futures
+
+    pending = sorted(set(deps) - done)
+    done = set(done)
+    running = {}
+    failure = None
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        while True:
+            if failure is None:
+                for i in list(pending):
+                    if len(running) >= workers:
+                        break
+                    if deps[i] <= done:
+                        pending.remove(i)
+                        running[executor.submit(run_step, i)] = i
+            if not running:
+                break
+            finished, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                i = running.pop(future)
+                try:
+                    future.result()
+                    done.add(i)
+                except Exception as e:
+                    if failure is None:
+                        failure = e
+    if failure is not None:
+        raise failure
+
+class Journal:
+    """
+    The steps an execution has completed, one JSON line each, fsync'd as
+    they're written so a crash can't lose a completion.
+    """
+    def __init__(self, path: str):
+        self.path = path
+
+    def completed(self) -> dict:
+        "Step index -> fingerprint, for each journaled step."
+        done = {}
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        rec = json.loads(line)
+                    except ValueError:
+                        break # A torn final write.
+                    done[rec["step"]] = rec["fingerprint"]
+        except FileNotFoundError:
+            pass
+        return done
+
+    def record(self, step: int, fingerprint: str):
+        with open(self.path, "a") as f:
+            f.write(json.dumps({"step": step, "fingerprint": fingerprint}) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+def run_config(cfg, step_file: Optional[str] = None, trace: Optional[Trace] = None,
+               journal: Optional[Journal] = None, resume=False):
     logging.info("running in real mode")
 
     try:
@@ -49,24 +333,72 @@ def run_config(cfg):
         logging.exception("The config file doesn't define a steps attribute.")
         raise
 
-    for i, step in enumerate(steps, start=1):
+    step_count = len(steps)
+    # Steps are numbered as in the config (coalesced ones by their range), but
+    # scheduled by their position once coalesced.
+    ranges = coalesce_steps(steps)
+    steps = [step for _, _, step in ranges]
+    # Fingerprint before anything runs; steps may mutate themselves.
+    fingerprints = [step_fingerprint(step) for step in steps]
+    deps = plan_steps(steps)
+    # Steps are journaled as they finish, so a resumed run may skip a completed
+    # step only if everything it depends on was skipped too.
+    skip = set()
+    if resume and journal is not None:
+        completed = journal.completed()
+        for i in sorted(deps):
+            if completed.get(ranges[i - 1][0]) == fingerprints[i - 1] and deps[i] <= skip:
+                skip.add(i)
+        logging.info(f"resuming: {len(skip)} of {len(steps)} steps already completed.")
+
+    lock = threading.Lock()
+    default_policy = getattr(cfg, "retry_policy", None) or default_retry_policy()
+
+    def run_step(i):
+        first, last, step = ranges[i - 1]
+        label = step_label(first, last)
+        retry_policy = getattr(step, "retry_policy", default_policy)
+        if step_file is not None:
+            with lock:
+                rewrite_file(step_file, f"{label}/{step_count} {step.__class__.__name__}")
+        should_run_s = None
+        attempts = []
+        outcome = "error"
+        _current_step.value = label
         try:
-            logging.info(f"Running step {i}: {step.__class__.__name__} ({step.desc()})")
+            logging.info(f"Running step {label}: {step.__class__.__name__} ({step.desc()})")
             try:
                 should_run_fn = step.should_run
             except AttributeError:
                 should_run_fn = lambda: True
-            if should_run_fn():
-                call_with_retry(step.run)
+            started = time.monotonic()
+            should_run = should_run_fn()
+            should_run_s = time.monotonic() - started
+            if should_run:
+                call_with_retry(step.run, attempts, retry_policy, f"step {label}")
+                outcome = "ok"
             else:
-                logging.info("should run = False; skipping.")
+                logging.info(f"step {label}: should run = False; skipping.")
+                outcome = "skipped"
         except Exception as e:
-            logging.exception(f"aborting config at step {i} ({step.__class__.__name__})")
+            logging.exception(f"aborting config at step {label} ({step.__class__.__name__})")
             raise
         else:
-            logging.info(f"Step {i} completed successfully.")
-    else:
-        logging.info("config executed successfully.")
+            if journal is not None:
+                with lock:
+                    journal.record(first, fingerprints[i - 1])
+            logging.info(f"Step {label} completed successfully.")
+        finally:
+            _current_step.value = None
+            if trace is not None:
+                with lock:
+                    trace.record(
+                        step=first, last=last, cls=step.__class__.__name__, desc=step.desc(),
+                        should_run_s=should_run_s, attempts=attempts, outcome=outcome,
+                    )
+
+    run_graph(deps, skip, run_step, getattr(cfg, "max_workers", DEFAULT_STEP_WORKERS))
+    logging.info("config executed successfully.")
 
 def main() -> int:
     parser = argparse.ArgumentParser(
@@ -80,6 +412,10 @@ def main() -> int:
     )
     parser_init.set_defaults(func=init)
     parser_init.add_argument("tar_file")
+    parser_init.add_argument("--sha256",
+                            help="expected digest of the tar file; init refuses to unpack on mismatch")
+    parser_init.add_argument("--codec", choices=["none", "gz", "xz"], default="gz",
+                            help="compression of a tar file streamed on stdin. (default gz)")
     parser_init.add_argument("-m", "--config-module", default="__cattle__",
                             help="name of the config module. defaults to __cattle__.")
     parser_init.add_argument("-d", "--dry-run",
@@ -96,27 +432,822 @@ def main() -> int:
     parser_exec.add_argument("-d", "--dry-run",
                             help="if set, prints the hypothetical rather than running anything",
                             action="store_true")
+    parser_exec.add_argument("--detach", action="store_true",
+                            help="daemonize and return as soon as the run has started, printing its pid")
+    parser_exec.add_argument("--resume", action="store_true",
+                            help="skip the steps this execution's journal shows were already completed")
+
+    parser_check = subparsers.add_parser(
+        "check",
+        help="prints which of the config's steps would run here, as a vector of 0 (no), 1 (yes) and ? (should_run failed)",
+    )
+    parser_check.set_defaults(func=check)
+    parser_check.add_argument("config_dir")
+    parser_check.add_argument("-m", "--config-module", default="__cattle__",
+                              help="name of the config module. defaults to __cattle__.")
+    parser_check.add_argument("--mark-done", action="store_true",
+                              help="if no step would run, mark the execution DONE")
+
+    parser_signatures = subparsers.add_parser(
+        "signatures",
+        help="describes the latest config under a run root, as the base for a delta transfer",
+    )
+    parser_signatures.set_defaults(func=signatures)
+    parser_signatures.add_argument("run_root")
+    parser_signatures.add_argument("--base", help="the base config dir, for --path")
+    parser_signatures.add_argument("--path", dest="paths", action="append", default=[],
+                                   help="a file (relative to the base) to give block signatures for. may be repeated.")
+
+    parser_patch = subparsers.add_parser(
+        "patch",
+        help="unpacks a delta archive against the base config it was made for",
+    )
+    parser_patch.set_defaults(func=patch)
+    parser_patch.add_argument("delta")
+    parser_patch.add_argument("--sha256",
+                              help="expected digest of the delta; patch refuses to unpack on mismatch")
+
+    parser_relay = subparsers.add_parser(
+        "relay",
+        help="forwards artifacts from this host's store to peer hosts' stores",
+    )
+    parser_relay.set_defaults(func=relay)
+    parser_relay.add_argument("--store", required=True,
+                              help="this host's artifact store")
+    parser_relay.add_argument("--runtime", required=True,
+                              help="digest of the cattle runtime, which peers use to relay further")
+    parser_relay.add_argument("--digest", dest="digests", action="append", default=[],
+                              help="digest of an artifact to forward. may be repeated.")
+    parser_relay.add_argument("--peer", dest="peers", action="append", default=[],
+                              help="a peer's store: a local path or ssh://user@host:port/path. may be repeated.")
+    parser_relay.add_argument("--fanout", type=int, default=2,
+                              help="how many peers this host sends to directly")
+
+    parser_poll = subparsers.add_parser(
+        "poll",
+        help="prints an execution's status and step each time they change, until it ends or the timeout passes",
+    )
+    parser_poll.set_defaults(func=poll)
+    parser_poll.add_argument("exec_dir")
+    parser_poll.add_argument("--since", default="",
+                             help="the last state the caller saw; it isn't printed again")
+    parser_poll.add_argument("--timeout", type=float, default=60)
+    parser_poll.add_argument("--interval", type=float, default=0.25,
+                             help="seconds between looks at the status files")
+
+    parser_log = subparsers.add_parser(
+        "log",
+        help="prints the lines of an execution's log that a query selects",
+    )
+    parser_log.set_defaults(func=log_query)
+    parser_log.add_argument("exec_dir")
+    parser_log.add_argument("--bytes", type=parse_range,
+                            help="only look at this START:END byte range of the log (from 0, END excluded)")
+    parser_log.add_argument("--lines", type=parse_range,
+                            help="only look at this START:END range of lines (from 0, END excluded), "
+                                 "counted from the start of --bytes if given")
+    parser_log.add_argument("--level", choices=list(LOG_LEVELS),
+                            help="only lines of records at this level or above")
+    parser_log.add_argument("--step", dest="steps", type=int, action="append", default=[],
+                            help="only lines logged by this step. may be repeated.")
+    parser_log.add_argument("-e", "--grep", dest="patterns", action="append", default=[],
+                            help="only lines matching this regular expression. may be repeated (any may match).")
+    parser_log.add_argument("-i", "--ignore-case", action="store_true")
+    parser_log.add_argument("--tail", type=int,
+                            help="only the last TAIL lines selected")
+    parser_log.add_argument("--codec", choices=["none", "gz"], default="none",
+                            help="compression of the output. (default none)")
+
+    parser_agent = subparsers.add_parser(
+        "agent",
+        help="answers framed JSON requests about this run root's executions on stdin/stdout",
+    )
+    parser_agent.set_defaults(func=agent)
+    parser_agent.add_argument("--run-root", required=True,
+                              help="the run root whose executions the agent may look at and touch")
 
     args = parser.parse_args()
     return args.func(args)
 
+def file_digest(path) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
 def init(args):
     """
     The remote init routine.
     This takes a tar file and initializes the runtime directory structure.
+    A tar file of "-" is read as a stream from stdin, compressed with --codec,
+    and the digest of what arrived is printed so the sender can check it.
+    (A file's compression is detected, as tarfile reads multi-member gzip and
+    multi-stream xz files happily.)
     """
+    if args.tar_file == "-":
+        return init_stream(args)
+    import tarfile
+
+    if args.sha256 is not None:
+        if file_digest(args.tar_file) != args.sha256:
+            print(f"{args.tar_file} doesn't match digest {args.sha256}", file=sys.stderr)
+            return 1
     with tarfile.open(args.tar_file) as t:
         t.extractall()
     return 0
 
+class HashingReader:
+    "Reads through to a binary stream, hashing whatever passes by."
+    def __init__(self, stream):
+        self.stream = stream
+        self.hash = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self.hash.update(data)
+        return data
+
+def decompressing(stream, codec: str):
+    """
+    A reader of the stream, decompressed. Unlike tarfile's own stream
+    decompression, these carry on through the concatenated gzip members or xz
+    streams the orchestrator's parallel compression produces.
+    """
+    if codec == "gz":
+        import gzip
+        return gzip.GzipFile(fileobj=stream, mode="rb")
+    if codec == "xz":
+        import lzma
+        return lzma.LZMAFile(stream)
+    return stream
+
+class ChunkedReader:
+    """
+    Reads the orchestrator's framing of a streamed archive: chunks, each
+    preceded by its length in hex on a line, then an empty chunk and a trailer
+    line holding the sender's digest of the payload.
+    """
+    def __init__(self, stream):
+        self.stream = stream
+        self.left = 0
+        self.trailer = None
+
+    def _next_chunk(self):
+        header = self.stream.readline()
+        if not header.endswith(b"\n"):
+            raise EOFError("stream ended mid-frame")
+        self.left = int(header, 16)
+        if self.left == 0:
+            self.trailer = self.stream.readline().decode().strip()
+
+    def read(self, size=-1):
+        out = []
+        while size != 0 and self.trailer is None:
+            if self.left == 0:
+                self._next_chunk()
+                continue
+            n = self.left if size < 0 else min(size, self.left)
+            data = self.stream.read(n)
+            if not data:
+                raise EOFError("stream ended mid-chunk")
+            self.left -= len(data)
+            if size > 0:
+                size -= len(data)
+            out.append(data)
+        return b"".join(out)
+
+def init_stream(args):
+    """
+    Unpack a streamed archive into a scratch directory, and only move its
+    contents into place once the sender's trailing digest (and --sha256, if
+    given) matches what arrived.
+    """
+    import shutil
+    import tarfile
+    import tempfile
+
+    chunks = ChunkedReader(sys.stdin.buffer)
+    reader = HashingReader(chunks)
+    scratch = tempfile.mkdtemp(prefix=".init-", dir=".")
+    try:
+        with tarfile.open(fileobj=decompressing(reader, args.codec), mode="r|") as t:
+            t.extractall(scratch)
+        # Take in any compression trailer tarfile stopped short of.
+        while reader.read(1 << 20):
+            pass
+        digest = reader.hash.hexdigest()
+        print(digest)
+        for expected in (chunks.trailer, args.sha256):
+            if expected is not None and digest != expected:
+                print(f"streamed archive doesn't match digest {expected}", file=sys.stderr)
+                return 1
+        for name in os.listdir(scratch):
+            if os.path.isdir(name) and not os.path.islink(name):
+                shutil.rmtree(name)
+            os.replace(os.path.join(scratch, name), name)
+        return 0
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+# Members of a delta archive, beside the config/ entries sent whole: how to
+# rebuild the other files from the base config, and the data that needs.
+DELTA_SPEC_NAME = "config.delta.json"
+DELTA_DATA_NAME = "config.delta.bin"
+
+# The unpacked config's manifest, as written by the orchestrator.
+CONFIG_MANIFEST = os.path.join("config", ".cattle-manifest.json")
+
+def block_size_for(size: int) -> int:
+    "rsync's rule of thumb for a file's block size: about sqrt(size), within bounds."
+    return min(max(int(size ** 0.5) // 8 * 8, 2048), 128 * 1024)
+
+def weak_checksum(block: bytes) -> int:
+    """
+    rsync's rolling checksum of a block, as (b << 16) | a. a is the sum of the
+    bytes and b the sum of the prefix sums, both mod 2^16.
+    """
+    a = sum(block) & 0xffff
+    b = sum(itertools.accumulate(block)) & 0xffff
+    return (b << 16) | a
+
+def strong_checksum(block: bytes) -> str:
+    return hashlib.blake2b(block, digest_size=16).hexdigest()
+
+def latest_config(run_root: str) -> Optional[str]:
+    """
+    The config dir of the execution under run_root that was unpacked most
+    recently and ran to completion, so it's known to be whole and unaltered
+    by a run in progress. (Unpacking fixes file mtimes, so go by the
+    manifest's ctime.)
+    """
+    latest, latest_ctime = None, None
+    try:
+        names = os.listdir(run_root)
+    except FileNotFoundError:
+        return None
+    for name in names:
+        if _read(os.path.join(run_root, name, STATUS_FILE), "") != STATUS_DONE:
+            continue
+        try:
+            ctime = os.stat(os.path.join(run_root, name, CONFIG_MANIFEST)).st_ctime
+        except OSError:
+            continue
+        if latest_ctime is None or ctime > latest_ctime:
+            latest, latest_ctime = os.path.join(run_root, name, "config"), ctime
+    return latest
+
+def signatures(args):
+    """
+    Describe a base config for a delta. Without --path: which config is the
+    base and its manifest. With them: block signatures of those files in the
+    --base config.
+    """
+    if not args.paths:
+        base = latest_config(args.run_root)
+        manifest = None
+        if base is not None:
+            with open(os.path.join(os.path.dirname(base), CONFIG_MANIFEST)) as f:
+                manifest = json.load(f)["files"]
+        print(json.dumps({"base": base, "manifest": manifest}))
+        return 0
+
+    files = {}
+    for relpath in args.paths:
+        path = os.path.join(args.base, relpath)
+        block_size = block_size_for(os.path.getsize(path))
+        with open(path, "rb") as f:
+            blocks = [[weak_checksum(b), strong_checksum(b)] for b in iter(lambda: f.read(block_size), b"")]
+        files[relpath] = {"block_size": block_size, "blocks": blocks}
+    print(json.dumps({"base": args.base, "files": files}))
+    return 0
+
+def patch(args):
+    """
+    Unpack a delta archive (see cattle_cli.make_delta): the files it carries
+    whole, plus the rest rebuilt from the base config it names. Rebuilt files
+    and files reused whole from the base are all checked against their
+    digests, since the base may have been altered since it was unpacked.
+    """
+    import shutil
+    import tarfile
+
+    if args.sha256 is not None and file_digest(args.delta) != args.sha256:
+        print(f"{args.delta} doesn't match digest {args.sha256}", file=sys.stderr)
+        return 1
+    try:
+        with tarfile.open(args.delta) as t:
+            t.extractall()
+        with open(DELTA_SPEC_NAME) as f:
+            spec = json.load(f)
+
+        with open(DELTA_DATA_NAME, "rb") as data:
+            for relpath, entry in sorted(spec["files"].items()):
+                dest = os.path.join("config", relpath)
+                partial = dest + ".partial"
+                if entry["op"] == "same":
+                    src = os.path.join(spec["base"], entry["from"])
+                    st = os.stat(src)
+                    if st.st_size != entry["size"] or file_digest(src) != entry["sha256"]:
+                        print(f"{src} has changed since it was unpacked", file=sys.stderr)
+                        return 1
+                    try:
+                        # A link shares the mode, so only link a file with the right one.
+                        if st.st_mode & 0o7777 != entry["mode"]:
+                            raise OSError("mode differs")
+                        os.link(src, partial)
+                    except OSError:
+                        shutil.copyfile(src, partial)
+                else:
+                    block_size = entry["block_size"]
+                    with open(os.path.join(spec["base"], relpath), "rb") as old, open(partial, "wb") as out:
+                        for op, start, count in entry["ops"]:
+                            if op == "copy":
+                                old.seek(start * block_size)
+                                out.write(old.read(count * block_size))
+                            else:
+                                data.seek(start)
+                                out.write(data.read(count))
+                    if file_digest(partial) != entry["sha256"]:
+                        os.unlink(partial)
+                        print(f"{relpath} doesn't match digest {entry['sha256']} after patching", file=sys.stderr)
+                        return 1
+                os.chmod(partial, entry["mode"])
+                os.replace(partial, dest)
+        return 0
+    finally:
+        # Applied or not, the delta's parts aren't part of the execution.
+        for name in (DELTA_SPEC_NAME, DELTA_DATA_NAME):
+            try:
+                os.unlink(name)
+            except FileNotFoundError:
+                pass
+
+# Moves freshly uploaded artifacts into a store once their digests check out,
+# then links every artifact into the execution directory (unless that's "-").
+# Runs under the receiving host's python3 via `-c`, because the cattle runtime
+# itself may be one of the artifacts; both the orchestrator's uploads and the
+# relays' go through it.
+ADMIT_SCRIPT = """
+import hashlib, os, shutil, sys
+store, exec_dir = sys.argv[1:3]
+for spec in sys.argv[3:]:
+    digest, name, uploaded = spec.split(":")
+    path = os.path.join(store, digest)
+    if uploaded == "1":
+        h = hashlib.sha256()
+        with open(path + ".partial", "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+        if h.hexdigest() != digest:
+            os.unlink(path + ".partial")
+            sys.exit("digest mismatch for uploaded artifact " + name)
+        os.replace(path + ".partial", path)
+    if exec_dir == "-":
+        continue
+    dest = os.path.join(exec_dir, name)
+    try:
+        os.link(path, dest)
+    except FileExistsError:
+        pass
+    except OSError:
+        shutil.copyfile(path, dest)
+"""
+
+class LocalPeer:
+    """A peer whose artifact store is reachable on this filesystem."""
+    def __init__(self, store: str):
+        self.store = store
+
+    def missing(self, digests: List[str]) -> List[str]:
+        os.makedirs(self.store, exist_ok=True)
+        return [d for d in digests if not os.path.exists(os.path.join(self.store, d))]
+
+    def put(self, src: str, digest: str):
+        import shutil
+        import subprocess
+
+        shutil.copyfile(src, os.path.join(self.store, digest + ".partial"))
+        subprocess.run([sys.executable, "-c", ADMIT_SCRIPT, self.store, "-", f"{digest}:{digest}:1"], check=True)
+
+    def run(self, argv: List[str]):
+        import subprocess
+
+        subprocess.run([sys.executable] + argv, check=True)
+
+class SshPeer:
+    """
+    A peer reached over ssh. Relaying hosts have no paramiko, so this shells
+    out to the system ssh client, and needs key-based (non-interactive) auth.
+    """
+    def __init__(self, spec: str):
+        from urllib.parse import urlsplit
+
+        u = urlsplit(spec)
+        self.store = u.path
+        self.ssh = ["ssh", "-o", "BatchMode=yes", "-p", str(u.port or 22), f"{u.username}@{u.hostname}"]
+
+    def _ssh(self, cmd: str, **kwargs):
+        import subprocess
+
+        return subprocess.run(self.ssh + [cmd], check=True, stdout=subprocess.PIPE, **kwargs)
+
+    def missing(self, digests: List[str]) -> List[str]:
+        store = shlex.quote(self.store)
+        probes = " ".join(f"test -f {store}/{d} || echo {d};" for d in digests)
+        return self._ssh(f"mkdir -p {store} && {probes}").stdout.decode().split()
+
+    def put(self, src: str, digest: str):
+        partial = shlex.quote(os.path.join(self.store, digest + ".partial"))
+        admit = f"python3 -c {shlex.quote(ADMIT_SCRIPT)} {shlex.quote(self.store)} - {digest}:{digest}:1"
+        with open(src, "rb") as f:
+            self._ssh(f"cat > {partial} && {admit}", stdin=f)
+
+    def run(self, argv: List[str]):
+        self._ssh(" ".join(["python3"] + [shlex.quote(a) for a in argv]))
+
+def make_peer(spec: str):
+    return SshPeer(spec) if spec.startswith("ssh://") else LocalPeer(spec)
+
+def relay(args):
+    """
+    Forward artifacts down a distribution tree. This host sends to `fanout`
+    peers directly, and each of those relays on to its share of the rest.
+    """
+    import concurrent.futures
+
+    digests = list(dict.fromkeys([args.runtime] + args.digests))
+    groups = [args.peers[i::args.fanout] for i in range(args.fanout)]
+
+    def send(group):
+        head = make_peer(group[0])
+        for d in head.missing(digests):
+            head.put(os.path.join(args.store, d), d)
+        if len(group) > 1:
+            argv = [os.path.join(head.store, args.runtime), "relay", "--store", head.store,
+                    "--runtime", args.runtime, "--fanout", str(args.fanout)]
+            argv += [a for d in args.digests for a in ("--digest", d)]
+            argv += [a for p in group[1:] for a in ("--peer", p)]
+            head.run(argv)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.fanout) as executor:
+        for future in [executor.submit(send, g) for g in groups if g]:
+            future.result()
+    return 0
+
+def daemonize(exec_dir: str) -> bool:
+    """
+    Detach from the caller the classic double-fork way: new session, stdio on
+    /dev/null, every other fd closed, pid recorded in the exec dir. Returns
+    False in the original process once the daemon has recorded its pid, and
+    True in the daemon. The daemon reports back over a pipe, and if it can't
+    get going, OSError is raised in the original process instead.
+    """
+    r, w = os.pipe()
+    child = os.fork()
+    if child > 0:
+        os.close(w)
+        with os.fdopen(r, "rb") as f:
+            reply = f.read().decode().split(" ", 1)
+        os.waitpid(child, 0)
+        if reply[0] != "PID" or len(reply) < 2:
+            raise OSError(f"detached run didn't start: {' '.join(reply).strip() or 'no reply'}")
+        print(reply[1])
+        return False
+
+    try:
+        os.close(r)
+        os.setsid()
+        if os.fork() > 0:
+            os._exit(0)
+
+        devnull = os.open(os.devnull, os.O_RDWR)
+        for fd in (0, 1, 2):
+            os.dup2(devnull, fd)
+        try:
+            maxfd = os.sysconf("SC_OPEN_MAX")
+        except (AttributeError, ValueError):
+            maxfd = 1024
+        os.closerange(3, w)
+        os.closerange(w + 1, maxfd)
+
+        pid = str(os.getpid())
+        pid_file = os.path.join(exec_dir, PID_FILE)
+        with open(pid_file + ".tmp", "w") as f:
+            f.write(pid)
+        os.replace(pid_file + ".tmp", pid_file)
+    except BaseException as e:
+        os.write(w, f"ERROR {e}".encode())
+        os._exit(1)
+    os.write(w, f"PID {pid}".encode())
+    os.close(w)
+    return True
+
+def rewrite_file(path: str, content: str):
+    "Replace the file's content atomically, so readers never see a partial write."
+    with open(path + ".tmp", 'w') as f:
+        f.write(content)
+    os.replace(path + ".tmp", path)
+
 def rewrite_status(status_file: str, status: str):
-    with open(status_file, 'w') as f:
-        f.write(status)
+    rewrite_file(status_file, status)
+
+def _read(path: str, default: str) -> str:
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return default
+
+def read_state(exec_dir: str) -> str:
+    """
+    An execution's state as "<status> <step>". A detached run that's still
+    PROGRESS but whose process is gone is reported as DIED.
+    """
+    status = _read(os.path.join(exec_dir, STATUS_FILE), "UNKNOWN")
+    if status == STATUS_PROGRESS:
+        pid = _read(os.path.join(exec_dir, PID_FILE), "")
+        try:
+            os.kill(int(pid), 0)
+        except (ProcessLookupError, ValueError):
+            status = STATUS_DIED
+        except PermissionError:
+            pass
+    return f"{status} {_read(os.path.join(exec_dir, STEP_FILE), '-')}"
+
+def next_state(exec_dir: str, since: str, deadline: float, interval: float = 0.25) -> str:
+    """
+    Wait for an execution's state to differ from `since`, for the execution to
+    end, or for the (monotonic) deadline to pass, and return the state.
+    """
+    while True:
+        state = read_state(exec_dir)
+        if (state != since or state.split(" ", 1)[0] in TERMINAL_STATUSES
+                or time.monotonic() >= deadline):
+            return state
+        time.sleep(interval)
+
+def poll(args):
+    """
+    Long-poll an execution: watching the files here is cheap, so the
+    orchestrator holds one quiet channel open rather than re-running `cat`.
+    """
+    deadline = time.monotonic() + args.timeout
+    last = args.since
+    while True:
+        state = next_state(args.exec_dir, last, deadline, args.interval)
+        if state != last:
+            print(state, flush=True)
+            last = state
+        if state.split(" ", 1)[0] in TERMINAL_STATUSES or time.monotonic() >= deadline:
+            return 0
+
+def parse_range(spec: str):
+    "START:END, either of which may be left out, as a (start, end or None) pair."
+    start, sep, end = spec.partition(":")
+    if not sep:
+        raise argparse.ArgumentTypeError(f"expected START:END, not {spec!r}")
+    return int(start or 0), int(end) if end else None
+
+def query_log(path: str, byte_range=None, line_range=None, level: Optional[str] = None,
+              steps=(), patterns=(), ignore_case=False, tail: Optional[int] = None):
+    """
+    Yield the lines (as bytes) of the log at `path` that the query selects:
+    those in the byte and line ranges, of records at `level` or above, logged
+    by one of `steps`, and matching one of `patterns`, as any are given. With
+    `tail`, only the last that many. The log is read a line at a time, so
+    the query costs memory for the tail at most. The line range counts from
+    the start of the byte range, so that the bytes before it aren't read.
+    """
+    import collections
+    import re
+
+    record_start = re.compile(LOG_RECORD.encode())
+    flags = re.IGNORECASE if ignore_case else 0
+    patterns = [re.compile(p.encode(), flags) for p in patterns]
+    min_level = LOG_LEVELS[level] if level else 0
+    steps = set(steps)
+    first_line, last_line = line_range or (0, None)
+    record_level, record_steps = 0, set()
+
+    def selected(lines):
+        nonlocal record_level, record_steps
+        for n, line in enumerate(lines):
+            if last_line is not None and n >= last_line:
+                return
+            m = record_start.match(line)
+            if m:
+                record_level = LOG_LEVELS.get(m.group(1).decode(), 0)
+                record_steps = set()
+                if m.group(2):
+                    first = int(m.group(2))
+                    record_steps = set(range(first, int(m.group(3) or first) + 1))
+            if n < first_line or record_level < min_level:
+                continue
+            if steps and not steps & record_steps:
+                continue
+            if patterns and not any(p.search(line) for p in patterns):
+                continue
+            yield line
+
+    def up_to(lines, remaining: int):
+        for line in lines:
+            if remaining <= 0:
+                return
+            yield line[:remaining]
+            remaining -= len(line)
+
+    with open(path, "rb") as f:
+        lines = f
+        if byte_range:
+            start, end = byte_range
+            f.seek(start)
+            if end is not None:
+                lines = up_to(f, end - start)
+        if tail is None:
+            yield from selected(lines)
+        else:
+            yield from collections.deque(selected(lines), maxlen=tail)
+
+def log_query(args):
+    """
+    Run a log query here, by the host, so only the lines wanted (compressed,
+    with --codec gz) cross the network.
+    """
+    path = os.path.join(args.exec_dir, LOG_FILE)
+    if not os.path.exists(path):
+        print(f"no log at {path}", file=sys.stderr)
+        return 1
+    out = sys.stdout.buffer
+    if args.codec == "gz":
+        import gzip
+        out = gzip.GzipFile(fileobj=sys.stdout.buffer, mode="wb", mtime=0)
+    lines = query_log(path, args.bytes, args.lines, args.level, args.steps, args.patterns,
+                      args.ignore_case, args.tail)
+    for line in lines:
+        out.write(line)
+    if out is not sys.stdout.buffer:
+        out.close()
+    sys.stdout.buffer.flush()
+    return 0
+
+# Agent frames are a 4 byte big-endian length, then that many bytes of JSON.
+FRAME_HEADER = struct.Struct(">I")
+
+# About the most log an agent sends in one reply.
+LOG_CHUNK = 1 << 20
+
+def write_frame(stream, obj):
+    data = json.dumps(obj).encode()
+    stream.write(FRAME_HEADER.pack(len(data)) + data)
+    stream.flush()
+
+def _read_exactly(stream, size: int) -> bytes:
+    data = b""
+    while len(data) < size:
+        chunk = stream.read(size - len(data))
+        if not chunk:
+            raise EOFError("stream ended mid-frame")
+        data += chunk
+    return data
+
+def read_frame(stream) -> Optional[dict]:
+    "The next frame from the stream, or None at a clean end of stream."
+    header = stream.read(FRAME_HEADER.size)
+    if not header:
+        return None
+    header += _read_exactly(stream, FRAME_HEADER.size - len(header))
+    (size,) = FRAME_HEADER.unpack(header)
+    return json.loads(_read_exactly(stream, size).decode())
+
+class Agent:
+    """
+    Answers framed requests from the orchestrator about the executions under
+    one run root, so a fleet query costs a frame on an open channel rather
+    than a new channel and a shell. Each request is {"id", "op", ...params}
+    and gets {"id", "ok", "result"} or {"id", "ok", "error"}. Requests are
+    handled on their own threads, so a slow one (exec, poll) doesn't hold up
+    the rest; replies come back in completion order.
+    """
+    def __init__(self, run_root: str, out):
+        self.run_root = os.path.abspath(run_root)
+        self.out = out
+        self.lock = threading.Lock()
+
+    def serve(self, inp):
+        while True:
+            req = read_frame(inp)
+            if req is None:
+                return
+            threading.Thread(target=self.handle, args=(req,)).start()
+
+    def handle(self, req: dict):
+        try:
+            op = getattr(self, "op_" + req["op"], None)
+            if op is None:
+                raise ValueError(f"unknown op {req['op']!r}")
+            reply = {"id": req["id"], "ok": True, "result": op(req)}
+        except Exception as e:
+            reply = {"id": req["id"], "ok": False, "error": f"{type(e).__name__}: {e}"}
+        with self.lock:
+            write_frame(self.out, reply)
+
+    def _exec_dir(self, req: dict) -> str:
+        # Only ever touch executions under our run root.
+        exec_dir = os.path.abspath(req["exec_dir"])
+        if os.path.dirname(exec_dir) != self.run_root:
+            raise ValueError(f"{exec_dir} isn't an execution under {self.run_root}")
+        return exec_dir
+
+    def op_ping(self, req):
+        return "pong"
+
+    def op_status(self, req):
+        status, step = read_state(self._exec_dir(req)).split(" ", 1)
+        return {"status": status, "step": step}
+
+    def op_poll(self, req):
+        deadline = time.monotonic() + req.get("timeout", 60)
+        return next_state(self._exec_dir(req), req.get("since", ""), deadline)
+
+    def op_log(self, req):
+        """
+        The lines a log query (query_log's keyword arguments, as `query`)
+        selects, from the `skip`th on and up to about LOG_CHUNK bytes of
+        them, and whether there are more. The query runs again from the start
+        for each further chunk, which the few that select that much can
+        afford. Lines travel as latin-1 strings, which JSON can carry and
+        which map back to the bytes exactly.
+        """
+        path = os.path.join(self._exec_dir(req), LOG_FILE)
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"no log at {path}")
+        lines, size = [], 0
+        for line in itertools.islice(query_log(path, **req.get("query", {})), req.get("skip", 0), None):
+            if size >= LOG_CHUNK:
+                return {"lines": lines, "more": True}
+            lines.append(line.decode("latin-1"))
+            size += len(line)
+        return {"lines": lines, "more": False}
+
+    def op_trace(self, req):
+        try:
+            with open(os.path.join(self._exec_dir(req), TRACE_FILE)) as f:
+                return parse_trace(f)
+        except FileNotFoundError:
+            return []
+
+    def op_clean(self, req):
+        import shutil
+
+        shutil.rmtree(self._exec_dir(req), ignore_errors=True)
+
+    def op_check(self, req):
+        import subprocess
+
+        exec_dir = self._exec_dir(req)
+        argv = [sys.executable, req["runtime"], "check", os.path.join(exec_dir, "config")]
+        argv += ["--mark-done"] if req.get("mark_done") else []
+        proc = subprocess.run(argv, cwd=exec_dir, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if proc.returncode != 0:
+            raise Exception(f"check failed with code {proc.returncode}: stderr={proc.stderr.decode()}")
+        return proc.stdout.decode().strip()
+
+    def op_exec(self, req):
+        """
+        Unpack the named archive (if any) and run the config with the
+        execution's runtime, as HostRunner.execute does over a shell.
+        """
+        import subprocess
+
+        exec_dir = self._exec_dir(req)
+        runtime = [sys.executable, req["runtime"]]
+        if req.get("archive"):
+            subprocess.run(runtime + ["init", req["archive"], "--sha256", req["sha256"]],
+                           cwd=exec_dir, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        argv = runtime + ["exec", os.path.join(exec_dir, "config")]
+        argv += ["--detach"] if req.get("detach") else []
+        argv += ["--resume"] if req.get("resume") else []
+        proc = subprocess.run(argv, cwd=exec_dir, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if proc.returncode != 0:
+            raise Exception(f"exec failed with code {proc.returncode}: stderr={proc.stderr.decode()}")
+        return proc.stdout.decode().strip()
+
+def agent(args):
+    """
+    Serve framed requests on stdin until it closes. Our stdout is the reply
+    channel, so anything else that wants to print goes to stderr.
+    """
+    out = sys.stdout.buffer
+    sys.stdout = sys.stderr
+    Agent(args.run_root, out).serve(sys.stdin.buffer)
+    return 0
+
+def load_config(config_dir: str, config_module: str):
+    "Import the config module from an unpacked config dir."
+    import pathlib
 
-def exec_config(args):
-    config_dir = args.config_dir.rstrip("/")
     config_abs = os.path.abspath(config_dir)
-    exec_dir = os.path.dirname(config_abs)
 
     # Make config/__cattle__.py importable:
     sys.path.append(os.path.dirname(config_abs))
@@ -125,8 +1256,8 @@ def exec_config(args):
     except FileNotFoundError:
         pass
 
-    config_pkg = os.path.basename(config_dir)
-    mod = f"{config_pkg}.{args.config_module}"
+    config_pkg = os.path.basename(config_abs)
+    mod = f"{config_pkg}.{config_module}"
     if mod.endswith(".py"):
         mod = mod[:-3]
 
@@ -140,35 +1271,106 @@ def exec_config(args):
     assert "facility" in sys.modules
     sys.modules["cattle.facility"] = sys.modules["facility"]
 
+    return importlib.import_module(mod)
+
+# Characters of a check vector: the step has nothing to do, it would run, or
+# its should_run failed.
+CHECK_CLEAN = "0"
+CHECK_PENDING = "1"
+CHECK_FAILED = "?"
+
+def check_config(cfg) -> str:
+    """
+    Evaluate every step's should_run, without running anything, and return a
+    vector with a character per step: CHECK_CLEAN, CHECK_PENDING or
+    CHECK_FAILED. Each step is judged against the host as it is now, not as it
+    would be once the steps before it had run.
+    """
+    vector = []
+    for i, step in enumerate(cfg.steps, 1):
+        should_run = getattr(step, "should_run", lambda: True)
+        try:
+            vector.append(CHECK_PENDING if should_run() else CHECK_CLEAN)
+        except Exception as e:
+            print(f"step {i}: should_run failed: {e}", file=sys.stderr)
+            vector.append(CHECK_FAILED)
+    return "".join(vector)
+
+def check(args):
+    """
+    Print the config's check vector. With --mark-done, an execution with
+    nothing to do is marked DONE, as though it had run.
+    """
+    try:
+        config_module = load_config(args.config_dir.rstrip("/"), args.config_module)
+    except ModuleNotFoundError as e:
+        print(f"couldn't load config: {e}", file=sys.stderr)
+        return 1
+    vector = check_config(config_module)
+    if args.mark_done and set(vector) <= {CHECK_CLEAN}:
+        exec_dir = os.path.dirname(os.path.abspath(args.config_dir.rstrip("/")))
+        rewrite_status(os.path.join(exec_dir, STATUS_FILE), STATUS_DONE)
+    print(vector)
+    return 0
+
+def exec_config(args):
+    config_dir = args.config_dir.rstrip("/")
+    exec_dir = os.path.dirname(os.path.abspath(config_dir))
+
     try:
-        config_module = importlib.import_module(mod)
+        config_module = load_config(config_dir, args.config_module)
     except ModuleNotFoundError as e:
         print(f"couldn't load config: {e}", file=sys.stderr)
         return 1
 
-    log_file = os.path.join(exec_dir, "exec.log")
-    status_file = os.path.join(exec_dir, "STATUS")
+    log_file = os.path.join(exec_dir, LOG_FILE)
+    status_file = os.path.join(exec_dir, STATUS_FILE)
+
+    # Recorded first, so there's never a PROGRESS without a live pid. (A
+    # detached run's daemon replaces it with its own.)
+    rewrite_file(os.path.join(exec_dir, PID_FILE), str(os.getpid()))
+    rewrite_status(status_file, STATUS_PROGRESS)
+
+    if args.detach:
+        try:
+            if not daemonize(exec_dir):
+                return 0
+        except OSError as e:
+            rewrite_status(status_file, STATUS_ERROR)
+            print(e, file=sys.stderr)
+            return 1
 
     logging.basicConfig(
         filename=log_file,
         level=logging.INFO,
-        format='%(asctime)s %(levelname)s %(message)s',
+        format=LOG_FORMAT,
     )
+    for handler in logging.getLogger().handlers:
+        handler.addFilter(tag_step)
 
     logging.info("running execution at path %s", exec_dir)
 
-    rewrite_status(status_file, STATUS_PROGRESS)
-
+    trace = None
     try:
         if args.dry_run:
             dry_run_config(config_module)
         else:
-            run_config(config_module)
+            trace = Trace(os.path.join(exec_dir, TRACE_FILE))
+            run_config(
+                config_module,
+                os.path.join(exec_dir, STEP_FILE),
+                trace,
+                Journal(os.path.join(exec_dir, JOURNAL_FILE)),
+                args.resume,
+            )
     except:
         # An unrecoverable error after performing retries.
         rewrite_status(status_file, STATUS_ERROR)
     else:
         rewrite_status(status_file, STATUS_DONE)
+    finally:
+        if trace is not None:
+            trace.close()
 
     return 0
 
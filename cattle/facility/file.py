@@ -1,6 +1,162 @@
-import filecmp
+import concurrent.futures
+import errno
+import hashlib
+import json
 import os
 import shutil
+import stat
+import threading
+
+# Written into the root of each config archive: the size and sha256 of every
+# file in the config, keyed by path relative to that root.
+MANIFEST_NAME = ".cattle-manifest.json"
+
+# How many files SyncTree compares or copies at once.
+DEFAULT_SYNC_WORKERS = 8
+
+# renameat2's flag for swapping two paths in one step (Linux 3.15+).
+RENAME_EXCHANGE = 2
+
+# Extended attribute InstallFile leaves on files it installs, recording the
+# digest along with the inode, size and mtime it was valid for.
+STAMP_XATTR = "user.cattle.sha256"
+
+_manifests = {}
+_manifests_lock = threading.Lock()
+
+def _digest_file(path) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def _load_manifest(root):
+    with _manifests_lock:
+        if root not in _manifests:
+            try:
+                with open(os.path.join(root, MANIFEST_NAME)) as f:
+                    _manifests[root] = json.load(f)["files"]
+            except (FileNotFoundError, ValueError, KeyError):
+                _manifests[root] = None
+        return _manifests[root]
+
+def _manifest_root(d: str):
+    "The nearest directory at or above d with a manifest, or None."
+    while True:
+        if os.path.exists(os.path.join(d, MANIFEST_NAME)):
+            return d
+        parent = os.path.dirname(d)
+        if parent == d:
+            return None
+        d = parent
+
+def _manifest_digest(root, path: str, size: int) -> str:
+    "path's digest from the manifest at root (if any, and if it's current), else by reading it."
+    if root is not None:
+        entry = (_load_manifest(root) or {}).get(os.path.relpath(path, root).replace(os.sep, "/"))
+        if entry is not None and entry["size"] == size:
+            return entry["sha256"]
+    return _digest_file(path)
+
+def source_digest(path: str) -> str:
+    """
+    The sha256 of a file shipped in the config, from the config's manifest
+    when it has one, otherwise by reading the file.
+    """
+    path = os.path.abspath(path)
+    return _manifest_digest(_manifest_root(os.path.dirname(path)), path, os.stat(path).st_size)
+
+def _stamp(st: os.stat_result) -> str:
+    return f"{st.st_ino}:{st.st_size}:{st.st_mtime_ns}"
+
+def installed_digest(path: str, st: os.stat_result) -> str:
+    """
+    The sha256 of an installed file: free if InstallFile stamped it and it
+    hasn't changed since, otherwise by reading it.
+    """
+    try:
+        digest, stamp = os.getxattr(path, STAMP_XATTR).decode().split("/", 1)
+        if stamp == _stamp(st):
+            return digest
+    except (AttributeError, OSError, ValueError):
+        pass
+    return _digest_file(path)
+
+def _stamp_installed(path: str, digest: str):
+    try:
+        os.setxattr(path, STAMP_XATTR, f"{digest}/{_stamp(os.stat(path))}".encode())
+    except (AttributeError, OSError):
+        pass # No xattr support here; we'll just hash next time.
+
+def _copy_contents(src_fd: int, dst_fd: int, size: int):
+    """
+    Copy with the kernel doing the work where it can: copy_file_range, then
+    sendfile, then plain reads and writes.
+    """
+    offset = 0
+    copy_range = getattr(os, "copy_file_range", None)
+    if copy_range is not None:
+        try:
+            while offset < size:
+                n = copy_range(src_fd, dst_fd, size - offset, offset, offset)
+                if n == 0:
+                    return
+                offset += n
+            return
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                raise
+    os.lseek(dst_fd, offset, os.SEEK_SET)
+    try:
+        while offset < size:
+            n = os.sendfile(dst_fd, src_fd, offset, size - offset)
+            if n == 0:
+                return
+            offset += n
+        return
+    except (AttributeError, OSError):
+        pass
+    os.lseek(src_fd, offset, os.SEEK_SET)
+    os.lseek(dst_fd, offset, os.SEEK_SET)
+    while True:
+        chunk = os.read(src_fd, 1 << 20)
+        if not chunk:
+            return
+        os.write(dst_fd, chunk)
+
+def atomic_install(src: str, dest: str, digest: str = None):
+    """
+    Copy src over dest so readers only ever see the old file or the new one:
+    copy to a temp file alongside dest, fsync it, and rename it into place.
+    An existing dest's mode and (where we're allowed) ownership carry over.
+    """
+    tmp = os.path.join(os.path.dirname(dest), f".{os.path.basename(dest)}.cattle-{os.urandom(4).hex()}")
+    try:
+        existing = os.stat(dest)
+    except FileNotFoundError:
+        existing = None
+    with open(src, "rb") as s:
+        # 0o666 less the umask, like a plain open() would give.
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+        try:
+            try:
+                _copy_contents(s.fileno(), fd, os.fstat(s.fileno()).st_size)
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            if existing is not None:
+                os.chmod(tmp, existing.st_mode & 0o7777)
+                try:
+                    os.chown(tmp, existing.st_uid, existing.st_gid)
+                except PermissionError:
+                    pass
+            os.replace(tmp, dest)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+    if digest is not None:
+        _stamp_installed(dest, digest)
 
 class Chmod:
     def __init__(self, path, mode):
@@ -55,19 +211,220 @@ class InstallFile:
 
     def should_run(self):
         # InstallFile should run only if there isn't an identical file already
-        # at the destination path.
-        filecmp.clear_cache()
+        # at the destination path. A size mismatch settles it without reading
+        # anything; otherwise compare digests.
         try:
-            return not filecmp.cmp(self.sourcepath, self.destpath, shallow=False)
+            st = os.stat(self.destpath)
         except FileNotFoundError:
             return True
+        if st.st_size != os.stat(self.sourcepath).st_size:
+            return True
+        return installed_digest(self.destpath, st) != source_digest(self.sourcepath)
 
     def run(self):
-        shutil.copyfile(self.sourcepath, self.destpath)
+        atomic_install(self.sourcepath, self.destpath, source_digest(self.sourcepath))
 
     def desc(self):
         return f"install file {self.destpath}"
 
+def _exchange(a: str, b: str) -> bool:
+    """
+    Swap the paths a and b atomically, if the platform can (Linux's
+    renameat2), returning whether it did.
+    """
+    import ctypes
+
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        renameat2 = libc.renameat2
+    except (OSError, AttributeError):
+        return False
+    at_fdcwd = -100
+    if renameat2(at_fdcwd, os.fsencode(a), at_fdcwd, os.fsencode(b), RENAME_EXCHANGE) == 0:
+        return True
+    if ctypes.get_errno() in (errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+        return False
+    raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()), a)
+
+class SyncTree:
+    def __init__(self, source_dir, dest_dir, delete=False, atomic=False, workers: int = DEFAULT_SYNC_WORKERS):
+        """
+        Make dest_dir's files match source_dir's, copying only the ones that
+        differ, `workers` at a time. Source digests come from the config's
+        manifest and installed ones from the stamps atomic_install leaves, so
+        an unchanged tree is compared without reading it. With `delete`,
+        files under dest_dir that aren't in source_dir go, symlinks (to files
+        or directories) included. With `atomic`, the new tree is built
+        alongside (linking unchanged files) and swapped in all at once where
+        the platform allows, else renamed in. Only source_dir's regular files
+        are synced: symlinks under it are skipped, and not followed.
+        >>> SyncTree(os.path.join(os.path.dirname(__file__), "static"), "/var/www/static", delete=True)
+        """
+        self.source_dir = source_dir
+        self.dest_dir = dest_dir
+        self.delete = delete
+        self.atomic = atomic
+        self.workers = workers
+        self._plan = None
+
+    def _source_files(self):
+        "relpath -> (size, digest) for each file under source_dir."
+        root = _manifest_root(os.path.abspath(self.source_dir))
+        sizes = {}
+        for d, dirs, files in os.walk(self.source_dir):
+            dirs.sort()
+            for name in sorted(files):
+                path = os.path.join(d, name)
+                st = os.lstat(path)
+                if name != MANIFEST_NAME and stat.S_ISREG(st.st_mode):
+                    sizes[os.path.relpath(path, self.source_dir)] = st.st_size
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+            digests = executor.map(
+                lambda relpath: _manifest_digest(
+                    root, os.path.abspath(os.path.join(self.source_dir, relpath)), sizes[relpath]),
+                sizes,
+            )
+            return {relpath: (sizes[relpath], digest) for relpath, digest in zip(sizes, digests)}
+
+    def _dest_files(self):
+        "The relpaths of the files and symlinks (to directories too) under dest_dir."
+        found = set()
+        for d, dirs, files in os.walk(self.dest_dir):
+            links = [name for name in dirs if os.path.islink(os.path.join(d, name))]
+            found.update(os.path.relpath(os.path.join(d, name), self.dest_dir) for name in files + links)
+        return found
+
+    def plan(self):
+        """
+        (changed, extraneous): the source files to copy, as {relpath:
+        digest}, and the dest files to delete (if we're deleting).
+        """
+        if not os.path.isdir(self.source_dir):
+            # (Else it's an empty tree, and with delete, dest_dir is emptied.)
+            raise NotADirectoryError(errno.ENOTDIR, "nothing to sync from", self.source_dir)
+        source = self._source_files()
+        extraneous = sorted(self._dest_files() - set(source)) if self.delete else []
+        # Symlinked directories that are going, with whatever's through them.
+        going = set(extraneous)
+
+        def changed(relpath):
+            d = os.path.dirname(relpath)
+            while d:
+                if d in going:
+                    return True
+                d = os.path.dirname(d)
+            size, digest = source[relpath]
+            path = os.path.join(self.dest_dir, relpath)
+            try:
+                st = os.lstat(path)
+            except (FileNotFoundError, NotADirectoryError):
+                return True
+            if not stat.S_ISREG(st.st_mode) or st.st_size != size:
+                return True
+            return installed_digest(path, st) != digest
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+            flags = list(executor.map(changed, source))
+        to_copy = {relpath: source[relpath][1] for relpath, flag in zip(source, flags) if flag}
+        return to_copy, extraneous
+
+    def should_run(self):
+        self._plan = self.plan()
+        return any(self._plan)
+
+    def run(self):
+        to_copy, extraneous = self._plan if self._plan is not None else self.plan()
+        self._plan = None
+        if self.atomic:
+            self._swap_in(to_copy, set(extraneous))
+            return
+        # Deleting first, so nothing is copied through a symlinked directory
+        # that's going.
+        for relpath in extraneous:
+            os.unlink(os.path.join(self.dest_dir, relpath))
+        self._prune(extraneous, self.dest_dir)
+        for relpath in to_copy:
+            os.makedirs(os.path.dirname(os.path.join(self.dest_dir, relpath)), exist_ok=True)
+        self._copy(to_copy, self.dest_dir)
+
+    def _copy(self, to_copy, dest_root: str):
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+            list(executor.map(
+                lambda relpath: atomic_install(
+                    os.path.join(self.source_dir, relpath), os.path.join(dest_root, relpath), to_copy[relpath]),
+                to_copy,
+            ))
+
+    @staticmethod
+    def _prune(deleted, root: str):
+        "Remove the directories under root that deleting left empty, deepest first."
+        dirs = {os.path.dirname(relpath) for relpath in deleted}
+        for d in sorted((d for d in dirs if d), key=lambda d: -d.count(os.sep)):
+            while d:
+                try:
+                    os.rmdir(os.path.join(root, d))
+                except OSError:
+                    break
+                d = os.path.dirname(d)
+
+    def _swap_in(self, to_copy, extraneous):
+        """
+        Build the new tree beside dest_dir: the old tree's files hard linked
+        in (less the extraneous ones), then the changed ones installed over
+        their links, so they keep the old files' modes. Then swap it for the
+        old one.
+        """
+        dest = os.path.abspath(self.dest_dir)
+        staging = f"{dest}.cattle-{os.urandom(4).hex()}"
+        os.makedirs(staging)
+        try:
+            if os.path.isdir(dest):
+                shutil.copymode(dest, staging)
+                for d, dirs, files in os.walk(dest):
+                    rel = os.path.relpath(d, dest)
+                    for name in dirs:
+                        if os.path.islink(os.path.join(d, name)):
+                            if os.path.normpath(os.path.join(rel, name)) not in extraneous:
+                                self._link(os.path.join(d, name), os.path.join(staging, rel, name))
+                            continue
+                        os.makedirs(os.path.join(staging, rel, name), exist_ok=True)
+                        shutil.copymode(os.path.join(d, name), os.path.join(staging, rel, name))
+                    for name in files:
+                        relpath = os.path.normpath(os.path.join(rel, name))
+                        if relpath not in extraneous:
+                            self._link(os.path.join(d, name), os.path.join(staging, relpath))
+                self._prune(extraneous, staging)
+            for relpath in to_copy:
+                os.makedirs(os.path.dirname(os.path.join(staging, relpath)), exist_ok=True)
+            self._copy(to_copy, staging)
+            if os.path.isdir(dest) and _exchange(staging, dest):
+                shutil.rmtree(staging)
+                return
+            # (No exchange here: there's a moment with no dest_dir at all.)
+            old = f"{dest}.cattle-old-{os.urandom(4).hex()}"
+            if os.path.isdir(dest):
+                os.rename(dest, old)
+            os.rename(staging, dest)
+            shutil.rmtree(old, ignore_errors=True)
+        except BaseException:
+            shutil.rmtree(staging, ignore_errors=True)
+            raise
+
+    @staticmethod
+    def _link(src: str, dest: str):
+        if os.path.islink(src):
+            os.symlink(os.readlink(src), dest)
+            return
+        try:
+            os.link(src, dest)
+        except OSError:
+            # (Say, protected_hardlinks and a file we don't own.)
+            shutil.copy2(src, dest)
+
+    def desc(self):
+        flags = "".join([" (deleting extraneous files)" if self.delete else "", " (atomic swap)" if self.atomic else ""])
+        return f"sync tree {self.dest_dir} from {self.source_dir}{flags}"
+
 class Symlink:
     def __init__(self, source, dest):
         self.source = source
@@ -0,0 +1,84 @@
+"""
+Annotations for how the runner treats steps: scheduling and retries.
+
+A config's steps run one after another until any step declares resources or
+dependencies. From then on the runner treats the steps as a graph, running
+independent ones concurrently (up to the config's `max_workers`, if set):
+
+* A step waits for the steps in its `depends_on`, which must come earlier.
+* A step waits for the last earlier step declaring any of the same
+  `resources`: paths, package names, service names, whatever keys you like.
+* A step declaring neither is a barrier: it waits for everything before it,
+  and everything after it waits for it.
+"""
+
+import contextlib
+import random
+import threading
+import time
+from typing import Optional
+
+# Each thread's current attempt deadline is kept as this attribute of the
+# thread. (Not in a threading.local: this module can be loaded twice, as
+# facility.step and cattle.facility.step, and each copy would have its own.)
+_DEADLINE_ATTR = "cattle_attempt_deadline"
+
+def declare(step, resources=(), depends_on=()):
+    """
+    Annotate a step for the graph scheduler, and return it.
+    >>> declare(InstallFile("a.conf", "/etc/a.conf"), resources={"/etc/a.conf"})
+    """
+    step.resources = set(resources)
+    step.depends_on = list(depends_on)
+    return step
+
+def attempt_timeout() -> Optional[float]:
+    """
+    Seconds left before the current attempt's RetryPolicy timeout, or None if
+    it hasn't one. The runner can't stop a step's Python code, so steps pass
+    this on to what they wait for, such as subprocess's `timeout=`, which
+    kills an overdue command.
+    >>> subprocess.run(["apt-get", "update"], check=True, timeout=attempt_timeout())
+    """
+    deadline = getattr(threading.current_thread(), _DEADLINE_ATTR, None)
+    return None if deadline is None else max(0.0, deadline - time.monotonic())
+
+@contextlib.contextmanager
+def attempt_deadline(timeout: Optional[float]):
+    "Run the block as an attempt limited to `timeout` seconds (see attempt_timeout)."
+    thread = threading.current_thread()
+    setattr(thread, _DEADLINE_ATTR, None if timeout is None else time.monotonic() + timeout)
+    try:
+        yield
+    finally:
+        setattr(thread, _DEADLINE_ATTR, None)
+
+class RetryPolicy:
+    def __init__(self, attempts=3, backoff_base=0.5, backoff_cap=30.0, jitter=True, timeout=None):
+        """
+        How a failing step is retried: up to `attempts` tries, each limited to
+        `timeout` seconds (which the step enforces: see attempt_timeout), with
+        exponential backoff between them. The n-th
+        retry waits up to min(backoff_cap, backoff_base * 2**(n-1)) seconds;
+        with jitter, a uniformly random slice of that, so a fleet of hosts
+        failing together doesn't retry together.
+
+        The runner uses a step's `retry_policy` attribute if it has one (as an
+        instance or class attribute), then the config's `retry_policy`, then
+        the default.
+        >>> RetryPolicy(attempts=5, backoff_base=2, timeout=300)
+        """
+        self.attempts = attempts
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.jitter = jitter
+        self.timeout = timeout
+
+    def delay(self, n: int) -> float:
+        "Seconds to wait after the n-th failed attempt."
+        ceiling = min(self.backoff_cap, self.backoff_base * 2 ** (n - 1))
+        return random.uniform(0, ceiling) if self.jitter else ceiling
+
+    def __repr__(self):
+        return (f"RetryPolicy(attempts={self.attempts}, backoff_base={self.backoff_base}, "
+                f"backoff_cap={self.backoff_cap}, jitter={self.jitter}, timeout={self.timeout})")
@@ -2,28 +2,112 @@
 Facilities related to Linux system stuff. Packages, systemd services, etc.
 """
 
+import glob
+import os
 import subprocess
+import time
 from typing import List
 
+from .step import RetryPolicy, attempt_timeout
+
+# Where apt keeps its package index. Each refresh rewrites the repositories'
+# Release files there, whatever else it leaves alone.
+APT_LISTS_DIR = "/var/lib/apt/lists"
+# Touched by apt's periodic (unattended) updates when they succeed.
+APT_UPDATE_STAMP = "/var/lib/apt/periodic/update-success-stamp"
+
+# Skip `apt-get update` when the index is younger than this many seconds.
+DEFAULT_INDEX_MAX_AGE = 60 * 60
+
 class InstallDebPackages:
-    def __init__(self, packages: List[str]):
+    # Back off well clear of each other when a mirror is struggling.
+    retry_policy = RetryPolicy(attempts=5, backoff_base=2.0, backoff_cap=60.0, timeout=30 * 60)
+
+    def __init__(self, packages: List[str], max_index_age: float = DEFAULT_INDEX_MAX_AGE):
+        """
+        Install deb packages, refreshing the package index only when it's
+        older than max_index_age seconds. Packages may be pinned as
+        "name=version".
+        >>> InstallDebPackages(["nginx", "curl=7.81.0-1ubuntu1.15"])
+        """
         if isinstance(packages, str):
             packages = [packages]
         self.packages = packages
+        self.max_index_age = max_index_age
+        self.force_refresh = False
 
     def should_run(self):
-        return True # It's naively idempotent.
+        # Only run if something's missing or at the wrong version.
+        wanted = dict(p.split("=", 1) if "=" in p else (p, None) for p in self.packages)
+        try:
+            proc = subprocess.run(
+                ["dpkg-query", "-W", "-f=${Package} ${Version} ${Status}\n"] + list(wanted),
+                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+            )
+        except FileNotFoundError:
+            return True
+        installed = {}
+        for line in proc.stdout.decode().splitlines():
+            name, version, status = line.split(" ", 2)
+            if status == "install ok installed":
+                installed[name.split(":")[0]] = version
+        return any(
+            name not in installed or (version is not None and installed[name] != version)
+            for name, version in wanted.items()
+        )
+
+    def index_is_fresh(self):
+        # (Not the lists dir's own mtime: that only changes when a file in it
+        # is added or removed.)
+        refreshed = None
+        paths = glob.glob(os.path.join(APT_LISTS_DIR, "*_InRelease"))
+        paths += glob.glob(os.path.join(APT_LISTS_DIR, "*_Release"))
+        for path in paths + [APT_UPDATE_STAMP]:
+            try:
+                mtime = os.stat(path).st_mtime
+            except FileNotFoundError:
+                continue
+            refreshed = mtime if refreshed is None else max(refreshed, mtime)
+        return refreshed is not None and time.time() - refreshed < self.max_index_age
 
     def run(self):
-        subprocess.run(["apt-get", "update", "-y"], check=True)
-        subprocess.run(["apt-get", "install", "-y"] + self.packages, check=True)
+        if self.force_refresh or not self.index_is_fresh():
+            subprocess.run(["apt-get", "update", "-y"], check=True, timeout=attempt_timeout())
+        try:
+            subprocess.run(["apt-get", "install", "-y"] + self.packages, check=True, timeout=attempt_timeout())
+        except (subprocess.CalledProcessError, subprocess.TimeoutExpired):
+            # Maybe the index is stale after all; refresh it on the retry.
+            self.force_refresh = True
+            raise
+
+    def merge(self, other: "InstallDebPackages") -> "InstallDebPackages":
+        """
+        Combine with the next package step, so consecutive package steps cost
+        one index refresh and one install transaction. A package named in both
+        takes whichever pin either gives it; if they pin it to different
+        versions, the steps stay apart (None).
+        """
+        pins = {}
+        for spec in self.packages + other.packages:
+            name, _, version = spec.partition("=")
+            pinned = pins.get(name)
+            if pinned and version and pinned != version:
+                return None
+            pins[name] = pinned or version
+        packages = [f"{name}={version}" if version else name for name, version in pins.items()]
+        return InstallDebPackages(packages, min(self.max_index_age, other.max_index_age))
 
     def desc(self):
-        return f"apt-get update && apt-get install -y {' '.join(self.packages)}"
+        return f"apt-get install -y {' '.join(self.packages)} (refreshing an index older than {self.max_index_age}s)"
 
 class RestartSystemdService:
-    def __init__(self, service):
+    def __init__(self, service, timeout: float = 5 * 60):
+        """
+        Restart a systemd service, giving up on a restart that takes longer
+        than `timeout` seconds.
+        """
         self.service = service
+        self.timeout = timeout
 
     def should_run(self):
         return True
@@ -31,8 +115,13 @@ class RestartSystemdService:
     def run(self):
         # Unmask first, as the service could be masked and unstartable from
         # prior events.
-        subprocess.run(["systemctl", "unmask", self.service], check=False)
-        subprocess.run(["systemctl", "restart", self.service], check=True)
+        subprocess.run(["systemctl", "unmask", self.service], check=False, timeout=self._timeout())
+        subprocess.run(["systemctl", "restart", self.service], check=True, timeout=self._timeout())
+
+    def _timeout(self) -> float:
+        "Our own timeout, or what's left of the attempt's, whichever's sooner."
+        left = attempt_timeout()
+        return self.timeout if left is None else min(self.timeout, left)
 
     def desc(self):
         return f"systemctl unmask {self.service} && systemctl restart {self.service}"
@@ -1,7 +1,69 @@
+import concurrent.futures
+import contextlib
+import errno
+import glob
+import hashlib
+import importlib.util
+import io
+import itertools
+import json
 import os
+import shlex
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
+from unittest import mock
+import zipfile
 
-from cattle.cattle_cli import main_args_inner
+import paramiko
+
+from cattle import cattle_cli, cattle_remote
+from cattle.facility.file import InstallFile, SyncTree
+from cattle.facility.step import RetryPolicy, attempt_timeout, declare
+from cattle.facility.system import InstallDebPackages
+from cattle.cattle_cli import (
+    AdaptiveConcurrency, ConnectionPool, HostRunner, KnownHosts, LocalHostConduit, RemoteHostConduit, choose_codec,
+    config_entries, fan_out_artifacts, main_args_inner, make_archive, make_artifact, make_executable, map_runners,
+)
+
+_registry_dir = None
+
+def setUpModule():
+    # Keep the tests' executions out of the user's own registry.
+    global _registry_dir
+    _registry_dir = tempfile.TemporaryDirectory()
+    os.environ["CATTLE_REGISTRY"] = os.path.join(_registry_dir.name, "registry.sqlite3")
+
+def tearDownModule():
+    del os.environ["CATTLE_REGISTRY"]
+    _registry_dir.cleanup()
+
+FLAKY_CONFIG = os.path.join(os.path.dirname(os.path.dirname(__file__)), "example/flaky")
+TEST_RUN_ROOT = "/tmp/cattle-test-run"
+
+# The CLI imports a config by its dir's name, and a name it's seen before
+# gets it the config it imported then, so each test config gets a new one.
+_config_names = itertools.count()
+
+def write_config(root: str, steps_src: str, files=None) -> str:
+    """
+    Write a config dir under root, with steps_src as its __cattle__.py and
+    `files` (relpath -> str or bytes) beside it. Returns its path.
+    """
+    cfg = os.path.join(root, f"cfg{next(_config_names)}")
+    for relpath, content in {**(files or {}), "__cattle__.py": steps_src}.items():
+        path = os.path.join(cfg, relpath)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb" if isinstance(content, bytes) else "w") as f:
+            f.write(content)
+    return cfg
+
+def run_local(argv, run_root: str = TEST_RUN_ROOT) -> cattle_cli.ExecResult:
+    "Run a cattle subcommand against this machine, under run_root."
+    return main_args_inner(argv + ["--local", "--run-root", run_root])
 
 class TestCLI(unittest.TestCase):
     def test_run_local_suite(self):
@@ -9,21 +71,1076 @@ class TestCLI(unittest.TestCase):
         Run the full cycle of exec/status/log/clean against the local fs.
         Definitely an integration test.
         """
-        run_root = "/tmp/cattle-test-run"
-        test_config = os.path.join(os.path.dirname(os.path.dirname(__file__)), "example/flaky")
+        proc = run_local(["exec", FLAKY_CONFIG])
+        self.assertEqual(proc.exit_code, 0)
+        exec_id = proc.result_vars["execution_id"]
+
+        proc = run_local(["status", exec_id])
+        self.assertEqual(proc.exit_code, 0)
+
+        proc = run_local(["log", exec_id])
+        self.assertEqual(proc.exit_code, 0)
+
+        proc = run_local(["profile", exec_id])
+        self.assertEqual(proc.exit_code, 0)
+        steps = sorted(proc.result_vars["steps"])
+        self.assertEqual([i for i, _, _ in steps], [1, 2, 3])
+
+        proc = run_local(["clean", exec_id])
+        self.assertEqual(proc.exit_code, 0)
+
+    def test_profile_skips_torn_trace_lines(self):
+        with tempfile.TemporaryDirectory() as run_root:
+            os.mkdir(os.path.join(run_root, "torn"))
+            with open(os.path.join(run_root, "torn", cattle_remote.TRACE_FILE), "w") as f:
+                f.write('{"step": 1, "cls": "Noop", "desc": "noop", "should_run_s": 0.5, "attempts": [1.0]}\n'
+                        '{"step": 2, "cls": "No')
+            proc = run_local(["profile", "torn"], run_root)
+            self.assertEqual(proc.exit_code, 0)
+            self.assertEqual(proc.result_vars["steps"], {(1, "Noop", "noop"): [1.5]})
+            runner = HostRunner("torn", run_root, "[local]", LocalHostConduit(), agent_runtime=make_executable())
+            try:
+                self.assertEqual([r["step"] for r in runner.trace()], [1])
+            finally:
+                runner.close()
+
+    def test_run_local_transfer_modes(self):
+        for mode in ("pipeline", "stream"):
+            with self.subTest(mode=mode):
+                proc = run_local(["exec", FLAKY_CONFIG, "--transfer", mode])
+                self.assertEqual(proc.exit_code, 0)
+                exec_id = proc.result_vars["execution_id"]
+                with open(os.path.join(TEST_RUN_ROOT, exec_id, "STATUS")) as f:
+                    self.assertEqual(f.read(), "DONE")
+
+                proc = run_local(["clean", exec_id])
+                self.assertEqual(proc.exit_code, 0)
+
+    def test_pipeline_with_a_chatty_runtime(self):
+        # More output than a pipe holds, which once deadlocked the bootstrap.
+        with tempfile.TemporaryDirectory() as tmp:
+            cfg = write_config(tmp, (
+                "class Chatter:\n"
+                "    def run(self):\n"
+                "        print('moo' * 500000)\n"
+                "    def desc(self):\n"
+                "        return 'chatter'\n"
+                "steps = [Chatter()]\n"
+            ))
+            result = {}
+            t = threading.Thread(target=lambda: result.update(proc=run_local(
+                ["exec", cfg, "--transfer", "pipeline"], os.path.join(tmp, "run"))), daemon=True)
+            t.start()
+            t.join(60)
+            self.assertFalse(t.is_alive())
+            self.assertEqual(result["proc"].exit_code, 0)
 
-        proc = main_args_inner(["exec", test_config, "--local", "--run-root", run_root])
+    def test_run_local_detached(self):
+        proc = run_local(["exec", FLAKY_CONFIG, "--detach"])
         self.assertEqual(proc.exit_code, 0)
         exec_id = proc.result_vars["execution_id"]
+        self.assertTrue(os.path.exists(os.path.join(TEST_RUN_ROOT, exec_id, "PID")))
 
-        proc = main_args_inner(["status", exec_id, "--local", "--run-root", run_root])
+        proc = run_local(["wait", exec_id, "--timeout", "10"])
         self.assertEqual(proc.exit_code, 0)
+        self.assertEqual(proc.result_vars, {"[local]": "DONE"})
 
-        proc = main_args_inner(["log", exec_id, "--local", "--run-root", run_root])
+        proc = run_local(["clean", exec_id])
         self.assertEqual(proc.exit_code, 0)
 
-        proc = main_args_inner(["clean", exec_id, "--local", "--run-root", run_root])
+    def test_failed_detach_is_reported(self):
+        # The daemon can't record its pid, and says so before it goes.
+        with tempfile.TemporaryDirectory() as tmp:
+            with self.assertRaisesRegex(OSError, "detached run didn't start: ERROR"):
+                cattle_remote.daemonize(os.path.join(tmp, "missing"))
+
+    def test_run_local_through_agent(self):
+        proc = run_local(["exec", FLAKY_CONFIG, "--detach"])
+        self.assertEqual(proc.exit_code, 0)
+        exec_id = proc.result_vars["execution_id"]
+
+        proc = run_local(["watch", exec_id, "--timeout", "10", "--agent"])
+        self.assertEqual(proc.result_vars, {"[local]": "DONE"})
+        runtime = make_executable()
+        agent = LocalHostConduit.agents[(TEST_RUN_ROOT, runtime.digest)]
+
+        # Later commands reuse the agent the first one started.
+        proc = run_local(["status", exec_id, "--agent", "--refresh"])
+        self.assertEqual(proc.result_vars, {"[local]": "DONE"})
+        proc = run_local(["profile", exec_id, "--agent"])
+        self.assertEqual([i for i, _, _ in sorted(proc.result_vars["steps"])], [1, 2, 3])
+        # Step 3 fails twice before it succeeds.
+        proc = run_local(["log", exec_id, "--step", "3", "--level", "WARNING", "--agent"])
+        self.assertEqual(proc.result_vars, {"[local]": 2})
+        self.assertIs(LocalHostConduit.agents[(TEST_RUN_ROOT, runtime.digest)], agent)
+        self.assertFalse(agent.closed)
+
+        runner = HostRunner(exec_id, TEST_RUN_ROOT, "[local]", LocalHostConduit(), agent_runtime=runtime)
+        try:
+            self.assertEqual(runner.status(), "DONE")
+            self.assertIs(runner.agent, agent)
+            self.assertEqual([r["step"] for r in runner.trace()], [1, 2, 3])
+            # Many calls in flight on the one channel at once.
+            with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+                statuses = list(executor.map(lambda _: runner.status(), range(32)))
+            self.assertEqual(set(statuses), {"DONE"})
+            with self.assertRaisesRegex(Exception, "isn't an execution under"):
+                runner.agent.call("clean", exec_dir="/etc")
+
+            # A query selecting more than a reply's worth comes in chunks.
+            lines = []
+            self.assertEqual(runner.query_log({}, lines.append), len(lines))
+            with mock.patch.object(cattle_remote, "LOG_CHUNK", 1):
+                local_agent = cattle_remote.Agent(TEST_RUN_ROOT, None)
+                req = {"exec_dir": runner.exec_dir, "query": {"line_range": [0, 3]}}
+                self.assertEqual(local_agent.op_log(dict(req, skip=1)),
+                                 {"lines": [lines[1].decode("latin-1")], "more": True})
+                self.assertEqual(local_agent.op_log(dict(req, skip=2)),
+                                 {"lines": [lines[2].decode("latin-1")], "more": False})
+        finally:
+            runner.close()
+
+        proc = run_local(["clean", exec_id, "--agent"])
+        self.assertEqual(proc.exit_code, 0)
+        self.assertFalse(os.path.exists(os.path.join(TEST_RUN_ROOT, exec_id)))
+
+    def test_conduit_factory_reaches_named_hosts(self):
+        made = []
+
+        def conduit_factory(hostdesc):
+            made.append(hostdesc)
+            return LocalHostConduit()
+
+        with tempfile.TemporaryDirectory() as run_root, \
+                mock.patch("getpass.getpass", side_effect=AssertionError("asked for a password")):
+            proc = main_args_inner(["status", "nowhere", "--host", "a", "--host", "b", "--run-root", run_root],
+                                   conduit_factory=conduit_factory)
+        self.assertEqual(sorted(made), ["a", "b"])
+        self.assertEqual(proc.result_vars, {"a": "UNKNOWN", "b": "UNKNOWN"})
+
+    def test_registry_remembers_hosts(self):
+        proc = run_local(["exec", FLAKY_CONFIG])
+        exec_id = proc.result_vars["execution_id"]
+
+        # No hosts given: they come from the registry, and the finished host
+        # isn't asked again.
+        with mock.patch.object(HostRunner, "status", side_effect=AssertionError("asked the host")):
+            proc = main_args_inner(["status", exec_id])
+        self.assertEqual(proc.result_vars, {"[local]": "DONE"})
+        proc = main_args_inner(["status", exec_id, "--refresh"])
+        self.assertEqual(proc.result_vars, {"[local]": "DONE"})
+
+        proc = main_args_inner(["list"])
+        self.assertIn(exec_id, proc.result_vars["executions"])
+
+        proc = main_args_inner(["clean", "--finished"])
+        self.assertIn(exec_id, proc.result_vars["cleaned"])
+        self.assertFalse(os.path.exists(os.path.join(TEST_RUN_ROOT, exec_id)))
+        self.assertNotIn(exec_id, main_args_inner(["list"]).result_vars["executions"])
+
+    def test_clean_finished_spares_failures_and_asks_once(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            env = {"CATTLE_REGISTRY": os.path.join(tmp, "registry.sqlite3")}
+            with mock.patch.dict(os.environ, env):
+                os.environ.pop("SSH_SPECIAL_PASS", None)
+                registry = cattle_cli.Registry()
+                for execution_id, outcome in (("ok1", "DONE"), ("ok2", "DONE"), ("bad", "ERROR")):
+                    runners = [HostRunner(execution_id, tmp, h, LocalHostConduit()) for h in ("a", "b")]
+                    registry.add_execution(execution_id, None, runners, False, None, "u")
+                    registry.set_status(execution_id, "a", "DONE")
+                    registry.set_status(execution_id, "b", outcome)
+                registry.close()
+
+                # Only the host asked about, though the registry knows both.
+                proc = main_args_inner(["status", "bad", "--host", "b"], conduit_factory=lambda h: LocalHostConduit())
+                self.assertEqual(proc.result_vars, {"b": "ERROR"})
+
+                with mock.patch("getpass.getpass", return_value="pw") as getpass, \
+                        mock.patch.object(cattle_cli, "RemoteHostConduit", lambda *args: LocalHostConduit()):
+                    proc = main_args_inner(["clean", "--finished"])
+                self.assertEqual(proc.result_vars["cleaned"], ["ok1", "ok2"])
+                getpass.assert_called_once()
+
+                with contextlib.redirect_stderr(io.StringIO()) as err:
+                    proc = main_args_inner(["status", "missing"])
+                self.assertEqual(proc.exit_code, 1)
+                self.assertIn("require at least one host", err.getvalue())
+
+RESUMABLE_CONFIG = """
+import os
+
+class Step:
+    def __init__(self, name):
+        self.name = name
+
+    def run(self):
+        if os.path.exists(os.path.join({tmp!r}, "fail-" + self.name)):
+            raise Exception("step " + self.name + " failed")
+        with open(os.path.join({tmp!r}, "ran"), "a") as f:
+            f.write(self.name + "\\n")
+
+    def desc(self):
+        return "step " + self.name
+
+steps = [Step("a"), Step("b"), Step("c")]
+"""
+
+class TestResume(unittest.TestCase):
+    def test_resume_skips_completed_steps(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            cfg = write_config(tmp, RESUMABLE_CONFIG.format(tmp=tmp))
+            open(os.path.join(tmp, "fail-b"), "w").close()
+            run_root = os.path.join(tmp, "run")
+
+            proc = run_local(["exec", cfg], run_root)
+            exec_id = proc.result_vars["execution_id"]
+            with open(os.path.join(run_root, exec_id, "STATUS")) as f:
+                self.assertEqual(f.read(), "ERROR")
+
+            os.unlink(os.path.join(tmp, "fail-b"))
+            proc = run_local(["resume", exec_id], run_root)
+            self.assertEqual(proc.exit_code, 0)
+            with open(os.path.join(run_root, exec_id, "STATUS")) as f:
+                self.assertEqual(f.read(), "DONE")
+            with open(os.path.join(tmp, "ran")) as f:
+                self.assertEqual(f.read().split(), ["a", "b", "c"])
+            # Step 2's failed attempt was superseded by its rerun.
+            steps = run_local(["profile", exec_id], run_root).result_vars["steps"]
+            self.assertEqual(sorted((i, len(times)) for (i, _, _), times in steps.items()), [(1, 1), (2, 1), (3, 1)])
+
+    def test_resume_a_run_whose_process_died(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            cfg = write_config(tmp, RESUMABLE_CONFIG.format(tmp=tmp))
+            run_root = os.path.join(tmp, "run")
+            proc = run_local(["exec", cfg], run_root)
+            exec_id = proc.result_vars["execution_id"]
+            exec_dir = os.path.join(run_root, exec_id)
+
+            # Killed mid-run: the status still says PROGRESS, but its process
+            # is gone (or never got to record itself).
+            dead = subprocess.Popen(["true"])
+            dead.wait()
+            for pid in (str(dead.pid), None):
+                with self.subTest(pid=pid):
+                    with open(os.path.join(exec_dir, "STATUS"), "w") as f:
+                        f.write("PROGRESS")
+                    if pid is None:
+                        os.unlink(os.path.join(exec_dir, "PID"))
+                    else:
+                        with open(os.path.join(exec_dir, "PID"), "w") as f:
+                            f.write(pid)
+                    self.assertEqual(cattle_remote.read_state(exec_dir).split()[0], "DIED")
+                    run_local(["resume", exec_id], run_root)
+                    with open(os.path.join(exec_dir, "STATUS")) as f:
+                        self.assertEqual(f.read(), "DONE")
+
+    def test_fingerprints_ignore_object_identity(self):
+        class Step:
+            def __init__(self):
+                self.name = "a"
+                self.handle = object()
+
+        class Explicit(Step):
+            def fingerprint(self):
+                return self.name
+
+        self.assertEqual(cattle_remote.step_fingerprint(Step()), cattle_remote.step_fingerprint(Step()))
+        a, b = Explicit(), Explicit()
+        b.name = "b"
+        self.assertNotEqual(cattle_remote.step_fingerprint(a), cattle_remote.step_fingerprint(b))
+
+DRIFT_CONFIG = """
+import os
+
+class Touch:
+    def __init__(self, name):
+        self.path = os.path.join({tmp!r}, name)
+
+    def should_run(self):
+        return not os.path.exists(self.path)
+
+    def run(self):
+        open(self.path, "w").close()
+
+    def desc(self):
+        return "touch " + self.path
+
+steps = [Touch("a"), Touch("b")]
+"""
+
+class TestCheck(unittest.TestCase):
+    def test_check_and_exec_if_drifted(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            cfg = write_config(tmp, DRIFT_CONFIG.format(tmp=tmp))
+            open(os.path.join(tmp, "a"), "w").close()
+            run_root = os.path.join(tmp, "run")
+
+            proc = run_local(["check", cfg], run_root)
+            self.assertEqual(proc.result_vars, {"01": ["[local]"]})
+            self.assertEqual(os.listdir(run_root), ["artifacts"])
+
+            proc = run_local(["exec", cfg, "--if-drifted"], run_root)
+            self.assertEqual(main_args_inner(["status", proc.result_vars["execution_id"]]).result_vars,
+                             {"[local]": "DONE"})
+            self.assertTrue(os.path.exists(os.path.join(tmp, "b")))
+
+            # Nothing left to do: the host is marked DONE without running.
+            proc = run_local(["check", cfg], run_root)
+            self.assertEqual(proc.result_vars, {"00": ["[local]"]})
+            proc = run_local(["exec", cfg, "--if-drifted"], run_root)
+            exec_dir = os.path.join(run_root, proc.result_vars["execution_id"])
+            with open(os.path.join(exec_dir, "STATUS")) as f:
+                self.assertEqual(f.read(), "DONE")
+            self.assertFalse(os.path.exists(os.path.join(exec_dir, "exec.log")))
+
+    def test_failed_check_is_cleaned_up(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            cfg = write_config(tmp, DRIFT_CONFIG.format(tmp=tmp))
+            run_root = os.path.join(tmp, "run")
+
+            with mock.patch.object(HostRunner, "check", side_effect=Exception("check blew up")), \
+                    contextlib.redirect_stderr(io.StringIO()):
+                proc = run_local(["check", cfg], run_root)
+            self.assertEqual(proc.result_vars, {cattle_cli.UNREACHABLE: ["[local]"]})
+            self.assertEqual(os.listdir(run_root), ["artifacts"])
+
+class TestDeltaTransfer(unittest.TestCase):
+    def test_delta_against_previous_execution(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            big = os.urandom(200000)
+            cfg = write_config(tmp, "steps = []\n", {"big.bin": big, "sub/t.conf": "x = 1\n" * 100})
+            args = ["exec", cfg, "--transfer", "delta"]
+            run_root = os.path.join(tmp, "run")
+
+            with mock.patch.dict(os.environ, {"CATTLE_CACHE_DIR": os.path.join(tmp, "cache")}):
+                run_local(args, run_root)
+                # An insertion and an overwrite in the big file, a change to the small one.
+                with open(os.path.join(cfg, "big.bin"), "wb") as f:
+                    f.write(b"new" + big[:100000] + b"changed" + big[100007:])
+                with open(os.path.join(cfg, "sub", "t.conf"), "w") as f:
+                    f.write("x = 2\n" + "x = 1\n" * 99)
+                proc = run_local(args, run_root)
+
+            exec_dir = os.path.join(run_root, proc.result_vars["execution_id"])
+            with open(os.path.join(exec_dir, "STATUS")) as f:
+                self.assertEqual(f.read(), "DONE")
+            (delta,) = glob.glob(os.path.join(exec_dir, "config.delta.tar*"))
+            self.assertLess(os.path.getsize(delta), 20000)
+            for relpath in ("big.bin", "sub/t.conf", "__cattle__.py"):
+                with open(os.path.join(cfg, relpath), "rb") as want, \
+                        open(os.path.join(exec_dir, "config", relpath), "rb") as got:
+                    self.assertEqual(got.read(), want.read())
+
+    def test_base_must_be_done_and_unaltered(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            cfg = write_config(tmp, "steps = []\n", {"kept.conf": "a = 1\n"})
+            run_root = os.path.join(tmp, "run")
+            args = ["exec", cfg, "--transfer", "delta"]
+
+            with mock.patch.dict(os.environ, {"CATTLE_CACHE_DIR": os.path.join(tmp, "cache")}):
+                first = os.path.join(run_root, run_local(args, run_root).result_vars["execution_id"])
+                self.assertEqual(cattle_remote.latest_config(run_root), os.path.join(first, "config"))
+                # Tampered with, keeping its size: the delta mustn't reuse it.
+                with open(os.path.join(first, "config", "kept.conf"), "w") as f:
+                    f.write("a = 2\n")
+                with contextlib.redirect_stderr(io.StringIO()) as err:
+                    second = os.path.join(run_root, run_local(args, run_root).result_vars["execution_id"])
+                self.assertIn("delta didn't apply", err.getvalue())
+                with open(os.path.join(second, "config", "kept.conf")) as f:
+                    self.assertEqual(f.read(), "a = 1\n")
+                for name in (cattle_remote.DELTA_SPEC_NAME, cattle_remote.DELTA_DATA_NAME):
+                    self.assertFalse(os.path.exists(os.path.join(second, name)))
+
+            # A run that didn't finish is no base.
+            with open(os.path.join(second, "STATUS"), "w") as f:
+                f.write("ERROR")
+            self.assertEqual(cattle_remote.latest_config(run_root), os.path.join(first, "config"))
+
+class TestLogQuery(unittest.TestCase):
+    def test_filters_run_on_the_host(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            exec_id = run_local(["exec", FLAKY_CONFIG], tmp).result_vars["execution_id"]
+
+            # Step 3 fails twice before it succeeds.
+            proc = run_local(["log", exec_id, "--step", "3", "--level", "WARNING"], tmp)
+            self.assertEqual(proc.result_vars, {"[local]": 2})
+            proc = run_local(["log", exec_id, "-e", "COMPLETED", "-i", "--tail", "1"], tmp)
+            self.assertEqual(proc.result_vars, {"[local]": 1})
+
+            out = os.path.join(tmp, "logs")
+            proc = run_local(["log", exec_id, "--lines", "1:3", "-o", out], tmp)
+            self.assertEqual(proc.exit_code, 0)
+            with open(os.path.join(out, "[local].log")) as f:
+                lines = f.read().splitlines()
+            self.assertEqual(len(lines), 2)
+            self.assertIn("running in real mode", lines[0])
+            self.assertIn("[1] Running step 1", lines[1])
+
+    def test_noisy_stderr_doesnt_stall_the_query(self):
+        # A host writing more to stderr than a pipe holds before it's done
+        # with stdout.
+        script = ("import gzip, sys; sys.stderr.write('warning\\n' * 100000); sys.stderr.flush(); "
+                  "sys.stdout.buffer.write(gzip.compress(b'selected\\n'))")
+
+        class NoisyConduit(LocalHostConduit):
+            def popen(self, cmd):
+                return super().popen(f"{sys.executable} -c {shlex.quote(script)}")
+
+        runner = HostRunner("noisy", "/nonexistent", "[local]", NoisyConduit())
+        lines = []
+        query = threading.Thread(target=runner.query_log, args=({}, lines.append), daemon=True)
+        query.start()
+        query.join(timeout=30)
+        self.assertFalse(query.is_alive(), "query stalled")
+        self.assertEqual(lines, [b"selected\n"])
+
+class TestCodecs(unittest.TestCase):
+    def test_each_codec_round_trips(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            # (Over a chunk, so there's more than one gzip member.)
+            payload = os.urandom(1000) * 1500
+            cfg = write_config(tmp, "steps = []\n", {"payload": payload})
+
+            with mock.patch.dict(os.environ, {"CATTLE_CACHE_DIR": os.path.join(tmp, "cache")}):
+                for codec, transfer in itertools.product(["none", "gz", "xz"], ["scp", "stream"]):
+                    with self.subTest(codec=codec, transfer=transfer):
+                        proc = run_local(["exec", cfg, "--codec", codec, "--transfer", transfer],
+                                         os.path.join(tmp, "run"))
+                        exec_dir = os.path.join(tmp, "run", proc.result_vars["execution_id"])
+                        with open(os.path.join(exec_dir, "STATUS")) as f:
+                            self.assertEqual(f.read(), "DONE")
+                        with open(os.path.join(exec_dir, "config", "payload"), "rb") as f:
+                            self.assertEqual(f.read(), payload)
+
+    def test_streamed_config_is_checked_before_unpacking(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            cfg = write_config(tmp, "steps = []\n")
+            archive = io.BytesIO()
+            cattle_cli.write_archive(cfg, archive, codec="none")
+
+            def stream_init(digest):
+                framed = io.BytesIO()
+                cattle_cli.ChunkedWriter(framed).write(archive.getvalue())
+                cattle_cli.ChunkedWriter(framed).finish(digest)
+                exec_dir = tempfile.mkdtemp(dir=tmp)
+                proc = subprocess.run(
+                    [sys.executable, cattle_remote.__file__, "init", "-", "--codec", "none"],
+                    cwd=exec_dir, input=framed.getvalue(), stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                )
+                return proc.returncode, sorted(os.listdir(exec_dir))
+
+            self.assertEqual(stream_init("0" * 64), (1, []))
+            digest = hashlib.sha256(archive.getvalue()).hexdigest()
+            self.assertEqual(stream_init(digest), (0, ["config"]))
+
+    def test_choose_codec(self):
+        with tempfile.TemporaryDirectory() as tmp, tempfile.TemporaryDirectory() as cache, \
+                mock.patch.dict(os.environ, {"CATTLE_CACHE_DIR": cache}):
+            cfg = write_config(tmp, "steps = []\n", {"random": os.urandom(1 << 20)})
+            self.assertEqual(choose_codec(cfg, config_entries(cfg), 1e9), "none")
+
+            text = "".join(f"setting_{i} = {i * i}\n" for i in range(50000))
+            cfg = write_config(tmp, "steps = []\n", {"text": text})
+            entries = config_entries(cfg)
+            codec = choose_codec(cfg, entries, 1e6, workers=1)
+            self.assertIn(codec, ("gz", "xz"))
+
+            # The same build doesn't get sampled again.
+            with mock.patch.object(cattle_cli, "_compress_chunk", side_effect=AssertionError("sampled")):
+                self.assertEqual(choose_codec(cfg, entries, 1e6, workers=1), codec)
+
+    def test_delta_codec_goes_by_the_delta(self):
+        with tempfile.TemporaryDirectory() as tmp, tempfile.TemporaryDirectory() as cache, \
+                mock.patch.dict(os.environ, {"CATTLE_CACHE_DIR": cache}):
+            cfg = write_config(tmp, "steps = []\n", {
+                "settings.conf": "".join(f"setting_{i} = {i * i}\n" for i in range(100000)),
+                "random": os.urandom(1 << 20),
+            })
+            entries = config_entries(cfg)
+            manifest = cattle_cli.build_manifest(cfg, entries)
+            self.assertIn(choose_codec(cfg, entries, 1e6, workers=1), ("gz", "xz"))
+
+            # The host has the text already, so the delta is all random bytes.
+            text = json.loads(manifest)["files"]["settings.conf"]
+            base = {"base": "old", "manifest": {"settings.conf": text}, "files": {}}
+            delta = cattle_cli.make_delta(cfg, entries, manifest, base, "auto", 1e6, workers=1)
+            self.assertEqual(delta.name, cattle_cli.DELTA_NAME)
+
+    def test_failed_compression_stops_the_workers(self):
+        out = io.BytesIO()
+        with self.assertRaises(RuntimeError):
+            with cattle_cli.ChunkCompressor(out, "gz", workers=2) as compressed:
+                compressed.write(os.urandom(3 << 20))
+                executor = compressed.executor
+                raise RuntimeError("tar failed")
+        self.assertIsNone(compressed.executor)
+        self.assertTrue(executor._shutdown)
+        self.assertFalse(compressed.pending)
+
+class Noop:
+    def run(self):
+        pass
+
+    def desc(self):
+        return "noop"
+
+class TestStepGraph(unittest.TestCase):
+    def test_undeclared_steps_run_in_order(self):
+        self.assertEqual(cattle_remote.plan_steps([Noop(), Noop(), Noop()]), {1: set(), 2: {1}, 3: {2}})
+
+    def test_resources_and_barriers(self):
+        a = declare(Noop(), resources={"/etc/a"})
+        b = declare(Noop(), resources={"/etc/b"})
+        a2 = declare(Noop(), resources={"/etc/a"})
+        barrier = Noop()
+        c = declare(Noop(), depends_on=[b])
+        self.assertEqual(
+            cattle_remote.plan_steps([a, b, a2, barrier, c]),
+            {1: set(), 2: set(), 3: {1}, 4: {1, 2, 3}, 5: {2, 4}},
+        )
+
+    def test_independent_steps_overlap(self):
+        started = threading.Barrier(2, timeout=5)
+
+        class Meet(Noop):
+            def run(self):
+                started.wait()
+
+        class Config:
+            steps = [declare(Meet(), resources={"x"}), declare(Meet(), resources={"y"})]
+
+        # Each step waits for the other to start, so this only finishes if
+        # they run concurrently.
+        cattle_remote.run_config(Config)
+
+    def test_coalesced_steps_keep_their_numbers(self):
+        class Mergeable(Noop):
+            def merge(self, other):
+                return self
+
+        class Config:
+            steps = [Noop(), Mergeable(), Mergeable(), Noop()]
+
+        with tempfile.TemporaryDirectory() as tmp:
+            trace = cattle_remote.Trace(os.path.join(tmp, "trace.jsonl"))
+            try:
+                cattle_remote.run_config(Config, trace=trace)
+            finally:
+                trace.close()
+            with open(os.path.join(tmp, "trace.jsonl")) as f:
+                records = cattle_remote.parse_trace(f)
+            self.assertEqual([(r["step"], r["last"]) for r in records], [(1, 1), (2, 3), (4, 4)])
+
+            log = os.path.join(tmp, "exec.log")
+            with open(log, "w") as f:
+                f.write("2026-01-01 00:00:00,000 INFO [2-3] Running step 2-3: Mergeable (noop)\n"
+                        "2026-01-01 00:00:00,001 INFO [4] Running step 4: Noop (noop)\n")
+            self.assertEqual(len(list(cattle_remote.query_log(log, steps=[3]))), 1)
+
+class TestRetryPolicy(unittest.TestCase):
+    def test_backoff_is_capped_and_jittered(self):
+        policy = RetryPolicy(backoff_base=1, backoff_cap=5, jitter=False)
+        self.assertEqual([policy.delay(n) for n in range(1, 6)], [1, 2, 4, 5, 5])
+        jittered = RetryPolicy(backoff_base=1, backoff_cap=5)
+        self.assertTrue(all(0 <= jittered.delay(4) <= 5 for _ in range(100)))
+
+    def test_attempts_time_out(self):
+        attempts = []
+        procs = []
+
+        def attempt():
+            procs.append(subprocess.Popen(["sleep", "5"]))
+            procs[-1].wait(timeout=attempt_timeout())
+
+        policy = RetryPolicy(attempts=2, backoff_base=0, timeout=0.05)
+        try:
+            with self.assertRaises(Exception):
+                cattle_remote.call_with_retry(attempt, attempts, policy)
+        finally:
+            for proc in procs:
+                proc.kill()
+                proc.wait()
+        self.assertEqual(len(attempts), 2)
+        self.assertTrue(all(a < 0.5 for a in attempts))
+
+    def test_attempts_never_overlap(self):
+        running = []
+        overlapped = []
+
+        def attempt():
+            overlapped.append(bool(running))
+            running.append(1)
+            time.sleep(0.1)
+            running.pop()
+
+        policy = RetryPolicy(attempts=3, backoff_base=0, timeout=0.01)
+        with self.assertRaisesRegex(Exception, "over its 0.01s timeout"):
+            cattle_remote.call_with_retry(attempt, None, policy)
+        self.assertEqual(overlapped, [False, False, False])
+
+class TestInstallDebPackages(unittest.TestCase):
+    def test_consecutive_package_steps_coalesce(self):
+        steps = [
+            InstallDebPackages("curl"),
+            InstallDebPackages(["jq", "curl"], max_index_age=60),
+            Noop(),
+            InstallDebPackages("nginx"),
+        ]
+        merged = cattle_remote.coalesce_steps(steps)
+        self.assertEqual([(first, last) for first, last, _ in merged], [(1, 2), (3, 3), (4, 4)])
+        self.assertEqual(merged[0][2].packages, ["curl", "jq"])
+        self.assertEqual(merged[0][2].max_index_age, 60)
+        self.assertEqual(merged[2][2].packages, ["nginx"])
+
+    def test_steps_depended_on_stay_apart(self):
+        steps = [InstallDebPackages("curl"), InstallDebPackages("jq"), InstallDebPackages("nginx")]
+        steps.append(declare(Noop(), depends_on=[steps[1]]))
+        merged = cattle_remote.coalesce_steps(steps)
+        self.assertEqual([(first, last) for first, last, _ in merged], [(1, 1), (2, 2), (3, 3), (4, 4)])
+        self.assertIn(2, cattle_remote.plan_steps([step for _, _, step in merged])[4])
+
+    def test_merge_reconciles_pins(self):
+        merged = InstallDebPackages(["curl", "jq=1.6"]).merge(InstallDebPackages(["curl=7.81.0", "jq"]))
+        self.assertEqual(merged.packages, ["curl=7.81.0", "jq=1.6"])
+        self.assertIsNone(InstallDebPackages("curl=7.81.0").merge(InstallDebPackages("curl=7.82.0")))
+        steps = [InstallDebPackages("curl=7.81.0"), InstallDebPackages("curl=7.82.0")]
+        self.assertEqual(len(cattle_remote.coalesce_steps(steps)), 2)
+
+    def test_index_freshness_goes_by_release_files(self):
+        from cattle.facility import system
+
+        with tempfile.TemporaryDirectory() as tmp:
+            stamp = os.path.join(tmp, "update-success-stamp")
+            with mock.patch.object(system, "APT_LISTS_DIR", tmp), mock.patch.object(system, "APT_UPDATE_STAMP", stamp):
+                step = InstallDebPackages("curl", max_index_age=60)
+                self.assertFalse(step.index_is_fresh())
+                release = os.path.join(tmp, "deb.debian.org_debian_dists_stable_InRelease")
+                open(release, "w").close()
+                self.assertTrue(step.index_is_fresh())
+                os.utime(release, (time.time() - 120,) * 2)
+                self.assertFalse(step.index_is_fresh())
+                open(stamp, "w").close()
+                self.assertTrue(step.index_is_fresh())
+
+    def test_should_run_checks_installed_versions(self):
+        dpkg_output = b"curl 7.81.0 install ok installed\njq 1.6 deinstall ok config-files\n"
+        with mock.patch("subprocess.run", return_value=mock.Mock(stdout=dpkg_output)):
+            self.assertFalse(InstallDebPackages("curl").should_run())
+            self.assertTrue(InstallDebPackages("curl=7.82.0").should_run())
+            self.assertTrue(InstallDebPackages(["curl", "jq"]).should_run())
+
+class TestInstallFile(unittest.TestCase):
+    def test_install_and_change_detection(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            src = os.path.join(tmp, "poem.txt")
+            dest = os.path.join(tmp, "installed.txt")
+            with open(src, "w") as f:
+                f.write("moo moo")
+
+            step = InstallFile(src, dest)
+            self.assertTrue(step.should_run())
+            step.run()
+            self.assertFalse(step.should_run())
+            with open(dest) as f:
+                self.assertEqual(f.read(), "moo moo")
+
+            # Same size, different bytes.
+            with open(dest, "w") as f:
+                f.write("baa baa")
+            self.assertTrue(step.should_run())
+            os.chmod(dest, 0o600)
+            step.run()
+            self.assertFalse(step.should_run())
+            self.assertEqual(os.stat(dest).st_mode & 0o777, 0o600)
+            self.assertEqual(sorted(os.listdir(tmp)), ["installed.txt", "poem.txt"])
+
+    def test_failed_copy_leaves_no_temp_file(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            src = os.path.join(tmp, "poem.txt")
+            dest = os.path.join(tmp, "installed.txt")
+            with open(src, "w") as f:
+                f.write("moo moo")
+
+            full = OSError(errno.ENOSPC, "No space left on device")
+            with mock.patch("cattle.facility.file._copy_contents", side_effect=full):
+                with self.assertRaises(OSError):
+                    InstallFile(src, dest).run()
+            self.assertEqual(os.listdir(tmp), ["poem.txt"])
+
+class TestSyncTree(unittest.TestCase):
+    def _write(self, root, files):
+        for relpath, content in files.items():
+            os.makedirs(os.path.dirname(os.path.join(root, relpath)), exist_ok=True)
+            with open(os.path.join(root, relpath), "w") as f:
+                f.write(content)
+
+    def _read(self, root):
+        found = {}
+        for d, _, files in os.walk(root):
+            for name in files:
+                with open(os.path.join(d, name)) as f:
+                    found[os.path.relpath(os.path.join(d, name), root)] = f.read()
+        return found
+
+    def test_sync_copies_changes_and_deletes(self):
+        for atomic in (False, True):
+            with self.subTest(atomic=atomic), tempfile.TemporaryDirectory() as tmp:
+                src, dest = os.path.join(tmp, "src"), os.path.join(tmp, "dest")
+                files = {f"d{i % 3}/f{i}": f"file {i}" for i in range(30)}
+                self._write(src, files)
+                self._write(dest, {"d0/f0": "file 0", "d1/f1": "stale", "old/gone": "x"})
+                os.chmod(os.path.join(dest, "d1/f1"), 0o600)
+
+                step = SyncTree(src, dest, delete=True, atomic=atomic, workers=4)
+                self.assertTrue(step.should_run())
+                self.assertEqual(len(step._plan[0]), 29)
+                self.assertEqual(step._plan[1], ["old/gone"])
+                step.run()
+                self.assertEqual(self._read(dest), files)
+                self.assertFalse(os.path.exists(os.path.join(dest, "old")))
+                self.assertEqual(os.stat(os.path.join(dest, "d1/f1")).st_mode & 0o777, 0o600)
+                self.assertEqual(sorted(os.listdir(tmp)), ["dest", "src"])
+                self.assertFalse(step.should_run())
+
+                # Same size, different bytes; and without delete, strays stay.
+                self._write(dest, {"d2/f2": "file X", "stray": "y"})
+                step = SyncTree(src, dest, atomic=atomic)
+                self.assertTrue(step.should_run())
+                step.run()
+                self.assertEqual(self._read(dest), dict(files, stray="y"))
+
+    def test_missing_source_leaves_dest_alone(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            dest = os.path.join(tmp, "dest")
+            self._write(dest, {"keep": "x"})
+            step = SyncTree(os.path.join(tmp, "missing"), dest, delete=True)
+            with self.assertRaises(NotADirectoryError):
+                step.should_run()
+            with self.assertRaises(NotADirectoryError):
+                step.run()
+            self.assertEqual(self._read(dest), {"keep": "x"})
+
+    def test_symlinks(self):
+        for atomic in (False, True):
+            with self.subTest(atomic=atomic), tempfile.TemporaryDirectory() as tmp:
+                src, dest, elsewhere = (os.path.join(tmp, d) for d in ("src", "dest", "elsewhere"))
+                self._write(src, {"d/f": "new", "f": "file"})
+                self._write(elsewhere, {"f": "old"})
+                os.symlink(os.path.join(src, "f"), os.path.join(src, "link"))
+                os.makedirs(dest)
+                # Symlinked directories in dest go like files do, and what's
+                # copied doesn't go through them.
+                os.symlink(elsewhere, os.path.join(dest, "d"))
+                os.symlink(elsewhere, os.path.join(dest, "stray"))
+
+                SyncTree(src, dest, delete=True, atomic=atomic).run()
+                self.assertEqual(self._read(dest), {"d/f": "new", "f": "file"})
+                self.assertEqual(sorted(os.listdir(dest)), ["d", "f"])
+                self.assertFalse(os.path.islink(os.path.join(dest, "d")))
+                self.assertEqual(self._read(elsewhere), {"f": "old"})
+
+class TestArtifactStore(unittest.TestCase):
+    def test_transfer_skips_cached_artifacts(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            payload = os.path.join(tmp, "payload")
+            with open(payload, "w") as f:
+                f.write("moo")
+            artifact = make_artifact(payload, "payload.txt")
+            run_root = os.path.join(tmp, "run")
+
+            first = HostRunner("cattle.1", run_root, "[local]", LocalHostConduit())
+            self.assertEqual(first.transfer([artifact]), [artifact])
+
+            second = HostRunner("cattle.2", run_root, "[local]", LocalHostConduit())
+            self.assertEqual(second.transfer([artifact]), [])
+            with open(os.path.join(second.exec_dir, "payload.txt")) as f:
+                self.assertEqual(f.read(), "moo")
+
+class TestFanOut(unittest.TestCase):
+    def test_relay_reaches_every_host(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            payload = os.path.join(tmp, "payload")
+            with open(payload, "w") as f:
+                f.write("moo")
+            artifact = make_artifact(payload, "payload.txt")
+            executable = make_executable()
+
+            # Each run root stands in for a separate host.
+            runners = [
+                HostRunner("cattle.1", os.path.join(tmp, f"host{n}"), f"host{n}", LocalHostConduit())
+                for n in range(7)
+            ]
+            fan_out_artifacts(runners, executable, [artifact, executable], fanout=2)
+
+            for r in runners:
+                self.assertTrue(os.path.exists(os.path.join(r.store_dir, artifact.digest)), r.hostdesc)
+                self.assertTrue(os.path.exists(os.path.join(r.store_dir, executable.digest)), r.hostdesc)
+            # Only the seeds were sent anything directly.
+            for r in runners[2:]:
+                self.assertFalse(os.path.exists(r.exec_dir), r.hostdesc)
+
+    def test_bad_relay_copies_are_refused(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            payload = os.path.join(tmp, "payload")
+            with open(payload, "w") as f:
+                f.write("moo")
+            artifact = make_artifact(payload, "payload.txt")
+            executable = make_executable()
+            runners = [
+                HostRunner("cattle.1", os.path.join(tmp, f"host{n}"), f"host{n}", LocalHostConduit())
+                for n in range(5)
+            ]
+            # The seed's store holds a truncated copy under the right name.
+            os.makedirs(runners[0].store_dir)
+            with open(os.path.join(runners[0].store_dir, artifact.digest), "w") as f:
+                f.write("mo")
+
+            with contextlib.redirect_stderr(io.StringIO()) as err:
+                fan_out_artifacts(runners, executable, [artifact, executable], fanout=1)
+            self.assertIn("relay failed", err.getvalue())
+            for r in runners[1:]:
+                self.assertFalse(os.path.exists(os.path.join(r.store_dir, artifact.digest)), r.hostdesc)
+
+            # The direct upload that follows fills the gap.
+            runners[1].transfer([artifact, executable])
+            with open(os.path.join(runners[1].exec_dir, "payload.txt")) as f:
+                self.assertEqual(f.read(), "moo")
+
+class TestConnectionPool(unittest.TestCase):
+    def test_known_hosts_index(self):
+        key = paramiko.ECDSAKey.generate()
+        other = paramiko.ECDSAKey.generate()
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "known_hosts")
+            with open(path, "w") as f:
+                f.write(f"# comment\nplain,10.0.0.1 {key.get_name()} {key.get_base64()}\n")
+                f.write(f"{paramiko.HostKeys.hash_host('[hashed]:2222')} {other.get_name()} {other.get_base64()}\n")
+            known = KnownHosts(path)
+        self.assertEqual(known.lookup("10.0.0.1"), {key.get_name(): key})
+        self.assertEqual(known.lookup("[hashed]:2222"), {other.get_name(): other})
+        self.assertEqual(known.lookup("hashed"), {})
+
+    def test_connections_are_shared_and_closed_when_idle(self):
+        with mock.patch.object(paramiko, "SSHClient") as client_class:
+            client = client_class.return_value
+            out = mock.Mock()
+            out.channel.recv_exit_status.return_value = 0
+            out.read.return_value = b""
+            client.exec_command.return_value = (mock.Mock(), out, mock.Mock())
+
+            pool = ConnectionPool(idle_timeout=60, known_hosts_path=os.devnull)
+            a = RemoteHostConduit("h", 22, "u", "pw", pool=pool)
+            b = RemoteHostConduit("h", 22, "u", "pw", pool=pool)
+            a.exec_command("true")
+            b.exec_command("true")
+            self.assertEqual(client_class.call_count, 1)
+            client.get_transport.return_value.set_keepalive.assert_called_once_with(pool.keepalive)
+
+            a.close()
+            b.close()
+            with pool.lock:
+                pool.close_idle()
+            client.close.assert_not_called()
+            with pool.lock:
+                pool.close_idle(time.monotonic() + 60)
+            client.close.assert_called_once()
+            self.assertEqual(pool.clients, {})
+
+    def test_agents_live_with_the_connection(self):
+        with mock.patch.object(paramiko, "SSHClient"):
+            pool = ConnectionPool(idle_timeout=60, known_hosts_path=os.devnull)
+            agent = mock.Mock(closed=False)
+            start = mock.Mock(return_value=agent)
+
+            for _ in range(2):
+                conduit = RemoteHostConduit("h", 22, "u", "pw", pool=pool)
+                self.assertIs(conduit.agent(("/run", "digest"), start), agent)
+                conduit.close()
+            start.assert_called_once()
+
+            # One that's exited is replaced, and they all go with the connection.
+            agent.closed = True
+            conduit = RemoteHostConduit("h", 22, "u", "pw", pool=pool)
+            conduit.agent(("/run", "digest"), start)
+            self.assertEqual(start.call_count, 2)
+            conduit.close()
+            with pool.lock:
+                pool.close_idle(time.monotonic() + 60)
+            self.assertEqual(pool.agents, {})
+
+class FakeRunner:
+    def __init__(self, n):
+        self.n = n
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+class TestMapRunners(unittest.TestCase):
+    def test_respects_max_in_flight(self):
+        lock = threading.Lock()
+        in_flight = []
+        peak = [0]
+
+        def fn(runner):
+            with lock:
+                in_flight.append(runner)
+                peak[0] = max(peak[0], len(in_flight))
+            time.sleep(0.01)
+            with lock:
+                in_flight.remove(runner)
+
+        runners = [FakeRunner(n) for n in range(20)]
+        map_runners(fn, runners, max_in_flight=3)
+        self.assertLessEqual(peak[0], 3)
+        self.assertTrue(all(r.closed for r in runners))
+
+    def test_raises_after_all_hosts_attempted(self):
+        seen = []
+
+        def fn(runner):
+            seen.append(runner.n)
+            if runner.n == 0:
+                raise ValueError("host 0 is down")
+
+        with self.assertRaises(ValueError):
+            map_runners(fn, [FakeRunner(n) for n in range(5)], max_in_flight=2)
+        self.assertEqual(sorted(seen), list(range(5)))
+
+    def test_max_in_flight_must_be_positive(self):
+        for argv in (["status", "x", "--max-in-flight", "0"], ["wait", "x", "--max-watching", "0"]):
+            with self.subTest(argv=argv):
+                with contextlib.redirect_stderr(io.StringIO()) as err, self.assertRaises(SystemExit):
+                    run_local(argv)
+                self.assertIn("must be at least 1", err.getvalue())
+
+    def test_wait_watches_every_host_at_once(self):
+        # Five hosts, each finishing only once all five are being watched.
+        everyone = threading.Barrier(5, timeout=10)
+
+        class WatchedRunner(FakeRunner):
+            hostdesc = property(lambda self: f"host{self.n}")
+
+            def watch(self, on_change, deadline):
+                everyone.wait()
+                on_change("DONE 3")
+
+        with mock.patch.object(cattle_cli, "runners_from_args", return_value=[WatchedRunner(n) for n in range(5)]):
+            proc = main_args_inner(["wait", "watched", "--local"])
         self.assertEqual(proc.exit_code, 0)
+        self.assertEqual(set(proc.result_vars.values()), {"DONE"})
+        # (Nor do they take the other operations' pacing.)
+        with contextlib.redirect_stderr(io.StringIO()), self.assertRaises(SystemExit):
+            main_args_inner(["wait", "watched", "--local", "--adaptive"])
+
+    def test_adaptive_concurrency(self):
+        adaptive = AdaptiveConcurrency(ceiling=6, initial=2)
+        lock = threading.Lock()
+        in_flight = []
+        peak = [0]
+
+        def fn(runner):
+            with lock:
+                in_flight.append(runner)
+                peak[0] = max(peak[0], len(in_flight))
+            time.sleep(0.01)
+            with lock:
+                in_flight.remove(runner)
+            # Hosts 30 on are behind a congested link.
+            runner.first_response = 0.01 if runner.n < 30 else 0.2
+
+        map_runners(fn, [FakeRunner(n) for n in range(60)], max_in_flight=6, adaptive=adaptive)
+        self.assertLessEqual(peak[0], 6)
+        limits = [limit for limit, _ in adaptive.decisions]
+        # Up to the ceiling while things were healthy, then cut back.
+        self.assertEqual(limits[:4], [3, 4, 5, 6])
+        self.assertLess(adaptive.allowed(), 6)
+        self.assertIn("round trip", adaptive.decisions[4][1])
+
+    def test_adaptive_cuts_once_per_window(self):
+        adaptive = AdaptiveConcurrency(ceiling=16, initial=8)
+        for _ in range(4):
+            adaptive.record(ok=False)
+        self.assertEqual(adaptive.allowed(), 4)
+        adaptive.record(ok=True, bytes_sent=10 << 20, send_s=1)
+        # (Too little to go by.)
+        adaptive.record(ok=True, bytes_sent=1000, send_s=1)
+        adaptive.record(ok=True, bytes_sent=2 << 20, send_s=1)
+        self.assertEqual(adaptive.allowed(), 2)
+
+    def test_adaptive_hears_from_every_operation(self):
+        class Unreachable(LocalHostConduit):
+            def exec_command(self, cmd):
+                raise OSError("no route to host")
+
+            def popen(self, cmd):
+                raise OSError("no route to host")
+
+        # log carries on past a failing host, but still counts it as failed.
+        adaptive = AdaptiveConcurrency(ceiling=4, initial=2)
+        with tempfile.TemporaryDirectory() as tmp, contextlib.redirect_stderr(io.StringIO()), \
+                mock.patch.object(cattle_cli, "adaptive_from_args", return_value=adaptive):
+            proc = main_args_inner(["log", "cattle.1", "--host", "down", "--run-root", tmp, "--adaptive"],
+                                   conduit_factory=lambda host: Unreachable())
+        self.assertEqual(proc.exit_code, 1)
+        self.assertEqual(adaptive.decisions, [(1, "host failed")])
+
+        # And operations other than exec time their first round trip.
+        with tempfile.TemporaryDirectory() as tmp:
+            runner = HostRunner("cattle.1", tmp, "[local]", LocalHostConduit())
+            runner.status()
+            self.assertIsNotNone(runner.first_response)
+
+class TestBuildCache(unittest.TestCase):
+    def test_archive_is_cached_and_reproducible(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            cfg = write_config(tmp, "steps = []\n", {"sub/data.bin": "data"})
+
+            with mock.patch.dict(os.environ, {"CATTLE_CACHE_DIR": os.path.join(tmp, "cache")}):
+                first = make_archive(cfg)
+                self.assertEqual(make_archive(cfg), first)
+
+                # New mtime: a different cache entry, but byte-identical.
+                os.utime(os.path.join(cfg, "sub/data.bin"), (0, 0))
+                second = make_archive(cfg)
+                self.assertNotEqual(second.path, first.path)
+                self.assertEqual(second.digest, first.digest)
+
+    def test_prune_spares_recently_used_builds(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            with mock.patch.dict(os.environ, {"CATTLE_CACHE_DIR": tmp}):
+                for i in range(cattle_cli.CACHE_KEEP + 2):
+                    cattle_cli._cached_build("t", str(i), "t", lambda f: f.write(b"x"))
+                builds = [n for n in os.listdir(tmp) if n.startswith("t-") and not n.endswith(".sha256")]
+                self.assertEqual(len(builds), cattle_cli.CACHE_KEEP + 2)
+                with mock.patch.object(cattle_cli, "CACHE_GRACE", 0):
+                    cattle_cli._cached_build("t", "last", "t", lambda f: f.write(b"x"))
+                builds = [n for n in os.listdir(tmp) if n.startswith("t-") and not n.endswith(".sha256")]
+                self.assertEqual(len(builds), cattle_cli.CACHE_KEEP)
+                self.assertEqual([n for n in os.listdir(tmp) if n.startswith(".")], [])
+
+    # (The runtime is only precompiled where hash-based pycs exist, from
+    # Python 3.7, which also brought -X importtime.)
+    @unittest.skipUnless(hasattr(importlib.util, "source_hash"), "no hash-based pycs before Python 3.7")
+    def test_runtime_ships_bytecode(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            with mock.patch.dict(os.environ, {"CATTLE_CACHE_DIR": tmp}):
+                runtime = make_executable()
+                source_only = make_executable(precompile=False)
+            with zipfile.ZipFile(runtime.path) as z:
+                pyc = z.read("cattle_remote.pyc")
+            self.assertEqual(pyc[:4], importlib.util.MAGIC_NUMBER)
+            with zipfile.ZipFile(source_only.path) as z:
+                self.assertNotIn("cattle_remote.pyc", z.namelist())
+
+            # The runtime only loads what a subcommand needs.
+            proc = subprocess.run(
+                [sys.executable, "-X", "importtime", runtime.path, "poll", tmp, "--timeout", "0"],
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True,
+            )
+            imported = {line.rsplit("|", 1)[-1].strip() for line in proc.stderr.decode().splitlines()}
+            self.assertIn("cattle_remote", imported)
+            self.assertFalse(imported & {"tarfile", "concurrent.futures", "facility.step"})
 
 if __name__ == "__main__":
     unittest.main()